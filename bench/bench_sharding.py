@@ -0,0 +1,197 @@
+"""
+Бенчмарк пропускной способности многопроцессного вебхука (WEBHOOK_WORKERS).
+
+Фронт (ShardRouter + build_web_app) принимает POST-апдейты Telegram по HTTP на localhost
+и раскладывает их по воркерам. В воркере перед обычными обработчиками стоит
+обработчик-нагрузка: --work итераций чистого Python на CPU, --io-ms мс ожидания (как
+запрос к Telegram/БД) и одна запись в SQLite. Запросы к Bot API подменены заглушкой, так что
+сеть и токены не нужны. Для каждого числа воркеров печатается апдейтов/с, соблюдён ли
+порядок апдейтов каждого пользователя и в скольких процессах обрабатывался один пользователь.
+
+Запуск из корня репозитория:
+    python bench/bench_sharding.py --workers 1 2 4 [--users 40] [--per-user 10] [--work 20000]
+
+Когда шардирование помогает:
+  * обработчики упираются в CPU (разбор, сборка текста, JSON), а не только ждут сеть: один
+    процесс ограничен GIL одним ядром, а await-ожидания и так перекрываются в одном event loop;
+  * есть свободные ядра: воркеров не больше, чем ядер минус одно под фронт;
+  * на одном ядре воркеры делят тот же процессор и добавляют накладные расходы на очереди
+    между процессами и переключение контекста — пропускная способность падает, а не растёт.
+
+Результаты (1 vCPU, Linux, Python 3.11.7; 400 апдейтов от 40 пользователей, --work 20000,
+--io-ms 5; разброс по трём прогонам):
+    workers=1: 116–137 upd/s
+    workers=2: 121–136 upd/s
+    workers=4:  69–77 upd/s
+    во всех прогонах порядок апдейтов каждого пользователя соблюдён, пользователь — в одном процессе.
+На одном ядре шардирование ничего не даёт, а при воркерах сверх числа ядер пропускная способность
+падает. Ускорения стоит ждать только на многоядерной машине при воркерах ≤ ядер − 1; проверять
+прогоном с --workers 1 2 4 на целевом железе перед тем, как включать WEBHOOK_WORKERS.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+# Дочерние процессы (spawn) заново выполняют этот модуль и получают те же подмены
+os.environ.setdefault("BENCH_SHARDING_DIR", tempfile.mkdtemp(prefix="bench_shards_"))
+os.environ.update(
+    TELEGRAM_TOKEN="1:bench",
+    OPENAI_API_KEY="sk-bench",
+    DB_PATH=os.path.join(os.environ["BENCH_SHARDING_DIR"], "botdata.db"),
+    WEBHOOK_SECRET="",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder, ApplicationHandlerStop, TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import tarot_bot  # noqa: E402
+
+logging.disable(logging.INFO)
+warnings.filterwarnings("ignore", message="No `JobQueue` set up")
+
+BENCH_WORK = int(os.getenv("BENCH_SHARDING_WORK", "20000"))
+BENCH_IO = float(os.getenv("BENCH_SHARDING_IO_MS", "5")) / 1000
+FRONT_PORT = 8765
+
+
+class StubRequest(BaseRequest):
+    """Bot API без сети: на любой метод отвечает getMe-подобным результатом."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class StubApplicationBuilder(ApplicationBuilder):
+    def build(self):
+        self.request(StubRequest())
+        self.get_updates_request(StubRequest())
+        return super().build()
+
+
+async def workload(update: Update, context):
+    x = 0
+    for i in range(BENCH_WORK):  # работа обработчика на CPU
+        x += i * i
+    await asyncio.sleep(BENCH_IO)  # ожидание Telegram/БД
+
+    seq = int(update.message.text.split()[-1])
+
+    def record():
+        with tarot_bot.get_db_transaction() as conn:
+            conn.execute(
+                "INSERT INTO bench_updates(pid, user_id, seq) VALUES (?, ?, ?)",
+                (os.getpid(), update.effective_user.id, seq)
+            )
+    await tarot_bot.run_db(record)
+    raise ApplicationHandlerStop
+
+
+_build_application = tarot_bot.build_application
+
+
+def build_bench_application():
+    app = _build_application()
+    app.add_handler(TypeHandler(Update, workload), group=-1)
+    return app
+
+
+tarot_bot.ApplicationBuilder = StubApplicationBuilder
+tarot_bot.build_application = build_bench_application
+
+
+def make_update(user_id: int, seq: int, update_id: int) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": f"msg {seq}",
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+    }}
+
+
+async def run(workers: int, users: int, per_user: int) -> float:
+    import httpx
+    from tornado.httpserver import HTTPServer
+
+    with tarot_bot.get_db_transaction() as conn:
+        conn.execute("DELETE FROM bench_updates")
+    router = tarot_bot.ShardRouter(workers)
+    router.start()
+    server = HTTPServer(tarot_bot.build_web_app(None, router))
+    server.listen(FRONT_PORT, "127.0.0.1")
+    await asyncio.sleep(3)  # воркеры поднимают Application
+
+    total = users * per_user
+    url = f"http://127.0.0.1:{FRONT_PORT}/{tarot_bot.TOKEN}"
+    started = time.perf_counter()
+    async with httpx.AsyncClient() as client:
+        update_id = 0
+        for seq in range(per_user):
+            batch = []
+            for user_id in range(1, users + 1):
+                update_id += 1
+                batch.append(client.post(url, json=make_update(user_id, seq, update_id)))
+            responses = await asyncio.gather(*batch)
+            assert {r.status_code for r in responses} == {200}
+    while True:
+        with tarot_bot.get_db_connection() as conn:
+            done = conn.execute("SELECT COUNT(*) FROM bench_updates").fetchone()[0]
+        if done >= total:
+            break
+        await asyncio.sleep(0.02)
+    elapsed = time.perf_counter() - started
+
+    with tarot_bot.get_db_connection() as conn:
+        rows = conn.execute("SELECT user_id, seq, pid FROM bench_updates ORDER BY id").fetchall()
+    server.stop()
+    await asyncio.get_running_loop().run_in_executor(None, router.stop)
+
+    ordered = all(
+        [r["seq"] for r in rows if r["user_id"] == uid] == list(range(per_user)) for uid in range(1, users + 1)
+    )
+    processes_per_user = max(len({r["pid"] for r in rows if r["user_id"] == uid}) for uid in range(1, users + 1))
+    print(f"workers={workers}: {total} апдейтов за {elapsed:.2f} с -> {total / elapsed:.0f} upd/s; "
+          f"порядок по пользователю соблюдён: {ordered}; процессов на пользователя: {processes_per_user}")
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность WEBHOOK_WORKERS")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--per-user", type=int, default=10)
+    parser.add_argument("--work", type=int, default=BENCH_WORK, help="итераций CPU-работы на апдейт")
+    parser.add_argument("--io-ms", type=float, default=BENCH_IO * 1000, help="мс ожидания на апдейт")
+    args = parser.parse_args()
+    # воркеры читают параметры нагрузки из окружения при импорте
+    os.environ["BENCH_SHARDING_WORK"] = str(args.work)
+    os.environ["BENCH_SHARDING_IO_MS"] = str(args.io_ms)
+
+    tarot_bot.init_db()
+    with tarot_bot.get_db_transaction() as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bench_updates("
+            "id INTEGER PRIMARY KEY, pid INTEGER, user_id INTEGER, seq INTEGER)"
+        )
+    print(f"ядер: {os.cpu_count()}, CPU-работа: {args.work} итераций, ожидание: {args.io_ms} мс на апдейт")
+    for workers in args.workers:
+        if workers > 1 and workers + 1 > (os.cpu_count() or 1):
+            print(f"  внимание: workers={workers} + фронт больше числа ядер — ускорения не ждите")
+        asyncio.run(run(workers, args.users, args.per_user))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,25 @@ import traceback
 import random
 import time
 import sys
+import threading
+import functools
+import heapq
+import ipaddress
+import signal
+import zlib
+import multiprocessing
+import queue
+from collections import Counter, OrderedDict, deque
+from contextlib import ExitStack, aclosing, asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
-from openai import OpenAI
-from yookassa import Configuration, Payment
+from telegram import Bot, Update, KeyboardButton, ReplyKeyboardMarkup, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import ApplicationBuilder, BasePersistence, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, PersistenceInput, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+from openai import AsyncOpenAI
+from tornado.httpserver import HTTPServer
+import tornado.web
+from yookassa import Configuration
 import uuid
 import httpx
 import asyncio
@@ -46,31 +60,293 @@ except ImportError:
     TAROT_DAY_INTERPRETATIONS = {}
     CONSULTATION_BLOCK = "💫 Для получения более детальной консультации обращайтесь: @nik_Anna_Er"
 
+# Офлайн-корпус значений карт по позициям (быстрые толкования без API)
+try:
+    from tarot_positions import CARD_MEANINGS, POSITION_KINDS, build_position_corpus
+except ImportError:
+    CARD_MEANINGS = {}
+    POSITION_KINDS = {}
+
+    def build_position_corpus(positions):
+        return {}
+
+# ====== РАСПОЗНАВАНИЕ НАЗВАНИЙ КАРТ ======
+# Все варианты написания (рус./англ., падежи, синонимы, цифры) заранее сводятся в один
+# словарь «нормализованная строка → ключ карты как в index.html». Горячий путь — один
+# поиск по словарю; редкие опечатки ловит ограниченное расстояние Левенштейна, а его
+# результат запоминается.
+
+# ключ: (русское название, синонимы; англ. варианты собираются из ключа)
+MAJOR_CARD_NAMES = {
+    "the_fool": ("Шут", ("дурак", "безумец", "fool")),
+    "the_magician": ("Маг", ("фокусник", "волшебник", "magus")),
+    "the_high_priestess": ("Верховная Жрица", ("жрица", "папесса", "high priestess", "priestess")),
+    "the_empress": ("Императрица", ("empress",)),
+    "the_emperor": ("Император", ("emperor",)),
+    "the_hierophant": ("Иерофант", ("верховный жрец", "жрец", "папа", "hierophant", "pope")),
+    "the_lovers": ("Влюбленные", ("влюблённые", "любовники", "lovers")),
+    "the_chariot": ("Колесница", ("chariot",)),
+    "strength": ("Сила", ("strength",)),
+    "the_hermit": ("Отшельник", ("hermit",)),
+    "wheel_of_fortune": ("Колесо Фортуны", ("колесо судьбы", "колесо", "фортуна", "wheel", "fortune")),
+    "justice": ("Справедливость", ("правосудие",)),
+    "the_hanged_man": ("Повешенный", ("hanged man",)),
+    "death": ("Смерть", ()),
+    "temperance": ("Умеренность", ()),
+    "the_devil": ("Дьявол", ("devil",)),
+    "the_tower": ("Башня", ("tower",)),
+    "the_star": ("Звезда", ("star",)),
+    "the_moon": ("Луна", ("moon",)),
+    "the_sun": ("Солнце", ("sun",)),
+    "judgement": ("Суд", ("страшный суд", "воскрешение", "judgment")),
+    "the_world": ("Мир", ("world",)),
+}
+
+# достоинство: (русское название, другие формы; первая англ. форма — как в ключе)
+MINOR_RANK_NAMES = {
+    "ace": ("Туз", ("туза", "1", "один", "единица"), ("ace", "one")),
+    "two": ("Двойка", ("двойку", "2", "два", "двойки"), ("two", "2")),
+    "three": ("Тройка", ("тройку", "3", "три", "тройки"), ("three", "3")),
+    "four": ("Четверка", ("четверку", "4", "четыре", "четверки"), ("four", "4")),
+    "five": ("Пятерка", ("пятерку", "5", "пять", "пятерки"), ("five", "5")),
+    "six": ("Шестерка", ("шестерку", "6", "шесть", "шестерки"), ("six", "6")),
+    "seven": ("Семерка", ("семерку", "7", "семь", "семерки"), ("seven", "7")),
+    "eight": ("Восьмерка", ("восьмерку", "8", "восемь", "восьмерки"), ("eight", "8")),
+    "nine": ("Девятка", ("девятку", "9", "девять", "девятки"), ("nine", "9")),
+    "ten": ("Десятка", ("десятку", "10", "десять", "десятки"), ("ten", "10")),
+    "page": ("Паж", ("пажа", "валет", "валета", "принцесса", "принцессу"), ("page", "knave", "princess")),
+    "knight": ("Рыцарь", ("рыцаря", "конь", "коня", "принц", "принца"), ("knight", "prince")),
+    "queen": ("Королева", ("королеву", "дама", "даму"), ("queen",)),
+    "king": ("Король", ("короля",), ("king",)),
+}
+
+# масть: (родительный падеж для названия, другие формы; англ. формы)
+MINOR_SUIT_NAMES = {
+    "wands": ("жезлов", ("жезлы", "жезл", "посохов", "посохи", "посох", "скипетров", "палок"), ("wands", "rods", "staves")),
+    "cups": ("кубков", ("кубки", "кубок", "чаш", "чаши", "чаша", "чашей"), ("cups", "chalices")),
+    "swords": ("мечей", ("мечи", "меч", "шпаг", "шпаги"), ("swords",)),
+    "pentacles": ("пентаклей", ("пентакли", "пентакль", "денариев", "денарии", "монет", "монеты", "дисков", "диски"),
+                  ("pentacles", "coins", "disks")),
+}
+
+CARD_NAME_PREFIXES = ("старший аркан ", "младший аркан ", "аркан ", "карта ", "the ")
+CARD_FUZZY_MEMO_SIZE = int(os.getenv("CARD_FUZZY_MEMO_SIZE", "4096"))
+
+# ё → е, разделители → пробел; буквы и цифры остаются, прочая пунктуация выбрасывается
+_CARD_NAME_TRANS = {ord("ё"): "е", ord("_"): " ", ord("-"): " ", ord("."): " ", ord(","): " "}
+_CARD_NAME_TRANS.update({ord(ch): None for ch in "«»\"'`()[]!?:;*"})
+
+
+def _fold_card_name(name: str) -> str:
+    return " ".join(name.casefold().translate(_CARD_NAME_TRANS).split())
+
+
+# Косвенные падежи русских названий старших арканов («Повешенного», «Башню», «Колеса Фортуны»):
+# окончание слова → окончания родительного, дательного, винительного, творительного и
+# предложного падежей. Винительный одушевлённых («шута») совпадает с родительным,
+# неодушевлённых («суд») — с именительным. Слова в род. падеже или мн. числе на -ы/-и
+# («Фортуны») не склоняются — так «Колесо Фортуны» даёт «Колеса Фортуны».
+_RU_CASE_ENDINGS = (
+    ("ый", ("ого", "ому", "ого", "ым", "ом")),
+    ("ой", ("ого", "ому", "ого", "ым", "ом")),
+    ("ая", ("ой", "ой", "ую", "ой", "ой")),
+    ("ые", ("ых", "ым", "ых", "ыми", "ых")),
+    ("ца", ("цы", "це", "цу", "цей", "це")),
+    ("це", ("ца", "цу", "це", "цем", "це")),
+    ("га", ("ги", "ге", "гу", "гой", "ге")),
+    ("ка", ("ки", "ке", "ку", "кой", "ке")),
+    ("а", ("ы", "е", "у", "ой", "е")),
+    ("я", ("и", "е", "ю", "ей", "е")),
+    ("ь", ("и", "и", "ь", "ью", "и")),
+    ("о", ("а", "у", "о", "ом", "е")),
+    ("ц", ("ца", "цу", "ца", "цом", "це")),
+)
+_RU_CONSONANT_CASE_ENDINGS = ("а", "у", "а", "ом", "е")
+_RU_CONSONANTS = frozenset("бвгджзклмнпрстфхчшщ")
+_RU_VOWELS = frozenset("аеиоуыэюя")
+
+
+def _ru_case_forms(phrase: str) -> list[str]:
+    """Формы названия в пяти косвенных падежах (слова склоняются согласованно)."""
+    words = _fold_card_name(phrase).split()
+    if not words or not all("а" <= ch <= "я" for w in words for ch in w):
+        return []  # только русские названия
+    declined = []
+    for word in words:
+        forms = None
+        if len(word) > 2 and word.endswith("ец") and any(ch in _RU_VOWELS for ch in word[:-2]):
+            forms = [word[:-2] + e for e in ("ца", "цу", "ца", "цем", "це")]  # беглая «е»: безумец → безумца
+        elif len(word) > 2:
+            for ending, endings in _RU_CASE_ENDINGS:
+                if word.endswith(ending):
+                    stem = word[:-len(ending)]
+                    forms = [stem + e for e in endings]
+                    break
+            else:
+                if word[-1] in _RU_CONSONANTS:
+                    forms = [word + e for e in _RU_CONSONANT_CASE_ENDINGS]
+        declined.append(forms or [word] * 5)
+    return sorted({" ".join(case) for case in zip(*declined)} - {" ".join(words)})
+
+
+def _bounded_levenshtein(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна, но не больше limit + 1 (дальше считать незачем)."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        best = i
+        for j, cb in enumerate(b, 1):
+            v = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            cur.append(v)
+            if v < best:
+                best = v
+        if best > limit:
+            return limit + 1
+        prev = cur
+    return min(prev[-1], limit + 1)
+
+
+class CardResolver:
+    """Название карты в любом виде → ключ как в index.html (или None)."""
+
+    def __init__(self):
+        self.names: dict[str, str] = {}        # ключ → русское название для промпта
+        self.aliases: dict[str, str] = {}      # нормализованный вариант → ключ
+        self._memo: dict[str, str | None] = {}  # сырая строка → ключ (горячий путь)
+        # словари для нечёткого поиска: старшие арканы целиком, младшие — по словам
+        self._major_words: dict[int, list[tuple[str, str]]] = {}
+        self._rank_words: dict[int, list[tuple[str, str]]] = {}
+        self._suit_words: dict[int, list[tuple[str, str]]] = {}
+        self.stats = {"exact": 0, "fuzzy": 0, "unknown": 0}
+        self._build()
+
+    def _add(self, alias: str, key: str):
+        folded = _fold_card_name(alias)
+        if folded:
+            self.aliases.setdefault(folded, key)
+
+    @staticmethod
+    def _index(words: dict, word: str, value: str):
+        word = _fold_card_name(word)
+        words.setdefault(len(word), []).append((word, value))
+
+    def _build(self):
+        for key, (ru, synonyms) in MAJOR_CARD_NAMES.items():
+            self.names[key] = ru
+            for alias in (key, key.removeprefix("the_"), ru, *synonyms):
+                for form in (alias, *_ru_case_forms(alias)):
+                    self._add(form, key)
+                    self._index(self._major_words, form, key)
+        for rank, (rank_ru, rank_forms, rank_en) in MINOR_RANK_NAMES.items():
+            for word in (rank_ru, *rank_forms, *rank_en):
+                self._index(self._rank_words, word, rank)
+        for suit, (suit_ru, suit_forms, suit_en) in MINOR_SUIT_NAMES.items():
+            for word in (suit_ru, *suit_forms, *suit_en):
+                self._index(self._suit_words, word, suit)
+        for rank, (rank_ru, rank_forms, rank_en) in MINOR_RANK_NAMES.items():
+            for suit, (suit_ru, suit_forms, suit_en) in MINOR_SUIT_NAMES.items():
+                key = f"{rank}_of_{suit}"
+                self.names[key] = f"{rank_ru} {suit_ru}"
+                self._add(key, key)
+                for r in (rank_ru, *rank_forms):
+                    for s in (suit_ru, *suit_forms):
+                        self._add(f"{r} {s}", key)
+                        self._add(f"{s} {r}", key)
+                for r in rank_en:
+                    for s in suit_en:
+                        self._add(f"{r} of {s}", key)
+                        self._add(f"{r} {s}", key)
+        # канонические ключи (так шлёт WebApp) отвечают без нормализации
+        self._memo.update({key: key for key in self.names})
+
+    def _strip_prefixes(self, folded: str) -> str:
+        for prefix in CARD_NAME_PREFIXES:
+            if folded.startswith(prefix):
+                folded = folded[len(prefix):]
+        return folded
+
+    @staticmethod
+    def _closest(word: str, words: dict) -> str | None:
+        # до 3 букв — только точно, 1 опечатка на короткие слова, 2 — на длинные;
+        # ничья между разными значениями — не угадываем
+        limit = 0 if len(word) < 4 else 1 if len(word) < 8 else 2
+        best, best_value, tie = limit + 1, None, False
+        for length in range(len(word) - limit, len(word) + limit + 1):
+            for candidate, value in words.get(length, ()):
+                d = _bounded_levenshtein(word, candidate, min(limit, best))
+                if d < best:
+                    best, best_value, tie = d, value, False
+                elif d == best and value != best_value:
+                    tie = True
+        return best_value if best <= limit and not tie else None
+
+    def _fuzzy(self, folded: str) -> str | None:
+        key = self._closest(folded, self._major_words)
+        if key:
+            return key
+        words = [w for w in folded.split() if w != "of"]
+        if len(words) != 2:
+            return None
+        for rank_word, suit_word in (words, words[::-1]):
+            rank = self._closest(rank_word, self._rank_words)
+            suit = rank and self._closest(suit_word, self._suit_words)
+            if suit:
+                return f"{rank}_of_{suit}"
+        return None
+
+    def resolve(self, name) -> str | None:
+        if not isinstance(name, str):
+            return None
+        try:
+            key = self._memo[name]
+        except KeyError:
+            pass
+        else:
+            if key:
+                self.stats["exact"] += 1
+            return key
+
+        folded = self._strip_prefixes(_fold_card_name(name))
+        key = self.aliases.get(folded)
+        if key:
+            self.stats["exact"] += 1
+        elif len(folded) >= 3:
+            key = self._fuzzy(folded)
+            if key:
+                self.stats["fuzzy"] += 1
+                logger.info(f"Карта «{name}» распознана как {key} по сходству")
+        if not key:
+            self.stats["unknown"] += 1
+        if len(self._memo) >= CARD_FUZZY_MEMO_SIZE + len(self.names):
+            self._memo = {k: k for k in self.names}
+        self._memo[name] = key
+        return key
+
+    def display_name(self, card: str) -> str:
+        """Русское название для промпта и ответа; нераспознанное — как ввели."""
+        key = self.resolve(card)
+        return self.names[key] if key else str(card).strip()
+
+    def stats_text(self) -> str:
+        st = self.stats
+        return (
+            "🃏 Названия карт\n"
+            f"вариантов в словаре: {len(self.aliases)}, запомнено вводов: {len(self._memo) - len(self.names)}\n"
+            f"точно: {st['exact']}, по сходству: {st['fuzzy']}, не распознано: {st['unknown']}"
+        )
+
+
+card_resolver = CardResolver()
+
+
 def normalize_card_key(name: str) -> str:
-    """Приводим название карты к ключам словаря (нижний регистр и типовые формы)."""
+    """Приводим название карты к ключу словарей; нераспознанное — к нормализованной строке."""
     if not name:
         return ""
-    s = name.strip().casefold()
-    while "  " in s:
-        s = s.replace("  ", " ")
-    # унификация падежей мастей
-    s = (s
-         .replace("жезлы", "жезлов")
-         .replace("кубки", "кубков")
-         .replace("пентакли", "пентаклей")
-         .replace("мечи", "мечей"))
-    # популярные синонимы/варианты
-    s = (s
-         .replace("дурак", "шут")
-         .replace("влюбленные", "влюблённые"))
-    # убираем служебные префиксы, если вдруг приходят
-    for prefix in ("старший аркан ", "аркан ", "карта "):
-        if s.startswith(prefix):
-            s = s[len(prefix):]
-    return s
-
-
-client = OpenAI()
+    return card_resolver.resolve(name) or card_resolver._strip_prefixes(_fold_card_name(name))
+
 
 # Константы
 MAX_FREE_REQUESTS = 10
@@ -92,6 +368,13 @@ SUB_CHANNEL_LINK = os.getenv("SUB_CHANNEL_LINK") or f"https://t.me/{SUB_CHANNEL_
 SUB_BONUS_AMOUNT = int(os.getenv("SUB_BONUS_AMOUNT", "5"))
 
 PUBLIC_URL = os.getenv("PUBLIC_URL")  # например: https://<имя-сервиса>.onrender.com
+# Адреса/подсети нашего обратного прокси через запятую (на Render — например 10.0.0.0/8).
+# X-Forwarded-For читаем только у запросов от них; пусто — заголовок игнорируем и берём
+# адрес соединения, иначе любой клиент подставил бы в заголовок IP ЮKassa.
+TRUSTED_PROXY_IPS = [
+    ipaddress.ip_network(net.strip(), strict=False)
+    for net in os.getenv("TRUSTED_PROXY_IPS", "").split(",") if net.strip()
+]
 
 
 # OpenAI настройки
@@ -99,6 +382,42 @@ PUBLIC_URL = os.getenv("PUBLIC_URL")  # например: https://<имя-сер
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 OPENAI_TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
 OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30.0"))  # сек
+# Общий пул соединений и ограничение параллельных запросов к OpenAI
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "75.0"))  # сек, на все попытки одного гадания
+# Предохранитель OpenAI: размыкается, когда среди последних OPENAI_BREAKER_WINDOW запросов
+# доля сбоев не ниже OPENAI_BREAKER_FAILURE_RATE; пока разомкнут — сразу локальное толкование
+OPENAI_BREAKER_WINDOW = int(os.getenv("OPENAI_BREAKER_WINDOW", "20"))
+OPENAI_BREAKER_FAILURE_RATE = float(os.getenv("OPENAI_BREAKER_FAILURE_RATE", "0.5"))
+OPENAI_BREAKER_MIN_CALLS = int(os.getenv("OPENAI_BREAKER_MIN_CALLS", "5"))
+OPENAI_BREAKER_RESET = float(os.getenv("OPENAI_BREAKER_RESET", "30"))       # сек до пробного запроса
+OPENAI_RETRY_AFTER_MAX = float(os.getenv("OPENAI_RETRY_AFTER_MAX", "10"))   # дольше — не ждём, размыкаем
+# Потоковая выдача ответа: правим сообщение «Расшифровываю карты...» по мере генерации
+OPENAI_STREAMING = os.getenv("OPENAI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))  # сек между правками одного сообщения
+STREAM_MESSAGE_LIMIT = 3800  # запас до лимита Telegram в 4096 единиц UTF-16
+# Кэш интерпретаций готовых раскладов (ключ: расклад + карты по порядку позиций)
+READING_CACHE_ENABLED = os.getenv("READING_CACHE_ENABLED", "1") == "1"
+READING_CACHE_VARIANTS = int(os.getenv("READING_CACHE_VARIANTS", "3"))      # вариантов текста на ключ
+READING_CACHE_MAX_KEYS = int(os.getenv("READING_CACHE_MAX_KEYS", "50000"))  # LRU-лимит ключей
+READING_CACHE_TTL = int(os.getenv("READING_CACHE_TTL", str(30 * 24 * 3600)))  # сек
+# Локальные (офлайн) толкования: для бесплатных попыток и при сбоях OpenAI
+LOCAL_READINGS_FOR_FREE = os.getenv("LOCAL_READINGS_FOR_FREE", "0") == "1"
+LOCAL_READING_FALLBACK = os.getenv("LOCAL_READING_FALLBACK", "1") == "1"
+# Сколько апдейтов PTB обрабатывает параллельно (иначе одно гадание блокирует всех);
+# апдейты одного пользователя при этом идут по очереди (UserOrderedUpdateProcessor)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+# Многопроцессный режим вебхуков: фронт раздаёт апдейты WEBHOOK_WORKERS воркерам по user_id
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "0"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))  # номер воркера (выставляет фронт); -1 — обычный процесс
+
+
+def worker_share(value: float) -> float:
+    """Общий на бота лимит делится поровну между воркерами; в обычном процессе — целиком."""
+    if SHARD_INDEX < 0 or WEBHOOK_WORKERS <= 1:
+        return value
+    return value / WEBHOOK_WORKERS
 # OPENAI_MAX_TOKENS у тебя уже есть — оставь его как есть (700 или 600)
 
 
@@ -154,6 +473,7 @@ WELCOME_TEXT = """🔮 Добро пожаловать в мир Таро! 🔮
 # YooKassa настройки
 Configuration.account_id = os.getenv('YOOKASSA_ACCOUNT_ID')
 Configuration.secret_key = os.getenv('YOOKASSA_SECRET_KEY')
+Configuration.api_url = os.getenv('YOOKASSA_API_URL', Configuration.api_url)
 
 def check_openai_setup():
     """Проверка настройки OpenAI API"""
@@ -167,77 +487,657 @@ def check_openai_setup():
     logger.info("OpenAI API настроен правильно")
     return True
 
+# ====== МИГРАЦИИ СХЕМЫ ======
+# Каждый шаг выполняется ровно один раз (в своей транзакции) и записывается в schema_migrations;
+# при обычном старте это один SELECT. Изменения схемы добавляются новым шагом в конец MIGRATIONS.
+# Шаги 1–9 повторяют прежний init_db и безопасны для баз, созданных до ведения версий.
+
+def _add_column(conn, table: str, column_def: str):
+    """ADD COLUMN, если колонки ещё нет (старые базы могли получить её до ведения версий)."""
+    name = column_def.split()[0]
+    if name not in {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
+
+
+def _m001_users(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            request_count INTEGER DEFAULT 0,
+            is_subscribed BOOLEAN DEFAULT FALSE,
+            is_banned BOOLEAN DEFAULT FALSE,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            paid_requests INTEGER DEFAULT 0,
+            last_payment_id TEXT,
+            subscription_end TEXT,
+            referrer_id INTEGER,
+            bonus_requests INTEGER DEFAULT 0
+        )
+    ''')
+    # флажок "бонус за канал уже выдан"
+    _add_column(conn, "users", "got_secretlovemagic INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users(subscription_end)")
+
+
+def _m002_fast_reading(conn):
+    # режим быстрых (офлайн) толкований
+    _add_column(conn, "users", "fast_reading INTEGER DEFAULT 0")
+
+
+def _m003_reading_cache(conn):
+    # кэш интерпретаций готовых раскладов
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reading_cache (
+            spread_key TEXT NOT NULL,
+            cards      TEXT NOT NULL,
+            variant    INTEGER NOT NULL,
+            text       TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used  REAL NOT NULL,
+            PRIMARY KEY (spread_key, cards, variant)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reading_cache_last_used ON reading_cache(last_used)")
+
+
+def _m004_request_log(conn):
+    # журнал гаданий (раньше — user_requests.csv)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS request_log (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            user_id   INTEGER,
+            username  TEXT,
+            question  TEXT,
+            cards     TEXT
+        )
+    ''')
+    _add_column(conn, "request_log", "spread_key TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_request_log_timestamp ON request_log(timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_request_log_user_id ON request_log(user_id)")
+
+
+def _m005_broadcasts(conn):
+    # рассылки: задание + курсор доставки по каждому получателю
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            text          TEXT NOT NULL,
+            segment       TEXT NOT NULL DEFAULT 'all',
+            status        TEXT NOT NULL DEFAULT 'running',
+            admin_chat_id INTEGER,
+            progress_message_id INTEGER,
+            total         INTEGER NOT NULL DEFAULT 0,
+            sent          INTEGER NOT NULL DEFAULT 0,
+            failed        INTEGER NOT NULL DEFAULT 0,
+            created_at    TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at   TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id  INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status  TEXT NOT NULL DEFAULT 'pending',
+            error   TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status ON broadcast_deliveries(job_id, status)")
+
+
+def _m006_payments(conn):
+    # платежи (раньше таблицы создавались при каждой оплате в save_created_payment)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_links (
+            order_id   TEXT PRIMARY KEY,
+            payment_id TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id    INTEGER,
+            tariff     TEXT,
+            amount     REAL,
+            status     TEXT DEFAULT 'pending',
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # обработанные уведомления ЮKassa (защита от повторной доставки)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_events (
+            event_key   TEXT PRIMARY KEY,
+            payment_id  TEXT NOT NULL,
+            event       TEXT NOT NULL,
+            received_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _m007_payment_reconcile(conn):
+    # сверка зависших платежей: счётчик попыток и время следующей проверки (UTC, как created_at)
+    _add_column(conn, "payments", "attempts INTEGER DEFAULT 0")
+    _add_column(conn, "payments", "next_check_at TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments(status, created_at)")
+
+
+def _m008_stats(conn):
+    # аналитика: агрегаты, которые обновляются при каждой записи журнала/оплате
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day      TEXT PRIMARY KEY,
+            readings INTEGER NOT NULL DEFAULT 0,
+            users    INTEGER NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0,
+            revenue  REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily_users (
+            day     TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_cards (card TEXT PRIMARY KEY, draws INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_spreads (spread_key TEXT PRIMARY KEY, readings INTEGER NOT NULL DEFAULT 0)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_payers (user_id INTEGER PRIMARY KEY, first_paid_at TEXT, tariff TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stats_totals (name TEXT PRIMARY KEY, value REAL NOT NULL DEFAULT 0)")
+
+
+def _m009_app_meta(conn):
+    # служебные отметки (разовые импорты и т.п.)
+    conn.execute("CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT)")
+
+
+def _m010_hot_path_indexes(conn):
+    # user_id — INTEGER PRIMARY KEY (rowid), отдельный индекс по нему лишь замедлял запись
+    conn.execute("DROP INDEX IF EXISTS idx_users_user_id")
+    # платежи пользователя, поиск по статусу — ведущая колонка idx_payments_status_created
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_payment_id ON users(last_payment_id)")
+
+
+def _m011_rate_limits(conn):
+    # состояние token bucket лимитов (если включено сохранение между перезапусками)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key        TEXT PRIMARY KEY,
+            tokens     REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def _m012_user_sessions(conn):
+    # context.user_data между перезапусками (см. SQLiteSessionPersistence)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id    INTEGER PRIMARY KEY,
+            data       TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_updated ON user_sessions(updated_at)")
+
+
+def _m013_broadcast_cancel(conn):
+    # запрос остановки рассылки виден любому процессу, а не только тому, что её ведёт
+    _add_column(conn, "broadcast_jobs", "cancel_requested INTEGER NOT NULL DEFAULT 0")
+
+
+MIGRATIONS = [
+    (1, "users", _m001_users),
+    (2, "users.fast_reading", _m002_fast_reading),
+    (3, "reading_cache", _m003_reading_cache),
+    (4, "request_log", _m004_request_log),
+    (5, "broadcasts", _m005_broadcasts),
+    (6, "payments", _m006_payments),
+    (7, "payments reconcile columns", _m007_payment_reconcile),
+    (8, "stats aggregates", _m008_stats),
+    (9, "app_meta", _m009_app_meta),
+    (10, "hot path indexes", _m010_hot_path_indexes),
+    (11, "rate_limits", _m011_rate_limits),
+    (12, "user_sessions", _m012_user_sessions),
+    (13, "broadcast_jobs.cancel_requested", _m013_broadcast_cancel),
+]
+
+
+def apply_migrations() -> list[int]:
+    """Применяет недостающие шаги по порядку. Возвращает номера применённых сейчас."""
+    with get_db_connection() as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TEXT DEFAULT CURRENT_TIMESTAMP)"
+        )
+        done = {r["version"] for r in conn.execute("SELECT version FROM schema_migrations")}
+
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version in done:
+            continue
+        with get_db_transaction() as conn:
+            # другой процесс мог успеть раньше — проверяем уже под блокировкой записи
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)).fetchone():
+                continue
+            step(conn)
+            conn.execute("INSERT INTO schema_migrations(version, name) VALUES (?, ?)", (version, name))
+        applied.append(version)
+        logger.info(f"Миграция {version} ({name}) применена")
+    return applied
+
+
 def init_db():
     """Инициализация базы данных"""
     try:
-        with get_db_connection() as conn:
-            # Создаем таблицу пользователей (если нет)
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    request_count INTEGER DEFAULT 0,
-                    is_subscribed BOOLEAN DEFAULT FALSE,
-                    is_banned BOOLEAN DEFAULT FALSE,
-                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    paid_requests INTEGER DEFAULT 0,
-                    last_payment_id TEXT,
-                    subscription_end TEXT,
-                    referrer_id INTEGER,
-                    bonus_requests INTEGER DEFAULT 0
-                )
-            ''')
-    
-            # 🔹 Миграция: флажок "бонус за канал уже выдан" (выполняется один раз)
-            try:
-                conn.execute("ALTER TABLE users ADD COLUMN got_secretlovemagic INTEGER DEFAULT 0")
-            except sqlite3.OperationalError:
-                # колонка уже существует — ничего страшного
-                pass
-    
-            # Индексы
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users(subscription_end)")
-            
+        apply_migrations()
         logger.info("База данных инициализирована")
     except Exception as e:
         logger.error(f"Ошибка инициализации БД: {e}")
 
+    # Разовый перенос старых реестров (user_ids.txt, users.db) в таблицу users
+    try:
+        import_legacy_users()
+    except Exception as e:
+        logger.error(f"Ошибка импорта старых пользователей: {e}")
+
+    # Разовое заполнение аналитики из накопленной истории
+    try:
+        with get_db_connection() as conn:
+            built = conn.execute("SELECT 1 FROM stats_totals WHERE name = 'stats_version'").fetchone()
+        if not built:
+            rebuild_stats()
+    except Exception as e:
+        logger.error(f"Ошибка заполнения аналитики: {e}")
+
 
 def maintenance_block(user_id: int) -> bool:
     return MAINTENANCE and user_id != ADMIN_ID
 
 
+# ====== ПУЛ СОЕДИНЕНИЙ SQLITE ======
+# Долгоживущие соединения: PRAGMA выполняются один раз при создании,
+# а встроенный кэш подготовленных выражений sqlite3 (cached_statements)
+# переживает отдельные вызовы get_user/update_user и т.п.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_WAIT = float(os.getenv("DB_POOL_WAIT", "2.0"))  # сек ожидания свободного соединения
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+
+class SQLitePool:
+    """Потокобезопасный пул соединений к одному файлу БД."""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle: list[sqlite3.Connection] = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            "acquired": 0, "created": 0, "reused": 0, "overflow": 0,
+            "waits": 0, "wait_time": 0.0, "max_wait": 0.0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=15,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        # Включаем WAL и таймаут на уровне SQLite — один раз на соединение
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA busy_timeout=15000;")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        started = time.perf_counter()
+        waited = False
+        conn = None
+        with self._cond:
+            deadline = started + DB_POOL_WAIT
+            while not self._idle and self._open >= self.size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                waited = True
+                self._cond.wait(remaining)
+            if self._idle:
+                conn = self._idle.pop()
+                self.stats["reused"] += 1
+            elif self._open >= self.size:
+                # пул исчерпан дольше DB_POOL_WAIT — временное соединение вместо взаимной блокировки
+                self.stats["overflow"] += 1
+            self._open += 1
+            self.stats["acquired"] += 1
+            if waited:
+                wait = time.perf_counter() - started
+                self.stats["waits"] += 1
+                self.stats["wait_time"] += wait
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self.stats["created"] += 1
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            self._open -= 1
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE … COMMIT на одном соединении (ROLLBACK при исключении)."""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.execute("COMMIT")
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats_text(self) -> str:
+        st = self.stats
+        avg_wait = (st["wait_time"] / st["waits"] * 1000) if st["waits"] else 0.0
+        reuse = (100.0 * st["reused"] / st["acquired"]) if st["acquired"] else 0.0
+        return (
+            f"🗄 Пул БД: выдано {st['acquired']}, повторно {st['reused']} ({reuse:.1f}%), "
+            f"создано {st['created']}, сверх лимита {st['overflow']}, "
+            f"ожиданий {st['waits']} (ср. {avg_wait:.1f} мс, макс. {st['max_wait'] * 1000:.1f} мс)"
+        )
+
+
+_db_pool = SQLitePool(DB_PATH, DB_POOL_SIZE)
+
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH, timeout=15, isolation_level=None)
-    # Включаем WAL и таймаут на уровне SQLite
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout=15000;")
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Соединение из пула: with get_db_connection() as conn: ..."""
+    return _db_pool.connection()
+
+
+def get_db_transaction():
+    """Транзакция на соединении из пула: with get_db_transaction() as conn: ..."""
+    return _db_pool.transaction()
+
+
+# ====== АСИНХРОННЫЙ СЛОЙ ДОСТУПА К БД ======
+# Синхронные запросы выполняются в ограниченном пуле потоков, чтобы блокировка
+# записи (busy_timeout до 15 с) не замораживала event loop и остальные чаты.
+# Пул соединений должен быть больше пула потоков: запросы иногда вложены.
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    """Выполнить синхронную функцию работы с БД в пуле потоков БД."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
+
+
+class UserRepository:
+    """Awaitable-методы над таблицами users/payments для async-обработчиков."""
+
+    async def get_user(self, user_id: int):
+        return await run_db(get_user, user_id)
+
+    async def get_user_data(self, user_id: int):
+        return await run_db(get_user_data, user_id)
+
+    async def register(self, user_id: int, username=None, first_name=None, last_name=None, referrer_id=None):
+        return await run_db(register_user, user_id, username, first_name, last_name, referrer_id)
+
+    async def apply_referral(self, user_id: int, referrer_id: int) -> bool:
+        return await run_db(apply_referral, user_id, referrer_id)
+
+    async def deduct(self, user_id: int) -> str | None:
+        return await run_db(deduct_user_request_sync, user_id)
+
+    async def refund(self, user_id: int, bucket: str | None):
+        return await run_db(refund_user_request_sync, user_id, bucket)
+
+    async def all_user_ids(self) -> list[int]:
+        return await run_db(get_all_user_ids)
+
+    async def toggle_fast_reading(self, user_id: int) -> bool:
+        return await run_db(toggle_fast_reading_flag, user_id)
+
+    async def grant_channel_bonus(self, user_id: int):
+        return await run_db(grant_channel_bonus, user_id)
+
+    async def add_paid(self, user_id: int, amount: int):
+        return await run_db(add_paid_requests, user_id, amount)
+
+    async def add_bonus(self, user_id: int, amount: int):
+        return await run_db(add_bonus_requests, user_id, amount)
+
+    async def reset_free(self, user_id: int):
+        return await run_db(reset_free_requests, user_id)
+
+    async def extend_subscription(self, user_id: int, days: int) -> datetime:
+        return await run_db(extend_subscription, user_id, days)
+
+    async def get_last_payment_id(self, user_id: int) -> str | None:
+        return await run_db(get_last_payment_id, user_id)
+
+    async def get_payment(self, payment_id: str):
+        return await run_db(get_payment, payment_id)
+
+    async def find_payment_by_order(self, order_id: str):
+        return await run_db(find_payment_by_order, order_id)
+
+    async def save_created_payment(self, order_id: str, payment_id: str, user_id: int, tariff_key: str, amount: float):
+        return await run_db(save_created_payment, order_id, payment_id, user_id, tariff_key, amount)
+
+    async def activate_subscription(self, user_id: int, tariff_key: str, payment_id: str):
+        return await run_db(activate_subscription, user_id, tariff_key, payment_id)
+
+
+repo = UserRepository()
+
+
+# ====== КЭШ ПОЛЬЗОВАТЕЛЕЙ ======
+# Строки users в памяти (LRU + TTL) с записью-через: каждая мутация читает свежую
+# строку в той же транзакции и кладёт её в кэш после COMMIT.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))  # сек
+
+
+class UserCache:
+    """LRU + TTL кэш строк users (dict) с защитой от записи устаревших данных читателями."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._items: OrderedDict[int, tuple[dict, float]] = OrderedDict()
+        self._gen: dict[int, int] = {}  # счётчик записей по пользователю
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "expired": 0}
+
+    def get(self, user_id: int) -> dict | None:
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            row, expires = item
+            if expires < time.monotonic():
+                del self._items[user_id]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return row
+
+    def generation(self, user_id: int) -> int:
+        with self._lock:
+            return self._gen.get(user_id, 0)
+
+    def _store(self, user_id: int, row: dict):
+        self._items[user_id] = (row, time.monotonic() + self.ttl)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.size:
+            evicted, _ = self._items.popitem(last=False)
+            self._gen.pop(evicted, None)
+            self.stats["evictions"] += 1
+
+    def fill(self, user_id: int, row: dict, generation: int):
+        """Заполнение после промаха: только если с начала чтения не было записи."""
+        with self._lock:
+            if self._gen.get(user_id, 0) == generation:
+                self._store(user_id, row)
+
+    def write(self, user_id: int, row: dict | None):
+        """Запись-через после мутации."""
+        with self._lock:
+            self._gen[user_id] = self._gen.get(user_id, 0) + 1
+            self.stats["writes"] += 1
+            if row is None:
+                self._items.pop(user_id, None)
+            else:
+                self._store(user_id, row)
+
+    def invalidate(self, user_id: int):
+        self.write(user_id, None)
+
+    def clear(self):
+        """Сброс после массовых изменений users (импорт); поколения сдвигаются, чтобы не принять старые fill."""
+        with self._lock:
+            for user_id in list(self._gen) + list(self._items):
+                self._gen[user_id] = self._gen.get(user_id, 0) + 1
+            self._items.clear()
+
+    def stats_text(self) -> str:
+        st = self.stats
+        lookups = st["hits"] + st["misses"]
+        hit_rate = (100.0 * st["hits"] / lookups) if lookups else 0.0
+        return (
+            f"👤 Кэш пользователей: {len(self._items)}/{self.size}, попаданий {st['hits']}, "
+            f"промахов {st['misses']} ({hit_rate:.1f}% hit), записей {st['writes']}, "
+            f"вытеснено {st['evictions']}, истекло {st['expired']}"
+        )
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# Мутации одного пользователя идут по одной (порядок записей его строки в кэш = порядок COMMIT),
+# разных — параллельно: замки разбиты на полосы по user_id, ожидание BEGIN IMMEDIATE
+# у одного пользователя не держит остальных. Полосы берутся по возрастанию номера — без взаимных блокировок.
+USER_WRITE_LOCK_STRIPES = 64
+_user_write_locks = [threading.Lock() for _ in range(USER_WRITE_LOCK_STRIPES)]
+
+
+@contextmanager
+def user_write_locked(user_ids=None):
+    """Замки полос для user_ids; None — все полосы (массовые изменения users)."""
+    if user_ids is None:
+        stripes = range(USER_WRITE_LOCK_STRIPES)
+    else:
+        stripes = sorted({uid % USER_WRITE_LOCK_STRIPES for uid in user_ids if uid})
+    with ExitStack() as stack:
+        for stripe in stripes:
+            stack.enter_context(_user_write_locks[stripe])
+        yield
+
+
+@contextmanager
+def user_mutation(*user_ids):
+    """
+    Транзакция, меняющая строки users, с записью-через в кэш:
+    with user_mutation(uid) as conn: conn.execute("UPDATE users ...")
+    """
+    with user_write_locked(user_ids):
+        with get_db_transaction() as conn:
+            yield conn
+            rows = {
+                uid: conn.execute("SELECT * FROM users WHERE user_id = ?", (uid,)).fetchone()
+                for uid in user_ids if uid
+            }
+        for uid, row in rows.items():
+            user_cache.write(uid, dict(row) if row else None)
+    if _shard_peers and rows:
+        publish_user_invalidation(list(rows))
+
+
+# В многопроцессном режиме у каждого воркера свой кэш: после COMMIT остальным
+# воркерам уходит сообщение, и они забывают свои копии этих строк.
+_shard_peers: list = []  # входящие очереди других воркеров
+
+
+def publish_user_invalidation(user_ids: list[int]):
+    for inbox in _shard_peers:
+        try:
+            inbox.put_nowait(("invalidate", user_ids))
+        except queue.Full:
+            # не страшно: копия всё равно истечёт по USER_CACHE_TTL
+            logger.warning(f"Очередь воркера переполнена, сброс кэша для {user_ids} не доставлен")
 
 
 
 def get_user(user_id):
+    """Строка users (dict) — из кэша или из БД."""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    generation = user_cache.generation(user_id)
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        return cursor.fetchone()
+        row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    user = dict(row)
+    user_cache.fill(user_id, user, generation)
+    return user
 
 def update_user(user_id, username=None, increment_count=False):
-    with get_db_connection() as conn:
+    with user_mutation(user_id) as conn:
         if username:
-            conn.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
+            cur = conn.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
+            if cur.rowcount:
+                _bump_stat_total(conn, "users")
         if increment_count:
             conn.execute("UPDATE users SET request_count = request_count + 1 WHERE user_id = ?", (user_id,))
 
 def register_user(user_id, username=None, first_name=None, last_name=None, referrer_id=None):
     """Регистрация нового пользователя"""
-    with get_db_connection() as conn:
-        conn.execute("""
+    with user_mutation(user_id, referrer_id) as conn:
+        cur = conn.execute("""
             INSERT OR IGNORE INTO users (user_id, username, referrer_id) 
             VALUES (?, ?, ?)
         """, (user_id, username, referrer_id))
+        if cur.rowcount:
+            _bump_stat_total(conn, "users")
         
         # Добавляем бонус рефереру
         if referrer_id and referrer_id != user_id:
@@ -247,6 +1147,28 @@ def register_user(user_id, username=None, first_name=None, last_name=None, refer
             """, (referrer_id,))
             logger.info(f"Добавлено 5 бонусных запросов пользователю {referrer_id}")
 
+def apply_referral(user_id: int, referrer_id: int) -> bool:
+    """Привязывает реферера и начисляет ему бонус, если привязки ещё не было."""
+    with user_mutation(user_id, referrer_id) as conn:
+        row = conn.execute(
+            "SELECT referrer_id FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+
+        if row and not row["referrer_id"]:
+            # привязать реферера к пользователю
+            conn.execute(
+                "UPDATE users SET referrer_id = ? WHERE user_id = ?",
+                (referrer_id, user_id)
+            )
+            # начислить бонус пригласившему (+5 можно изменить)
+            conn.execute(
+                "UPDATE users SET bonus_requests = COALESCE(bonus_requests, 0) + 5 WHERE user_id = ?",
+                (referrer_id,)
+            )
+            return True
+    return False
+
 def get_user_data(user_id):
     """Получение данных пользователя"""
     user = get_user(user_id)
@@ -288,7 +1210,7 @@ def expire_if_needed(user_id: int, subscription_end_str: str | None) -> bool:
     """
     active = is_subscription_active(user_id, subscription_end_str)
     if not active:
-        with get_db_connection() as conn:
+        with user_mutation(user_id) as conn:
             conn.execute(
                 "UPDATE users SET is_subscribed = 0, subscription_end = NULL WHERE user_id = ?",
                 (user_id,)
@@ -296,18 +1218,105 @@ def expire_if_needed(user_id: int, subscription_end_str: str | None) -> bool:
     return active
 
 
+LEGACY_USER_IDS_PATH = 'user_ids.txt'
+LEGACY_USERS_DB_PATH = 'users.db'
+
+
+def _read_legacy_user_ids(path: str) -> list[int]:
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding='utf-8') as file:
+        return [int(line) for line in (l.strip() for l in file) if line.lstrip('-').isdigit()]
+
+
+def _read_legacy_users_db(path: str) -> list[dict]:
+    """Старая база users.db (user_id, username, free_requests, paid_requests, ...), только чтение."""
+    if not os.path.isfile(path) or os.path.abspath(path) == os.path.abspath(DB_PATH):
+        return []
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(r) for r in conn.execute("SELECT * FROM users")]
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+
+
+def import_legacy_users(ids_path: str = LEGACY_USER_IDS_PATH, legacy_db_path: str = LEGACY_USERS_DB_PATH) -> int:
+    """
+    Один раз сливает user_ids.txt и users.db в users одной транзакцией.
+    Существующие строки не перезаписываются (только пустые username/referrer_id),
+    балансы переносятся лишь для пользователей, которых в users ещё не было.
+    Возвращает число добавленных пользователей.
+    """
+    with get_db_connection() as conn:
+        if conn.execute("SELECT 1 FROM app_meta WHERE key = 'legacy_users_imported'").fetchone():
+            return 0
+
+    rows = {uid: {"user_id": uid} for uid in _read_legacy_user_ids(ids_path)}
+    for r in _read_legacy_users_db(legacy_db_path):
+        if r.get("user_id") is None:
+            continue
+        free_left = r.get("free_requests")
+        rows[int(r["user_id"])] = {
+            "user_id": int(r["user_id"]),
+            "username": r.get("username"),
+            "request_count": max(0, MAX_FREE_REQUESTS - free_left) if free_left is not None else 0,
+            "paid_requests": r.get("paid_requests") or 0,
+            "bonus_requests": r.get("bonus_requests") or 0,
+            "subscription_end": r.get("subscription_end"),
+            "is_subscribed": 1 if is_subscription_active(r["user_id"], r.get("subscription_end")) else 0,
+            "is_banned": r.get("is_banned") or 0,
+            "referrer_id": r.get("referrer_id"),
+            "join_date": r.get("registration_date"),
+        }
+    params = [
+        (r["user_id"], r.get("username"), r.get("request_count", 0), r.get("is_subscribed", 0),
+         r.get("is_banned", 0), r.get("join_date"), r.get("paid_requests", 0), r.get("subscription_end"),
+         r.get("referrer_id"), r.get("bonus_requests", 0))
+        for r in rows.values()
+    ]
+
+    with user_write_locked(), get_db_transaction() as conn:
+        before = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        conn.executemany("""
+            INSERT INTO users (user_id, username, request_count, is_subscribed, is_banned, join_date,
+                               paid_requests, subscription_end, referrer_id, bonus_requests)
+            VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username    = COALESCE(users.username, excluded.username),
+                referrer_id = COALESCE(users.referrer_id, excluded.referrer_id)
+        """, params)
+        after = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        if after != before:
+            _bump_stat_total(conn, "users", after - before)
+        conn.execute("INSERT INTO app_meta(key, value) VALUES ('legacy_users_imported', CURRENT_TIMESTAMP)")
+    user_cache.clear()
+
+    if rows:
+        logger.info(f"Импорт старых реестров: {len(rows)} записей, новых пользователей {after - before}")
+    return after - before
+
+
+def user_exists(user_id: int) -> bool:
+    """Проверка по первичному ключу users (раньше — линейный поиск в user_ids.txt)."""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return True
+    with get_db_connection() as conn:
+        return conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+
 def save_user_id(user_id):
     """Сохранение ID пользователя"""
-    if not os.path.exists('user_ids.txt'):
-        open('user_ids.txt', 'w').close()
-    
-    with open('user_ids.txt', 'r') as file:
-        existing_ids = file.read().splitlines()
-    
-    if str(user_id) not in existing_ids:
-        with open('user_ids.txt', 'a') as file:
-            file.write(f"{user_id}\n")
-        logger.info(f"Добавлен новый пользователь: {user_id}")
+    if user_exists(user_id):
+        return
+    with user_mutation(user_id) as conn:
+        cur = conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        if cur.rowcount:
+            _bump_stat_total(conn, "users")
+            logger.info(f"Добавлен новый пользователь: {user_id}")
 
 def can_make_request(user_data, user_id):
     """Проверка возможности сделать запрос"""
@@ -326,30 +1335,314 @@ def get_all_user_ids() -> list[int]:
         return [int(r["user_id"]) for r in rows if r["user_id"] is not None]
 
 
+# ====== РАССЫЛКИ ======
+# Задание и курсор по каждому получателю лежат в БД: после перезапуска рассылка продолжается
+# с неотправленных. Отправка идёт в несколько потоков под общим лимитом Telegram (~30 сообщений/сек),
+# на RetryAfter вся рассылка ставится на паузу на указанное время.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))                  # сообщений/сек на всю рассылку
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3.0"))  # сек
+BROADCAST_FLUSH_SIZE = int(os.getenv("BROADCAST_FLUSH_SIZE", "50"))
+BROADCAST_MAX_RETRIES = 3
+
+# Сегменты: SQL-выборка получателей (параметр — текущее время в формате subscription_end)
+BROADCAST_SEGMENTS = {
+    "all":  ("все", "SELECT user_id FROM users WHERE user_id IS NOT NULL"),
+    "sub":  ("с активной подпиской",
+             "SELECT user_id FROM users WHERE is_subscribed = 1 AND subscription_end > :now"),
+    "paid": ("платившие",
+             "SELECT user_id FROM users WHERE paid_requests > 0 OR user_id IN (SELECT user_id FROM stats_payers)"),
+    "free": ("без подписки и оплат",
+             "SELECT user_id FROM users WHERE user_id IS NOT NULL "
+             "AND NOT (is_subscribed = 1 AND COALESCE(subscription_end, '') > :now) "
+             "AND COALESCE(paid_requests, 0) = 0 AND user_id NOT IN (SELECT user_id FROM stats_payers)"),
+}
+
+
+class AsyncRateLimiter:
+    """Равномерный лимит: не чаще rate вызовов в секунду; pause() сдвигает все слоты (RetryAfter)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+def create_broadcast_job(text: str, segment: str, admin_chat_id: int) -> tuple[int, int]:
+    """Создаёт задание и курсор получателей в одной транзакции. Возвращает (job_id, total)."""
+    _title, query = BROADCAST_SEGMENTS[segment]
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with get_db_transaction() as conn:
+        job_id = conn.execute(
+            "INSERT INTO broadcast_jobs(text, segment, admin_chat_id) VALUES (?, ?, ?)",
+            (text, segment, admin_chat_id)
+        ).lastrowid
+        conn.execute(
+            f"INSERT OR IGNORE INTO broadcast_deliveries(job_id, user_id) SELECT :job_id, user_id FROM ({query})",
+            {"job_id": job_id, "now": now}
+        )
+        total = conn.execute(
+            "SELECT COUNT(*) FROM broadcast_deliveries WHERE job_id = ?", (job_id,)
+        ).fetchone()[0]
+        conn.execute("UPDATE broadcast_jobs SET total = ? WHERE id = ?", (total, job_id))
+    return job_id, total
+
+
+def set_broadcast_progress_message(job_id: int, message_id: int):
+    with get_db_transaction() as conn:
+        conn.execute("UPDATE broadcast_jobs SET progress_message_id = ? WHERE id = ?", (message_id, job_id))
+
+
+def get_broadcast_job(job_id: int):
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+
+def get_unfinished_broadcast_ids() -> list[int]:
+    with get_db_connection() as conn:
+        return [r["id"] for r in conn.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")]
+
+
+def get_pending_broadcast_recipients(job_id: int) -> list[int]:
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT user_id FROM broadcast_deliveries WHERE job_id = ? AND status = 'pending'", (job_id,)
+        ).fetchall()
+        return [r["user_id"] for r in rows]
+
+
+def save_broadcast_results(job_id: int, results: list[tuple[int, str, str | None]]):
+    """results: (user_id, status, error). Сдвигает курсор и счётчики задания."""
+    if not results:
+        return
+    sent = sum(1 for _uid, status, _err in results if status == "sent")
+    with get_db_transaction() as conn:
+        conn.executemany(
+            "UPDATE broadcast_deliveries SET status = ?, error = ? WHERE job_id = ? AND user_id = ?",
+            [(status, err, job_id, uid) for uid, status, err in results]
+        )
+        conn.execute(
+            "UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+            (sent, len(results) - sent, job_id)
+        )
+
+
+def request_broadcast_cancel(job_id: int) -> bool:
+    """Помечает идущую рассылку на остановку. False — такой рассылки нет или она уже завершена."""
+    with get_db_transaction() as conn:
+        return conn.execute(
+            "UPDATE broadcast_jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,)
+        ).rowcount > 0
+
+
+def is_broadcast_cancel_requested(job_id: int) -> bool:
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT cancel_requested FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+
+def finish_broadcast_job(job_id: int, status: str):
+    with get_db_transaction() as conn:
+        conn.execute(
+            "UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'",
+            (status, job_id)
+        )
+
+
+class BroadcastEngine:
+    """Фоновый запуск и возобновление рассылок.
+
+    Остановка идёт через флаг cancel_requested в БД: рассылку может вести другой воркер
+    (после перезапуска их возобновляет шард 0), а задача проверяет флаг после каждой пачки.
+    """
+
+    def __init__(self):
+        self.limiter = AsyncRateLimiter(BROADCAST_RATE)
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._cancelled: set[int] = set()
+        self.stats = {"sent": 0, "failed": 0, "blocked": 0, "retry_after": 0}
+
+    def start(self, app, job_id: int):
+        if job_id in self._tasks and not self._tasks[job_id].done():
+            return
+        task = asyncio.create_task(self._run(app.bot, job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _t: self._tasks.pop(job_id, None))
+
+    async def resume_all(self, app):
+        for job_id in await run_db(get_unfinished_broadcast_ids):
+            logger.info(f"Возобновляем рассылку #{job_id}")
+            self.start(app, job_id)
+
+    async def cancel(self, job_id: int) -> bool:
+        if not await run_db(request_broadcast_cancel, job_id):
+            return False
+        if job_id in self._tasks:
+            self._cancelled.add(job_id)  # своя задача остановится, не дожидаясь пачки
+        return True
+
+    async def stop(self):
+        """При остановке просто прерываем задачи: курсор в БД, рассылка продолжится при запуске."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send_one(self, bot, job_id: int, uid: int, text: str) -> tuple[int, str, str | None]:
+        for _attempt in range(BROADCAST_MAX_RETRIES):
+            await self.limiter.acquire()
+            if job_id in self._cancelled:
+                return uid, "pending", None
+            try:
+                await bot.send_message(chat_id=uid, text=text, disable_web_page_preview=True)
+                self.stats["sent"] += 1
+                return uid, "sent", None
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                self.limiter.pause(_retry_after_seconds(e) + 0.5)
+            except Forbidden as e:
+                self.stats["blocked"] += 1
+                return uid, "blocked", str(e)[:200]
+            except Exception as e:
+                self.stats["failed"] += 1
+                return uid, "failed", str(e)[:200]
+        self.stats["failed"] += 1
+        return uid, "failed", "retry_after"
+
+    async def _report(self, bot, job_id: int, final: str | None = None):
+        job = await run_db(get_broadcast_job, job_id)
+        if not job or not job["admin_chat_id"]:
+            return
+        done = job["sent"] + job["failed"]
+        text = (
+            f"📣 Рассылка #{job_id} ({BROADCAST_SEGMENTS.get(job['segment'], (job['segment'],))[0]})\n"
+            f"Отправлено: {done}/{job['total']} | ✅ {job['sent']} | ❌ {job['failed']}"
+        )
+        if final:
+            text += f"\n{final}"
+        try:
+            if job["progress_message_id"]:
+                await bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["progress_message_id"])
+            elif final:
+                await bot.send_message(chat_id=job["admin_chat_id"], text=text)
+        except BadRequest:
+            pass  # текст не изменился
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки #{job_id}: {e}")
+
+    async def _run(self, bot, job_id: int):
+        job = await run_db(get_broadcast_job, job_id)
+        if not job or job["status"] != "running":
+            return
+        if job["cancel_requested"]:
+            self._cancelled.add(job_id)
+        recipients = await run_db(get_pending_broadcast_recipients, job_id)
+        queue: asyncio.Queue = asyncio.Queue()
+        for uid in recipients:
+            queue.put_nowait(uid)
+        results: list = []
+        flush_lock = asyncio.Lock()
+
+        async def flush():
+            async with flush_lock:
+                batch = [r for r in results if r[1] != "pending"]
+                results.clear()
+                await run_db(save_broadcast_results, job_id, batch)
+                if job_id not in self._cancelled and await run_db(is_broadcast_cancel_requested, job_id):
+                    self._cancelled.add(job_id)
+
+        async def worker():
+            while not queue.empty() and job_id not in self._cancelled:
+                uid = queue.get_nowait()
+                results.append(await self._send_one(bot, job_id, uid, job["text"]))
+                if len(results) >= BROADCAST_FLUSH_SIZE:
+                    await flush()
+
+        async def progress():
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+                await flush()
+                await self._report(bot, job_id)
+
+        reporter = asyncio.create_task(progress())
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, BROADCAST_CONCURRENCY))))
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+            await flush()
+
+        if job_id in self._cancelled:
+            self._cancelled.discard(job_id)
+            await run_db(finish_broadcast_job, job_id, "cancelled")
+            await self._report(bot, job_id, "⏹ Остановлена.")
+        else:
+            await run_db(finish_broadcast_job, job_id, "done")
+            await self._report(bot, job_id, "✅ Готово.")
+
+    def stats_text(self) -> str:
+        st = self.stats
+        return (
+            "📣 Рассылки\n"
+            f"активных: {len(self._tasks)}\n"
+            f"отправлено: {st['sent']}, заблокировали бота: {st['blocked']}, ошибок: {st['failed']}\n"
+            f"RetryAfter: {st['retry_after']}"
+        )
+
+
+broadcast_engine = BroadcastEngine()
+
+
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # только админ
+    """/broadcast [@сегмент] текст — фоновая рассылка (только админ)"""
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("❌ Эта команда только для администратора.")
         return
 
-    # текст берём из аргументов команды
-    text = " ".join(context.args) if context.args else ""
+    args = list(context.args or [])
+    segment = "all"
+    if args and args[0].startswith("@") and args[0][1:] in BROADCAST_SEGMENTS:
+        segment = args.pop(0)[1:]
+    text = " ".join(args)
     if not text.strip():
-        await update.message.reply_text("Формат: /broadcast ваш текст для рассылки")
+        segments = ", ".join(f"@{key} — {title}" for key, (title, _q) in BROADCAST_SEGMENTS.items())
+        await update.message.reply_text(f"Формат: /broadcast [@сегмент] ваш текст для рассылки\nСегменты: {segments}")
         return
 
-    user_ids = get_all_user_ids()
-    ok = fail = 0
-    # маленькая задержка, чтобы не упереться в лимиты
-    for uid in user_ids:
-        try:
-            await context.bot.sendMessage(chat_id=uid, text=text, disable_web_page_preview=True)
-            ok += 1
-        except Exception:
-            fail += 1
-        await asyncio.sleep(0.05)  # ≈20 сообщений/сек
+    job_id, total = await run_db(create_broadcast_job, text, segment, update.effective_chat.id)
+    progress_message = await update.message.reply_text(
+        f"📣 Рассылка #{job_id} ({BROADCAST_SEGMENTS[segment][0]})\nОтправлено: 0/{total}\n"
+        f"Остановить: /broadcast_cancel {job_id}"
+    )
+    await run_db(set_broadcast_progress_message, job_id, progress_message.message_id)
+    broadcast_engine.start(context.application, job_id)
 
-    await update.message.reply_text(f"Готово. ✅ {ok} | ❌ {fail} | Всего: {len(user_ids)}")
+
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast_cancel <id> — остановить рассылку (только админ)"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Формат: /broadcast_cancel <номер рассылки>")
+        return
+    job_id = int(context.args[0])
+    if await broadcast_engine.cancel(job_id):
+        await update.message.reply_text(f"⏹ Останавливаю рассылку #{job_id}…")
+    else:
+        await update.message.reply_text(f"Рассылка #{job_id} не выполняется.")
 
 
 async def handle_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -361,78 +1654,387 @@ async def handle_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
-async def deduct_user_request(user_id: int) -> str | None:
+def deduct_user_request_sync(user_id: int) -> str | None:
+    """
+    Атомарно списывает одну попытку и возвращает «чек» (корзину): free → bonus → paid.
+    Чтение и списание идут в одной транзакции BEGIN IMMEDIATE: параллельные
+    списания (в т.ч. из других потоков/процессов) выстраиваются в очередь и не уходят в минус.
+    """
     if user_id == ADMIN_ID:
         return "admin"
 
-    u = get_user(user_id)
-    if not u:
-        return None
-
-    # подписка ещё активна?
-    is_sub = bool(u["is_subscribed"] or 0)
-    sub_end = u["subscription_end"]
-    if is_sub and expire_if_needed(u["user_id"], sub_end):
-        return "sub"
+    with user_mutation(user_id) as conn:
+        u = conn.execute(
+            "SELECT is_subscribed, subscription_end, request_count, bonus_requests, paid_requests "
+            "FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        if not u:
+            return None
 
-    free_remaining = max(0, MAX_FREE_REQUESTS - (u["request_count"] or 0))
-    bonus_requests = u["bonus_requests"] or 0
-    paid_requests  = u["paid_requests"] or 0
+        # подписка ещё активна?
+        if u["is_subscribed"]:
+            if is_subscription_active(user_id, u["subscription_end"]):
+                return "sub"
+            conn.execute(
+                "UPDATE users SET is_subscribed = 0, subscription_end = NULL WHERE user_id = ?",
+                (user_id,)
+            )
 
-    with get_db_connection() as conn:
-        if free_remaining > 0:
-            conn.execute("UPDATE users SET request_count = request_count + 1 WHERE user_id = ?", (user_id,))
+        if (u["request_count"] or 0) < MAX_FREE_REQUESTS:
+            conn.execute(
+                "UPDATE users SET request_count = COALESCE(request_count,0) + 1 WHERE user_id = ?",
+                (user_id,)
+            )
             return "free"
-        if bonus_requests > 0:
+        if (u["bonus_requests"] or 0) > 0:
             conn.execute("UPDATE users SET bonus_requests = bonus_requests - 1 WHERE user_id = ?", (user_id,))
             return "bonus"
-        if paid_requests > 0:
+        if (u["paid_requests"] or 0) > 0:
             conn.execute("UPDATE users SET paid_requests = paid_requests - 1 WHERE user_id = ?", (user_id,))
             return "paid"
     return None
 
 
+async def deduct_user_request(user_id: int) -> str | None:
+    return await repo.deduct(user_id)
+
+
+# Обратные операции к списанию: одно UPDATE-выражение на корзину
+_REFUND_SQL = {
+    "free": "UPDATE users SET request_count = MAX(COALESCE(request_count,0) - 1, 0) WHERE user_id = ?",
+    "bonus": "UPDATE users SET bonus_requests = COALESCE(bonus_requests,0) + 1 WHERE user_id = ?",
+    "paid": "UPDATE users SET paid_requests = COALESCE(paid_requests,0) + 1 WHERE user_id = ?",
+}
+
+
+def refund_user_request_sync(user_id: int, bucket: str | None):
+    """Атомарно возвращает попытку в ту корзину, из которой она была списана."""
+    sql = _REFUND_SQL.get(bucket)
+    if not sql:
+        return  # admin / sub / None — возвращать нечего
+    with user_mutation(user_id) as conn:
+        conn.execute(sql, (user_id,))
+
 
 async def refund_user_request(user_id: int, bucket: str | None):
-    if bucket in (None, "admin", "sub"):
-        return
-    with get_db_connection() as conn:
-        if bucket == "free":
-            conn.execute(
-                "UPDATE users SET request_count = CASE WHEN request_count>0 THEN request_count-1 ELSE 0 END WHERE user_id = ?",
-                (user_id,)
-            )
-        elif bucket == "bonus":
-            conn.execute(
-                "UPDATE users SET bonus_requests = COALESCE(bonus_requests,0) + 1 WHERE user_id = ?",
-                (user_id,)
-            )
-        elif bucket == "paid":
-            conn.execute(
-                "UPDATE users SET paid_requests = COALESCE(paid_requests,0) + 1 WHERE user_id = ?",
-                (user_id,)
-            )
+    await repo.refund(user_id, bucket)
+
+
+# ====== ЖУРНАЛ ГАДАНИЙ (БУФЕРИЗОВАННАЯ ЗАПИСЬ) ======
+# Обработчик только кладёт запись в очередь; фоновая задача пишет пачками в
+# таблицу request_log — по размеру пачки или по таймеру, и дописывает остаток при остановке.
+REQUEST_LOG_QUEUE_SIZE = int(os.getenv("REQUEST_LOG_QUEUE_SIZE", "10000"))
+REQUEST_LOG_BATCH_SIZE = int(os.getenv("REQUEST_LOG_BATCH_SIZE", "200"))
+REQUEST_LOG_FLUSH_INTERVAL = float(os.getenv("REQUEST_LOG_FLUSH_INTERVAL", "2.0"))  # сек
+_REQUEST_LOG_STOP = object()  # метка остановки в очереди: всё, что до неё, будет записано
+
+
+def write_request_log_batch(records: list[tuple]):
+    """Пишет пачку записей журнала и в той же транзакции обновляет агрегаты аналитики."""
+    with get_db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO request_log(timestamp, user_id, username, question, cards, spread_key) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            records
+        )
+        update_reading_stats(conn, records)
+
+
+class RequestLogWriter:
+    """Очередь записей журнала + фоновый сброс пачками."""
+
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self.stats = {
+            "enqueued": 0, "written": 0, "dropped": 0, "failed": 0,
+            "batches": 0, "high_water": 0, "flush_ms_max": 0.0,
+        }
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=REQUEST_LOG_QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, record: tuple) -> bool:
+        """Не блокирует: при переполнении запись отбрасывается и учитывается в dropped."""
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return True
+        self.stats["enqueued"] += 1
+        self.stats["high_water"] = max(self.stats["high_water"], self._queue.qsize())
+        return True
+
+    def _drain(self, batch: list) -> bool:
+        """Добирает пачку из очереди без ожидания; True — встретилась метка остановки."""
+        while len(batch) < REQUEST_LOG_BATCH_SIZE and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is _REQUEST_LOG_STOP:
+                return True
+            batch.append(item)
+        return False
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        try:
+            await run_db(write_request_log_batch, batch)
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        except Exception as e:
+            self.stats["failed"] += len(batch)
+            logger.error(f"Ошибка записи журнала гаданий ({len(batch)} зап.): {e}")
+        self.stats["flush_ms_max"] = max(self.stats["flush_ms_max"], (time.perf_counter() - started) * 1000)
+
+    async def _run(self):
+        # задачу не отменяют: stop() кладёт в очередь метку, и набранная пачка всегда дописывается
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _REQUEST_LOG_STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + REQUEST_LOG_FLUSH_INTERVAL
+            while len(batch) < REQUEST_LOG_BATCH_SIZE:
+                stopping = self._drain(batch)
+                remaining = deadline - time.monotonic()
+                if stopping or len(batch) >= REQUEST_LOG_BATCH_SIZE or remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is _REQUEST_LOG_STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает всё, что осталось в очереди."""
+        if self._task is not None:
+            if not self._task.done():
+                await self._queue.put(_REQUEST_LOG_STOP)
+            try:
+                await self._task
+            except Exception as e:
+                logger.error(f"Фоновая запись журнала гаданий завершилась с ошибкой: {e}")
+            self._task = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                batch = []
+                self._drain(batch)
+                await self._flush(batch)
+            self._queue = None
+
+    def stats_text(self) -> str:
+        st = self.stats
+        depth = self._queue.qsize() if self._queue is not None else 0
+        avg_batch = (st["written"] / st["batches"]) if st["batches"] else 0.0
+        return (
+            f"📝 Журнал гаданий: в очереди {depth} (макс. {st['high_water']}/{REQUEST_LOG_QUEUE_SIZE}), "
+            f"записано {st['written']} в {st['batches']} пачках (ср. {avg_batch:.1f}), "
+            f"отброшено {st['dropped']}, ошибок {st['failed']}, сброс макс. {st['flush_ms_max']:.1f} мс"
+        )
 
 
+request_log_writer = RequestLogWriter()
 
 
-def log_request(user_id, username, question, cards):
-    """Логирование запроса в CSV"""
+def log_request(user_id, username, question, cards, spread_key=None):
+    """Логирование запроса: в очередь фоновой записи (или сразу в БД, если очередь не запущена)"""
     try:
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         cards_str = ', '.join(cards) if isinstance(cards, list) else str(cards)
-        
-        file_exists = os.path.isfile('user_requests.csv')
-        with open('user_requests.csv', 'a', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            if not file_exists:
-                writer.writerow(['timestamp', 'user_id', 'username', 'question', 'cards'])
-            writer.writerow([timestamp, user_id, username, question, cards_str])
-        
+        record = (timestamp, user_id, username, question, cards_str, spread_key)
+
+        if not request_log_writer.enqueue(record):
+            write_request_log_batch([record])
+
         logger.info(f"Запрос записан в лог: {user_id} - {question[:50]}...")
     except Exception as e:
         logger.error(f"Ошибка записи в лог: {e}")
 
+# ====== АНАЛИТИКА ======
+# Агрегаты (DAU, карты, расклады, оплаты) обновляются инкрементально: журнал — пачками
+# в write_request_log_batch, оплаты — в activate_subscription. /stats читает только их.
+
+def _bump_stat_total(conn, name: str, delta: float = 1):
+    conn.execute(
+        "INSERT INTO stats_totals(name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        (name, delta)
+    )
+
+
+def update_reading_stats(conn, records):
+    """records: (timestamp, user_id, username, question, cards, spread_key)."""
+    readings, cards, spreads, day_users = Counter(), Counter(), Counter(), set()
+    for timestamp, user_id, _username, _question, cards_str, spread_key in records:
+        day = (timestamp or "")[:10]
+        readings[day] += 1
+        spreads[spread_key or "custom"] += 1
+        if user_id is not None:
+            day_users.add((day, int(user_id)))
+        for card in (cards_str or "").split(","):
+            key = normalize_card_key(card)
+            if key:
+                cards[key] += 1
+
+    new_users = Counter()
+    for day, user_id in day_users:
+        cur = conn.execute("INSERT OR IGNORE INTO stats_daily_users(day, user_id) VALUES (?, ?)", (day, user_id))
+        new_users[day] += cur.rowcount
+    conn.executemany(
+        "INSERT INTO stats_daily(day, readings, users) VALUES (?, ?, ?) "
+        "ON CONFLICT(day) DO UPDATE SET readings = readings + excluded.readings, users = users + excluded.users",
+        [(day, n, new_users[day]) for day, n in readings.items()]
+    )
+    conn.executemany(
+        "INSERT INTO stats_cards(card, draws) VALUES (?, ?) "
+        "ON CONFLICT(card) DO UPDATE SET draws = draws + excluded.draws",
+        list(cards.items())
+    )
+    conn.executemany(
+        "INSERT INTO stats_spreads(spread_key, readings) VALUES (?, ?) "
+        "ON CONFLICT(spread_key) DO UPDATE SET readings = readings + excluded.readings",
+        list(spreads.items())
+    )
+
+
+def record_payment_stats(conn, user_id: int, tariff_key: str, amount: float | None, paid_at: str | None = None):
+    """Вызывается ровно один раз на успешный платёж (внутри транзакции активации)."""
+    paid_at = paid_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute(
+        "INSERT INTO stats_daily(day, payments, revenue) VALUES (?, 1, ?) "
+        "ON CONFLICT(day) DO UPDATE SET payments = payments + 1, revenue = revenue + excluded.revenue",
+        (paid_at[:10], amount or 0)
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO stats_payers(user_id, first_paid_at, tariff) VALUES (?, ?, ?)",
+        (user_id, paid_at, tariff_key)
+    )
+
+
+def import_request_csv(conn, path: str = 'user_requests.csv') -> int:
+    """Переносит историю из старого user_requests.csv в request_log."""
+    if not os.path.isfile(path):
+        return 0
+    with open(path, newline='', encoding='utf-8') as file:
+        rows = [
+            (r.get('timestamp'), int(r['user_id']) if (r.get('user_id') or '').isdigit() else None,
+             r.get('username'), r.get('question'), r.get('cards'),
+             "card_of_day" if r.get('question') == "Карта дня" else None)
+            for r in csv.DictReader(file)
+        ]
+    conn.executemany(
+        "INSERT INTO request_log(timestamp, user_id, username, question, cards, spread_key) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    return len(rows)
+
+
+def rebuild_stats():
+    """Пересчитывает все агрегаты с нуля (один раз при первом запуске или по /stats rebuild)."""
+    with get_db_transaction() as conn:
+        if not conn.execute("SELECT 1 FROM request_log LIMIT 1").fetchone():
+            imported = import_request_csv(conn)
+            if imported:
+                logger.info(f"Импортировано {imported} записей из user_requests.csv")
+        for table in ("stats_daily", "stats_daily_users", "stats_cards", "stats_spreads", "stats_payers", "stats_totals"):
+            conn.execute(f"DELETE FROM {table}")
+
+        cursor = conn.execute("SELECT timestamp, user_id, username, question, cards, spread_key FROM request_log")
+        while True:
+            chunk = cursor.fetchmany(5000)
+            if not chunk:
+                break
+            update_reading_stats(conn, [tuple(r) for r in chunk])
+
+        for r in conn.execute(
+            "SELECT user_id, tariff, amount, created_at FROM payments WHERE status = 'succeeded' ORDER BY created_at"
+        ).fetchall():
+            record_payment_stats(conn, r["user_id"], r["tariff"], r["amount"], r["created_at"])
+
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        _bump_stat_total(conn, "users", users)
+        _bump_stat_total(conn, "stats_version", 1)
+    logger.info("Аналитика пересчитана")
+
+
+def collect_stats() -> dict:
+    today = datetime.now().date()
+    week_ago = (today - timedelta(days=6)).isoformat()
+    with get_db_connection() as conn:
+        totals = {r["name"]: r["value"] for r in conn.execute("SELECT name, value FROM stats_totals")}
+        days = {r["day"]: r for r in conn.execute(
+            "SELECT day, readings, users, payments, revenue FROM stats_daily WHERE day >= ?", (week_ago,)
+        )}
+        overall = conn.execute(
+            "SELECT COALESCE(SUM(readings),0) AS readings, COALESCE(SUM(payments),0) AS payments, "
+            "COALESCE(SUM(revenue),0) AS revenue FROM stats_daily"
+        ).fetchone()
+        payers = conn.execute("SELECT COUNT(*) FROM stats_payers").fetchone()[0]
+        top_cards = conn.execute("SELECT card, draws FROM stats_cards ORDER BY draws DESC LIMIT 5").fetchall()
+        top_spreads = conn.execute("SELECT spread_key, readings FROM stats_spreads ORDER BY readings DESC LIMIT 7").fetchall()
+    week = [days[d] for d in days]
+    return {
+        "users": int(totals.get("users", 0)),
+        "dau_today": days[today.isoformat()]["users"] if today.isoformat() in days else 0,
+        "dau_week_avg": (sum(r["users"] for r in week) / 7.0),
+        "readings_today": days[today.isoformat()]["readings"] if today.isoformat() in days else 0,
+        "readings_week": sum(r["readings"] for r in week),
+        "readings_total": overall["readings"],
+        "payments_total": overall["payments"],
+        "revenue_total": overall["revenue"],
+        "payers": payers,
+        "top_cards": [(r["card"], r["draws"]) for r in top_cards],
+        "top_spreads": [(r["spread_key"], r["readings"]) for r in top_spreads],
+    }
+
+
+def _spread_label(spread_key: str) -> str:
+    if spread_key in READY_SPREADS:
+        return READY_SPREADS[spread_key]["title"]
+    return {"custom": "🃏 Свой вопрос", "card_of_day": "🌟 Карта дня"}.get(spread_key, spread_key)
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats — сводка по аналитике (только админ); /stats rebuild — пересчёт агрегатов"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    if context.args and context.args[0] == "rebuild":
+        await run_db(rebuild_stats)
+
+    started = time.perf_counter()
+    st = await run_db(collect_stats)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    conversion = (100.0 * st["payers"] / st["users"]) if st["users"] else 0.0
+
+    lines = [
+        "📊 Статистика",
+        f"👥 Пользователей: {st['users']}",
+        f"📅 DAU сегодня: {st['dau_today']}, в среднем за 7 дней: {st['dau_week_avg']:.1f}",
+        f"🔮 Гаданий: сегодня {st['readings_today']}, за 7 дней {st['readings_week']}, всего {st['readings_total']}",
+        f"💳 Платящих: {st['payers']} из {st['users']} (конверсия {conversion:.2f}%), "
+        f"оплат {st['payments_total']} на {st['revenue_total']:.2f}₽",
+        "",
+        "🃏 Чаще всего выпадают:",
+    ]
+    for card, draws in st["top_cards"]:
+        name = CARD_MEANINGS.get(card, {}).get("name", card)
+        lines.append(f"• {name} — {draws}")
+    lines += ["", "📚 Гадания по раскладам:"]
+    for spread_key, readings in st["top_spreads"]:
+        lines.append(f"• {_spread_label(spread_key)} — {readings}")
+    lines += ["", f"⏱ {elapsed_ms:.1f} мс"]
+    await update.message.reply_text("\n".join(lines))
+
+
 def build_ref_link(user_id: int, bot_username: str) -> str:
     # username приходит как 'MyBot' или '@MyBot' — нормализуем
     bot_username = bot_username.lstrip('@')
@@ -598,65 +2200,813 @@ READY_SPREADS = {
     }
 }
 
+# ====== ЛОКАЛЬНЫЕ ТОЛКОВАНИЯ ======
+DEFAULT_SPREAD_POSITIONS = ["Первая карта", "Вторая карта", "Третья карта"]
+CARD_ORDINALS = ("Первая карта", "Вторая карта", "Третья карта")
+
+# Корпус (карта, позиция) → абзац для всех позиций готовых раскладов и расклада по умолчанию
+LOCAL_READING_CORPUS = build_position_corpus(
+    DEFAULT_SPREAD_POSITIONS + [pos for spread in READY_SPREADS.values() for pos in spread["positions"]]
+)
+
+
+def assemble_local_reading(question: str | None, cards: list, positions: list | None = None) -> str | None:
+    """Собирает толкование расклада из корпуса. None — если карта не распознана."""
+    # Берём CARD_MEANINGS, а не TAROT_DAY_INTERPRETATIONS: тексты «карты дня» — цельные
+    # сообщения про одну карту на весь день («Этот день может...») и не делятся по позициям
+    # расклада; в корпусе позиций у каждой карты есть суть, совет и тексты под позицию.
+    positions = positions or DEFAULT_SPREAD_POSITIONS
+    keys = [normalize_card_key(c) for c in cards]
+    if len(keys) != len(positions) or any(k not in CARD_MEANINGS for k in keys):
+        return None
+
+    paragraphs = []
+    if question and question != "Вопрос не указан":
+        paragraphs.append(f"Ваш вопрос: {question}")
+    for ordinal, key, position in zip(CARD_ORDINALS, keys, positions):
+        meaning = CARD_MEANINGS[key]
+        label = "" if position in DEFAULT_SPREAD_POSITIONS else f" ({position})"
+        text = LOCAL_READING_CORPUS.get((key, position)) or meaning["core"]
+        paragraphs.append(f"{ordinal}{label} — {meaning['name']}. {text}")
+
+    # итоговый совет — от последней карты, чья позиция ещё не дала совета
+    advice_keys = [k for k, pos in zip(keys, positions) if POSITION_KINDS.get(pos) not in ("advice", "lesson")]
+    if advice_keys:
+        advice = CARD_MEANINGS[advice_keys[-1]]["advice"]
+        paragraphs.append(f"В целом расклад советует: {advice[0].lower()}{advice[1:]} ✨")
+    else:
+        paragraphs[-1] += " ✨"
+    return "\n\n".join(paragraphs)
+
+
+async def wants_local_reading(user_id: int, bucket: str | None) -> bool:
+    """Быстрое толкование: включено пользователем (/fast) или для бесплатных попыток."""
+    if LOCAL_READINGS_FOR_FREE and bucket == "free":
+        return True
+    u = await repo.get_user(user_id)
+    return bool(u and u["fast_reading"])
+
+
+def toggle_fast_reading_flag(user_id: int) -> bool:
+    """Переключает users.fast_reading и возвращает новое значение."""
+    _ensure_user_exists(user_id)
+    with user_mutation(user_id) as conn:
+        conn.execute(
+            "UPDATE users SET fast_reading = 1 - COALESCE(fast_reading, 0) WHERE user_id = ?",
+            (user_id,)
+        )
+    u = get_user(user_id)
+    return bool(u and u["fast_reading"])
+
+
+async def toggle_fast_reading(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/fast — включает/выключает быстрые толкования без ожидания"""
+    user = update.effective_user
+    if await repo.toggle_fast_reading(user.id):
+        text = ("⚡ Быстрые толкования включены: ответ приходит сразу, по классическим значениям карт.\n"
+                "Чтобы вернуть подробные толкования, снова отправьте /fast")
+    else:
+        text = "🔮 Подробные толкования снова включены."
+    await update.message.reply_text(text, reply_markup=main_keyboard())
+
+
 # Функции для работы с OpenAI
-async def get_tarot_reading(prompt: str) -> str:
+TAROT_SYSTEM_PROMPT = (
+    "Ты - профессиональный таролог. Давай краткие, но содержательные интерпретации карт таро. "
+    "1. Начинай с краткого ответа на вопрос, затем расшифровка каждой карты 2-3 предложения. "
+    "2. Используй мистический, но понятный язык. 3. Давай практические советы. "
+    "4. Будь позитивным, но честным. 3-4 абзаца максимум. "
+    "5. Не используй эмодзи, кроме одного в конце. Пиши от второго лица. Обращайся на 'Вы'. "
+    "6. Нумеруй позиции по месту в раскладе: 'Первая карта — ...', 'Вторая карта — ...', 'Третья карта — ...'. "
+    "   Не путай номер позиции с достоинством карты (например, 'Четверка мечей' — это название карты, а не четвертая позиция). "
+    "7. Названия карт строго по-русски: Туз, Двойка, Тройка, Четверка, Пятерка, Шестерка, Семерка, Восьмерка, Девятка, Десятка, "
+    "   Паж, Рыцарь, Королева, Король; масти — жезлов, кубков, мечей, пентаклей. Пиши: 'Четверка мечей' (не 'четыре мечей'). "
+    "8. Старшие арканы называй официально: Маг, Жрица, Императрица, Император, Иерофант, Влюбленные, Колесница, Сила, Отшельник, "
+    "   Колесо Фортуны, Справедливость, Повешенный, Смерть, Умеренность, Дьявол, Башня, Звезда, Луна, Солнце, Суд, Мир. "
+    "9. В тексте не смешивай номер позиции и название карты."
+)
+
+# Один асинхронный клиент на процесс: общий пул keep-alive соединений,
+# запросы не блокируют event loop PTB.
+_openai_client: AsyncOpenAI | None = None
+
+
+# ====== ПРЕДОХРАНИТЕЛЬ И ГИСТОГРАММЫ ЗАДЕРЖЕК ======
+# Общие для внешних сервисов (ЮKassa, OpenAI).
+
+class CircuitBreaker:
     """
-    Вызывает OpenAI и возвращает текст интерпретации.
-    Ключ берётся из переменной окружения OPENAI_API_KEY (нигде в коде не нужен).
+    closed → open → (reset_timeout) → half_open: пропускается один пробный вызов;
+    успех замыкает цепь, сбой снова размыкает. Размыкание — после failure_threshold сбоев
+    подряд, а при window > 0 — когда среди последних window вызовов (не меньше min_calls)
+    доля сбоев достигла failure_rate.
     """
-    logger.info(f"Отправка запроса в OpenAI: prompt={prompt[:120]}...")
-
-    model_name = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # можно сменить в .env при желании
-    system_prompt = (
-        "Ты - профессиональный таролог. Давай краткие, но содержательные интерпретации карт таро. "
-        "1. Начинай с краткого ответа на вопрос, затем расшифровка каждой карты 2-3 предложения. "
-        "2. Используй мистический, но понятный язык. 3. Давай практические советы. "
-        "4. Будь позитивным, но честным. 3-4 абзаца максимум. "
-        "5. Не используй эмодзи, кроме одного в конце. Пиши от второго лица. Обращайся на 'Вы'. "
-        "6. Нумеруй позиции по месту в раскладе: 'Первая карта — ...', 'Вторая карта — ...', 'Третья карта — ...'. "
-        "   Не путай номер позиции с достоинством карты (например, 'Четверка мечей' — это название карты, а не четвертая позиция). "
-        "7. Названия карт строго по-русски: Туз, Двойка, Тройка, Четверка, Пятерка, Шестерка, Семерка, Восьмерка, Девятка, Десятка, "
-        "   Паж, Рыцарь, Королева, Король; масти — жезлов, кубков, мечей, пентаклей. Пиши: 'Четверка мечей' (не 'четыре мечей'). "
-        "8. Старшие арканы называй официально: Маг, Жрица, Императрица, Император, Иерофант, Влюбленные, Колесница, Сила, Отшельник, "
-        "   Колесо Фортуны, Справедливость, Повешенный, Смерть, Умеренность, Дьявол, Башня, Звезда, Луна, Солнце, Суд, Мир. "
-        "9. В тексте не смешивай номер позиции и название карты."
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float,
+                 window: int = 0, failure_rate: float = 0.5, min_calls: int = 5):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self._outcomes: deque | None = deque(maxlen=window) if window else None
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._open_for = reset_timeout
+        self._probe_started: float | None = None
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def is_open(self) -> bool:
+        """Разомкнут и время пробы ещё не пришло (без побочных эффектов)."""
+        return self.state == "open" and time.monotonic() - self.opened_at < self._open_for
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self.opened_at < self._open_for:
+                self.stats["rejected"] += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            # проба, чей результат так и не пришёл (отмена), не должна держать цепь вечно
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                self.stats["rejected"] += 1
+                return False
+            self._probe_started = now
+        return True
+
+    def failure_ratio(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def record_success(self):
+        self._probe_started = None
+        self.failures = 0
+        if self._outcomes is not None:
+            self._outcomes.append(True)
+        if self.state != "closed":
+            logger.info(f"Предохранитель {self.name}: цепь замкнута")
+            if self._outcomes is not None:
+                self._outcomes.clear()
+        self.state = "closed"
+
+    def record_failure(self):
+        self._probe_started = None
+        self.failures += 1
+        if self._outcomes is not None:
+            self._outcomes.append(False)
+            tripped = len(self._outcomes) >= self.min_calls and self.failure_ratio() >= self.failure_rate
+        else:
+            tripped = self.failures >= self.failure_threshold
+        if self.state == "half_open" or tripped:
+            self.open_for(self.reset_timeout)
+
+    def open_for(self, seconds: float):
+        """Разомкнуть минимум на seconds (например, по Retry-After)."""
+        if self.state != "open":
+            self.stats["opened"] += 1
+            logger.warning(f"Предохранитель {self.name}: цепь разомкнута на {seconds:.0f} с")
+        elif self.is_open():
+            seconds = max(seconds, self._open_for - (time.monotonic() - self.opened_at))
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self._open_for = max(seconds, 0.0)
+
+    def stats_text(self) -> str:
+        rate = f", сбоев в окне {self.failure_ratio() * 100:.0f}% из {len(self._outcomes)}" if self._outcomes is not None else ""
+        return (
+            f"предохранитель: {self.state}, сбоев подряд {self.failures}{rate}, "
+            f"размыканий {self.stats['opened']}, отклонено {self.stats['rejected']}"
+        )
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами (мс)."""
+
+    BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает q-квантиль."""
+        if not self.total:
+            return 0.0
+        rank, seen = q * self.total, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return float(self.BUCKETS_MS[i]) if i < len(self.BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def text(self) -> str:
+        if not self.total:
+            return "нет вызовов"
+        buckets = " ".join(
+            f"≤{bound}:{n}" for bound, n in zip(self.BUCKETS_MS, self.counts) if n
+        )
+        if self.counts[-1]:
+            buckets += f" >{self.BUCKETS_MS[-1]}:{self.counts[-1]}"
+        return (
+            f"n={self.total}, avg {self.sum_ms / self.total:.0f} мс, p50≤{self.percentile(0.5):.0f}, "
+            f"p95≤{self.percentile(0.95):.0f}, max {self.max_ms:.0f} мс [{buckets}]"
+        )
+
+
+# ====== ОЧЕРЕДЬ К OPENAI С ПРИОРИТЕТАМИ ======
+# Одновременно к OpenAI идут не более OPENAI_MAX_CONCURRENCY гаданий; остальные ждут в очереди,
+# откуда первыми выходят админ, подписчики, платные, бонусные и только потом бесплатные.
+# Очередь ограничена, а бесплатные при длинной очереди сразу получают быстрое толкование.
+LLM_QUEUE_LIMIT = int(os.getenv("LLM_QUEUE_LIMIT", "100"))               # всего ожидающих
+LLM_FREE_SHED_QUEUE = int(os.getenv("LLM_FREE_SHED_QUEUE", "10"))        # с такой очереди бесплатных не ставим
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "90"))          # сек ожидания в очереди
+LLM_QUEUE_UPDATE_INTERVAL = float(os.getenv("LLM_QUEUE_UPDATE_INTERVAL", "3"))  # сек между «вы N-й»
+
+READING_PRIORITY = {"admin": 0, "sub": 1, "paid": 2, "bonus": 3, "free": 4}
+PRIORITY_FREE = READING_PRIORITY["free"]
+_PRIORITY_NAMES = {v: k for k, v in READING_PRIORITY.items()}
+
+
+class OpenAIUnavailable(Exception):
+    """Предохранитель OpenAI разомкнут — запрос в сеть не отправлялся."""
+
+
+openai_breaker = CircuitBreaker(
+    "OpenAI", failure_threshold=OPENAI_BREAKER_MIN_CALLS, reset_timeout=OPENAI_BREAKER_RESET,
+    window=OPENAI_BREAKER_WINDOW, failure_rate=OPENAI_BREAKER_FAILURE_RATE, min_calls=OPENAI_BREAKER_MIN_CALLS,
+)
+OPENAI_RETRY_STATS = {"retries": 0, "rate_limited": 0, "retry_after_honored": 0, "fast_fallbacks": 0}
+
+
+def _openai_retry_after(err: Exception) -> float | None:
+    """Retry-After из ответа 429 (retry-after-ms или retry-after, сек)."""
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+def _retry_delay(attempt: int) -> float:
+    """Экспоненциальная пауза с джиттером: разошедшиеся повторы не бьют в API одновременно."""
+    base = API_RETRY_DELAY * (2 ** attempt)
+    return base / 2 + random.uniform(0, base / 2)
+
+
+def ensure_openai_available():
+    """Быстрый отказ до очереди и списаний: при разомкнутой цепи сразу идём в локальное толкование."""
+    if openai_breaker.is_open():
+        OPENAI_RETRY_STATS["fast_fallbacks"] += 1
+        raise OpenAIUnavailable("предохранитель OpenAI разомкнут")
+
+
+def openai_stats_text() -> str:
+    st = OPENAI_RETRY_STATS
+    return (
+        "🤖 OpenAI\n"
+        f"{openai_breaker.stats_text()}\n"
+        f"повторов: {st['retries']}, 429: {st['rate_limited']} (ждали по Retry-After {st['retry_after_honored']}), "
+        f"мгновенных локальных ответов: {st['fast_fallbacks']}"
     )
 
 
-    last_error = None
-    for attempt in range(API_RETRY_ATTEMPTS):
+class AdmissionRejected(Exception):
+    """Очередь к OpenAI переполнена (или бесплатный запрос отсечён при перегрузке)."""
+
+
+class PriorityAdmission:
+    """Семафор с очередью по приоритету (меньше — раньше), ограничением длины и позицией в очереди."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []  # heap (priority, seq, future)
+        self._seq = 0
+        self.stats = {name: Counter() for name in READING_PRIORITY}
+        self.wait_time = {name: LatencyHistogram() for name in READING_PRIORITY}
+
+    def _position(self, key: tuple[int, int]) -> int:
+        return 1 + sum(1 for p, seq, fut in self._waiters if (p, seq) < key and not fut.done())
+
+    def _pending(self) -> int:
+        return sum(1 for _p, _s, fut in self._waiters if not fut.done())
+
+    def release(self):
+        while self._waiters:
+            _p, _s, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)  # слот переходит ожидающему, active не меняется
+                return
+        self.active -= 1
+
+    async def acquire(self, priority: int, on_queued=None):
+        """on_queued(position) — корутина, вызывается при постановке в очередь и смене позиции."""
+        name = _PRIORITY_NAMES.get(priority, "free")
+        st = self.stats[name]
+        if self.active < self.capacity and not self._pending():
+            self.active += 1
+            st["admitted"] += 1
+            self.wait_time[name].observe(0.0)
+            return
+
+        queued = self._pending()
+        if queued >= LLM_QUEUE_LIMIT:
+            st["rejected"] += 1
+            raise AdmissionRejected("очередь к OpenAI заполнена")
+        if priority >= PRIORITY_FREE and queued >= LLM_FREE_SHED_QUEUE:
+            st["shed"] += 1
+            raise AdmissionRejected("перегрузка: бесплатный запрос отсечён")
+
+        self._seq += 1
+        key = (priority, self._seq)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        st["queued"] += 1
+        started = time.monotonic()
+        shown = None
         try:
-            client = OpenAI()  # ключ возьмётся из OPENAI_API_KEY
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=OPENAI_MAX_TOKENS,
-                temperature=0.7
+            while True:
+                position = self._position(key)
+                if on_queued and position != shown:
+                    shown = position
+                    await on_queued(position)
+                remaining = LLM_QUEUE_TIMEOUT - (time.monotonic() - started)
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), timeout=min(LLM_QUEUE_UPDATE_INTERVAL, remaining))
+                    break
+                except asyncio.TimeoutError:
+                    continue
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                self.release()  # слот уже передали нам — отдаём следующему
+            else:
+                fut.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                st["timeouts"] += 1
+                raise AdmissionRejected("слишком долго в очереди к OpenAI") from None
+            raise
+        st["admitted"] += 1
+        self.wait_time[name].observe(time.monotonic() - started)
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_FREE, on_queued=None):
+        await self.acquire(priority, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats_text(self) -> str:
+        lines = [f"🚦 Очередь к OpenAI: занято {self.active}/{self.capacity}, ждут {self._pending()}"]
+        for name in READING_PRIORITY:
+            st = self.stats[name]
+            if not st:
+                continue
+            lines.append(
+                f"{name}: пропущено {st['admitted']} (из очереди {st['queued']}), отсечено {st['shed']}, "
+                f"переполнение {st['rejected']}, таймаут {st['timeouts']}; ожидание {self.wait_time[name].text()}"
             )
-            result = (response.choices[0].message.content or "").strip()
-            finish_reason = getattr(response.choices[0], "finish_reason", "n/a")
-            logger.info(f"OpenAI finish_reason={finish_reason}, len={len(result)}")
+        return "\n".join(lines)
 
-            if not result:
-                raise RuntimeError("Пустой ответ от API")
 
-            return result
+llm_admission = PriorityAdmission(max(1, int(worker_share(OPENAI_MAX_CONCURRENCY))))
+
 
+def queue_position_notifier(message):
+    """Колбэк для acquire: показывает «вы N-й в очереди» правкой сообщения о процессе."""
+    async def notify(position: int):
+        try:
+            await message.edit_text(
+                f"⏳ Сейчас много желающих узнать судьбу — вы {position}-й в очереди.\n"
+                "Толкование начнётся автоматически, ничего нажимать не нужно."
+            )
+        except Exception:
+            pass
+    return notify
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """Ленивая инициализация общего клиента (ключ берётся из OPENAI_API_KEY)."""
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(
+            timeout=OPENAI_TIMEOUT,
+            max_retries=0,  # повторы делаем сами в get_tarot_reading
+            http_client=httpx.AsyncClient(
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=OPENAI_POOL_SIZE,
+                    max_keepalive_connections=OPENAI_POOL_SIZE,
+                ),
+            ),
+        )
+    return _openai_client
+
+
+async def close_openai_client():
+    """Закрываем пул соединений при остановке бота."""
+    global _openai_client
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+
+
+async def _request_completion(prompt: str) -> str:
+    """Одна попытка запроса с таймаутом (слот в очереди берёт вызывающий)."""
+    response = await asyncio.wait_for(
+        get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": TAROT_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=OPENAI_MAX_TOKENS,
+            temperature=OPENAI_TEMPERATURE
+        ),
+        timeout=OPENAI_TIMEOUT
+    )
+    result = (response.choices[0].message.content or "").strip()
+    finish_reason = getattr(response.choices[0], "finish_reason", "n/a")
+    logger.info(f"OpenAI finish_reason={finish_reason}, len={len(result)}")
+
+    if not result:
+        raise RuntimeError("Пустой ответ от API")
+    return result
+
+
+async def _tarot_reading_with_retries(prompt: str) -> str:
+    last_error = None
+    for attempt in range(API_RETRY_ATTEMPTS):
+        if not openai_breaker.allow():
+            raise OpenAIUnavailable("предохранитель OpenAI разомкнут") from last_error
+        try:
+            result = await _request_completion(prompt)
         except Exception as e:
+            # asyncio.CancelledError сюда не попадает — отмена пробрасывается сразу
             last_error = e
-            logger.error(f"Ошибка OpenAI (попытка {attempt + 1}/{API_RETRY_ATTEMPTS}): {e}")
+            openai_breaker.record_failure()
+            logger.error(f"Ошибка OpenAI (попытка {attempt + 1}/{API_RETRY_ATTEMPTS}): {e!r}")
+            delay = _retry_delay(attempt)
+            retry_after = _openai_retry_after(e)
+            if retry_after is not None:
+                OPENAI_RETRY_STATS["rate_limited"] += 1
+                if retry_after > OPENAI_RETRY_AFTER_MAX:
+                    # ждать столько пользователь не будет — размыкаем для всех на указанное время
+                    openai_breaker.open_for(retry_after)
+                    break
+                OPENAI_RETRY_STATS["retry_after_honored"] += 1
+                delay = max(delay, retry_after)
             if attempt < API_RETRY_ATTEMPTS - 1:
-                await asyncio.sleep(API_RETRY_DELAY * (attempt + 1))
+                OPENAI_RETRY_STATS["retries"] += 1
+                await asyncio.sleep(delay)
+        else:
+            openai_breaker.record_success()
+            return result
 
     # Если все попытки упали — пробрасываем последнюю ошибку
     raise last_error if last_error else RuntimeError("Неизвестная ошибка OpenAI")
 
 
+async def get_tarot_reading(prompt: str, priority: int = PRIORITY_FREE, on_queued=None) -> str:
+    """
+    Вызывает OpenAI и возвращает текст интерпретации.
+    Не блокирует event loop: общий AsyncOpenAI, не более OPENAI_MAX_CONCURRENCY
+    гаданий одновременно (очередь по priority), таймаут на попытку OPENAI_TIMEOUT
+    и общий дедлайн OPENAI_DEADLINE после выхода из очереди.
+    """
+    ensure_openai_available()
+    async with llm_admission.slot(priority, on_queued):
+        logger.info(f"Отправка запроса в OpenAI: prompt={prompt[:120]}...")
+        return await asyncio.wait_for(_tarot_reading_with_retries(prompt), timeout=OPENAI_DEADLINE)
+
+
+async def stream_tarot_reading(prompt: str):
+    """
+    Асинхронный генератор кусочков интерпретации (stream=True).
+    Слот в очереди к OpenAI берёт вызывающий (stream_reading_to_message); перебирать только
+    внутри aclosing(), иначе при ошибке у потребителя ответ OpenAI не закроется до сборки мусора.
+    """
+    logger.info(f"Потоковый запрос в OpenAI: prompt={prompt[:120]}...")
+    stream = await asyncio.wait_for(
+        get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": TAROT_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=OPENAI_MAX_TOKENS,
+            temperature=OPENAI_TEMPERATURE,
+            stream=True
+        ),
+        timeout=OPENAI_TIMEOUT
+    )
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    finally:
+        await stream.close()
+
+
+def _retry_after_seconds(err: RetryAfter) -> float:
+    """RetryAfter.retry_after бывает int или timedelta (в зависимости от версии PTB)."""
+    value = err.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+def _split_point(text: str, limit: int) -> int:
+    """Где резать текст не длиннее limit: абзац → строка → предложение → пробел → жёстко."""
+    for seps in (("\n\n",), ("\n",), (". ", "! ", "? ", "… "), (" ",)):
+        pos = max(text.rfind(sep, 0, limit - len(sep) + 1) for sep in seps)
+        if pos > limit // 2:
+            return pos + len(seps[0])
+    return limit
+
+
+class StreamingReply:
+    """
+    Показывает растущий текст правками сообщения: не чаще STREAM_EDIT_INTERVAL,
+    при приближении к лимиту длины продолжает в новом сообщении.
+    """
+
+    def __init__(self, message):
+        self.messages = [message]
+        self.text = ""          # весь полученный текст
+        self._tail = ""         # часть текста, относящаяся к последнему сообщению
+        self._shown = ""        # что сейчас реально показано в последнем сообщении
+        self._next_edit = 0.0
+
+    async def _edit(self, text: str, force: bool = False):
+        if not text.strip() or text == self._shown:
+            return
+        while True:
+            now = time.monotonic()
+            if now < self._next_edit:
+                if not force:
+                    return
+                await asyncio.sleep(self._next_edit - now)
+            try:
+                await self.messages[-1].edit_text(text)
+                self._shown = text
+                self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                return
+            except RetryAfter as e:
+                self._next_edit = time.monotonic() + _retry_after_seconds(e)
+                if not force:
+                    return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self._shown = text
+                    return
+                raise
+
+    async def feed(self, delta: str):
+        self.text += delta
+        self._tail += delta
+        # длину считаем в UTF-16, как Telegram: эмодзи в толкованиях занимают по две единицы
+        while utf16_len(self._tail) > STREAM_MESSAGE_LIMIT:
+            cut = _split_point(self._tail, _utf16_prefix(self._tail, STREAM_MESSAGE_LIMIT))
+            head, self._tail = self._tail[:cut].rstrip(), self._tail[cut:].lstrip()
+            await self._edit(head, force=True)
+            self.messages.append(await self.messages[-1].chat.send_message(self._tail or "…"))
+            self._shown = self._tail or "…"
+            self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        await self._edit(self._tail)
+
+    async def finish(self):
+        await self._edit(self._tail.rstrip(), force=True)
+
+    async def discard(self):
+        for message in self.messages:
+            try:
+                await message.delete()
+            except Exception:
+                pass
+
+
+async def stream_reading_to_message(processing_message, prompt: str, priority: int = PRIORITY_FREE) -> str:
+    """
+    Стримит интерпретацию прямо в processing_message и возвращает полный текст.
+    Пока гадание ждёт в очереди к OpenAI, в том же сообщении показывается позиция.
+    Если поток упал до первого токена — обычный запрос с повторами.
+    При ошибке после начала показа удаляет показанные части и пробрасывает исключение.
+    """
+    ensure_openai_available()
+    async with llm_admission.slot(priority, queue_position_notifier(processing_message)):
+        return await _stream_reading_to_message(processing_message, prompt)
+
+
+async def _stream_reading_to_message(processing_message, prompt: str) -> str:
+    reply = StreamingReply(processing_message)
+
+    async def _run() -> str:
+        if not openai_breaker.allow():
+            raise OpenAIUnavailable("предохранитель OpenAI разомкнут")
+        try:
+            async with aclosing(stream_tarot_reading(prompt)) as deltas:
+                async for delta in deltas:
+                    await reply.feed(delta)
+        except Exception as e:
+            openai_breaker.record_failure()
+            if reply.text:
+                raise
+            logger.error(f"Стрим OpenAI не начался ({e!r}), повторяем обычным запросом")
+            await reply.feed(await _tarot_reading_with_retries(prompt))
+        else:
+            openai_breaker.record_success()
+        if not reply.text.strip():
+            raise RuntimeError("Пустой ответ от API")
+        await reply.finish()
+        return reply.text.strip()
+
+    try:
+        return await asyncio.wait_for(_run(), timeout=OPENAI_DEADLINE)
+    except BaseException:
+        await reply.discard()
+        raise
+
+
+# ====== КЭШ ИНТЕРПРЕТАЦИЙ ГОТОВЫХ РАСКЛАДОВ ======
+# Для готовых раскладов вопрос и позиции фиксированы, значит ответ зависит только
+# от (расклад, карты по порядку). Храним до READING_CACHE_VARIANTS разных текстов
+# на ключ: пока пул не набран — идём в OpenAI, дальше отдаём случайный вариант.
+READING_CACHE_STATS = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+_reading_cache_inserts = 0
+
+
+def reset_reading_choice(user_data: dict):
+    """Начало нового сценария гадания: выбор готового расклада или карты дня из прошлого не переносится."""
+    for key in ('spread_key', 'spread_positions', 'is_card_of_day'):
+        user_data.pop(key, None)
+
+
+def active_spread_key(user_data: dict) -> str | None:
+    """Готовый расклад текущего гадания — только если вопрос ровно его название (для кэша и статистики)."""
+    spread_key = user_data.get('spread_key')
+    spread = READY_SPREADS.get(spread_key)
+    if spread and user_data.get('question') == spread['title']:
+        return spread_key
+    return None
+
+
+def reading_cache_key(spread_key: str | None, cards: list) -> tuple[str, str] | None:
+    """Ключ кэша или None, если расклад не готовый или карты не распознаны."""
+    if not READING_CACHE_ENABLED or spread_key not in READY_SPREADS:
+        return None
+    keys = [normalize_card_key(c) for c in cards]
+    if any(k not in TAROT_DAY_INTERPRETATIONS for k in keys):
+        return None
+    # подпись позиций: если позиции расклада поменяют — старые тексты не подойдут
+    positions = "|".join(READY_SPREADS[spread_key]["positions"])
+    spread_sig = f"{spread_key}#{zlib.crc32(positions.encode()):08x}"
+    return spread_sig, ",".join(keys)
+
+
+def get_cached_reading(key: tuple[str, str]) -> str | None:
+    """Случайный вариант из полного пула или None (промах)."""
+    now = time.time()
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT text FROM reading_cache WHERE spread_key = ? AND cards = ? AND created_at > ?",
+            (key[0], key[1], now - READING_CACHE_TTL)
+        ).fetchall()
+        if len(rows) < READING_CACHE_VARIANTS:
+            READING_CACHE_STATS["misses"] += 1
+            return None
+        conn.execute(
+            "UPDATE reading_cache SET last_used = ? WHERE spread_key = ? AND cards = ?",
+            (now, key[0], key[1])
+        )
+    READING_CACHE_STATS["hits"] += 1
+    return random.choice(rows)["text"]
+
+
+def store_cached_reading(key: tuple[str, str], text: str):
+    """Добавляет вариант в пул ключа (просроченные варианты вытесняются)."""
+    global _reading_cache_inserts
+    now = time.time()
+    with get_db_connection() as conn:
+        conn.execute(
+            "DELETE FROM reading_cache WHERE spread_key = ? AND cards = ? AND created_at <= ?",
+            (key[0], key[1], now - READING_CACHE_TTL)
+        )
+        used = {r["variant"] for r in conn.execute(
+            "SELECT variant FROM reading_cache WHERE spread_key = ? AND cards = ?",
+            (key[0], key[1])
+        ).fetchall()}
+        free = [v for v in range(READING_CACHE_VARIANTS) if v not in used]
+        if not free:
+            return
+        conn.execute(
+            "INSERT OR IGNORE INTO reading_cache(spread_key, cards, variant, text, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key[0], key[1], free[0], text, now, now)
+        )
+    READING_CACHE_STATS["stores"] += 1
+    _reading_cache_inserts += 1
+    if _reading_cache_inserts % 100 == 0:
+        evict_reading_cache()
+
+
+def evict_reading_cache():
+    """TTL + LRU: удаляем просроченное и самые давно не используемые ключи сверх лимита."""
+    now = time.time()
+    with get_db_connection() as conn:
+        removed = conn.execute(
+            "DELETE FROM reading_cache WHERE created_at <= ?", (now - READING_CACHE_TTL,)
+        ).rowcount
+        total_keys = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM reading_cache GROUP BY spread_key, cards)"
+        ).fetchone()[0]
+        excess = total_keys - READING_CACHE_MAX_KEYS
+        if excess > 0:
+            removed += conn.execute("""
+                DELETE FROM reading_cache WHERE (spread_key, cards) IN (
+                    SELECT spread_key, cards FROM reading_cache
+                    GROUP BY spread_key, cards
+                    ORDER BY MAX(last_used)
+                    LIMIT ?
+                )
+            """, (excess,)).rowcount
+    READING_CACHE_STATS["evictions"] += removed
+    if removed:
+        logger.info(f"reading_cache: вытеснено {removed} вариантов")
+
+
+def reading_cache_stats_text() -> str:
+    st = READING_CACHE_STATS
+    lookups = st["hits"] + st["misses"]
+    hit_rate = (100.0 * st["hits"] / lookups) if lookups else 0.0
+    return (
+        f"🗂 Кэш готовых раскладов: попаданий {st['hits']}, промахов {st['misses']} "
+        f"({hit_rate:.1f}% hit), сохранено {st['stores']}, вытеснено {st['evictions']}"
+    )
 
 
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/metrics — счётчики подсистем (только админ)"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    lines = [
+        reading_cache_stats_text(),
+        card_resolver.stats_text(),
+        user_cache.stats_text(),
+        request_log_writer.stats_text(),
+        broadcast_engine.stats_text(),
+        reading_inflight.stats_text(),
+        openai_stats_text(),
+        llm_admission.stats_text(),
+        reading_rate_limiter.stats_text(),
+        outbound.stats_text(),
+        session_store.stats_text(),
+        payment_notify_stats_text(),
+        payment_reconcile_stats_text(),
+        yookassa_gateway.stats_text(),
+        _db_pool.stats_text(),
+    ]
+    if SHARD_INDEX >= 0:
+        lines.append(shard_stats_text())
+    await update.message.reply_text("\n\n".join(lines))
+
+
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/cache_stats — счётчики кэша (только админ)"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    await update.message.reply_text(reading_cache_stats_text())
 
 
 # Валидация
@@ -680,26 +3030,6 @@ def is_valid_cards(cards):
         return False, "Нужно указать ровно 3 карты."
     return True, ""
 
-# Хелпер для отправки длинных сообщений
-async def reply_chunked(message, text: str, **kwargs):
-    """Отправляет длинный текст, разбивая его на части."""
-    limit = 3800  # запас под Markdown/клавиатуру
-    if len(text) <= limit:
-        await message.reply_text(text, **kwargs)
-        return
-
-    # Если есть клавиатура, прикрепляем её только к последнему сообщению
-    keyboard_kwargs = kwargs.copy()
-    kwargs.pop('reply_markup', None)
-    
-    for i in range(0, len(text), limit):
-        chunk = text[i:i+limit]
-        is_last_chunk = (i + limit) >= len(text)
-        
-        current_kwargs = keyboard_kwargs if is_last_chunk else kwargs
-        await message.reply_text(chunk, **current_kwargs)
-
-
 # Обработчики команд
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
@@ -711,56 +3041,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # =========================
     args = context.args
 
-    # возврат из ЮKassa: /start pay_<order_id>
-    from yookassa import Payment
-
     # возврат из YooKassa: /start pay_<order_id>
     if args and args[0].startswith("pay_"):
         order_id = args[0][4:]
         try:
-            with sqlite3.connect('botdata.db', timeout=15) as conn:
-                conn.row_factory = sqlite3.Row
-                conn.execute("PRAGMA journal_mode=WAL;")
-                conn.execute("PRAGMA busy_timeout=15000;")
-
-                pid_row = conn.execute(
-                    "SELECT payment_id FROM payment_links WHERE order_id = ?",
-                    (order_id,)
-                ).fetchone()
+            row = await repo.find_payment_by_order(order_id)
 
-                row = None
-                if pid_row:
-                    payment_id = pid_row["payment_id"]
-                    row = conn.execute(
-                        "SELECT user_id, tariff FROM payments WHERE payment_id = ?",
-                        (payment_id,)
-                    ).fetchone()
-
-            if pid_row and row:
-                p = Payment.find_one(payment_id)
-                status = getattr(p, "status", None)
-                if getattr(p, "paid", False) or status == "succeeded":
-                    activate_subscription(
+            if row:
+                payment_id = row["payment_id"]
+                # уже подтверждён уведомлением/сверкой — в ЮKassa не ходим
+                paid = row["status"] == "succeeded" or is_payment_paid(
+                    await yookassa_gateway.get_payment_cached(payment_id)
+                )
+                if paid:
+                    await repo.activate_subscription(
                         user_id=row["user_id"],
                         tariff_key=row["tariff"],
                         payment_id=payment_id
                     )
 
-                    u = get_user(row["user_id"]) or {}
-
-                    tariff = TARIFFS.get(row["tariff"], {})
-                    added = tariff.get("requests") or tariff.get("days")
-                    kind = "гаданий" if "requests" in tariff else "дней безлимита"
-
-                    info_lines = [
-                        "🎉 Оплата прошла! Доступ активирован.",
-                        f"➕ Начислено: {added} {kind}."
-                    ]
-                    if u:
-                        info_lines.append(
-                            f"📊 Теперь доступно: бесплатных {max(0, MAX_FREE_REQUESTS - (u['request_count'] or 0))}, "
-                            f"платных {u['paid_requests'] or 0}, бонусных {u['bonus_requests'] or 0}."
-                        )
+                    u = await repo.get_user(row["user_id"]) or {}
+                    info_lines = payment_success_lines(u, row["tariff"])
 
                     await update.message.reply_text("\n".join(info_lines), reply_markup=main_keyboard())
                 else:
@@ -773,6 +3074,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "❌ Заказ не найден. Напишите в поддержку.",
                     reply_markup=main_keyboard()
                 )
+        except PaymentGatewayError as e:
+            logger.warning(f"ЮKassa не ответила при возврате order_id={order_id}: {e}")
+            await update.message.reply_text(
+                "⌛ Платёжная система сейчас отвечает медленно. Нажмите ссылку ещё раз через минуту.",
+                reply_markup=main_keyboard()
+            )
         except Exception as e:
             logger.exception(f"Ошибка обработки возврата оплаты order_id={order_id}: {e}")
             await update.message.reply_text(
@@ -795,38 +3102,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             referrer_id = None
 
     # регистрация пользователя
-    register_user(user.id, user.username, user.first_name, user.last_name, referrer_id)
+    await repo.register(user.id, user.username, user.first_name, user.last_name, referrer_id)
 
     # начисление бонуса пригласившему (если пришли по реф-ссылке)
     if referrer_id and referrer_id != user.id:
         try:
-            with get_db_connection() as conn:
-                row = conn.execute(
-                    "SELECT referrer_id FROM users WHERE user_id = ?",
-                    (user.id,)
-                ).fetchone()
+            rewarded = await repo.apply_referral(user.id, referrer_id)
 
-                if row and not row["referrer_id"]:
-                    # привязать реферера к пользователю
-                    conn.execute(
-                        "UPDATE users SET referrer_id = ? WHERE user_id = ?",
-                        (referrer_id, user.id)
-                    )
-                    # начислить бонус пригласившему (+5 можно изменить)
-                    conn.execute(
-                        "UPDATE users SET bonus_requests = COALESCE(bonus_requests, 0) + 5 WHERE user_id = ?",
-                        (referrer_id,)
+            # попытаться уведомить пригласившего
+            if rewarded:
+                try:
+                    await context.bot.send_message(
+                        referrer_id,
+                        "🎉 Ваш друг присоединился к боту! +5 гаданий начислено."
                     )
-                    conn.commit()
-
-                    # попытаться уведомить пригласившего
-                    try:
-                        await context.bot.send_message(
-                            referrer_id,
-                            "🎉 Ваш друг присоединился к боту! +5 гаданий начислено."
-                        )
-                    except Exception:
-                        pass
+                except Exception:
+                    pass
         except Exception as e:
             logger.error(f"Ошибка начисления реферального бонуса: {e}")
 
@@ -837,16 +3128,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown",
     )
 
+_payment_check_times: dict[int, float] = {}
+
+
+def payment_check_cooldown(user_id: int) -> float:
+    """Сколько ещё ждать до следующей проверки (0 — можно, время проверки запоминается)."""
+    now = time.monotonic()
+    wait = _payment_check_times.get(user_id, 0.0) + PAYMENT_CHECK_COOLDOWN - now
+    if wait > 0:
+        return wait
+    _payment_check_times[user_id] = now
+    if len(_payment_check_times) > 10000:
+        for uid, at in list(_payment_check_times.items()):
+            if now - at > PAYMENT_CHECK_COOLDOWN:
+                del _payment_check_times[uid]
+    return 0.0
+
+
 async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     # забираем последний платеж пользователя
-    with get_db_connection() as conn:
-        row = conn.execute(
-            "SELECT last_payment_id FROM users WHERE user_id = ?",
-            (user_id,)
-        ).fetchone()
-    payment_id = row["last_payment_id"] if row else None
+    payment_id = await repo.get_last_payment_id(user_id)
 
     if not payment_id:
         await update.message.reply_text(
@@ -855,36 +3158,45 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # проверяем статус в YooKassa
-    from yookassa import Payment
-    p = Payment.find_one(payment_id)
-    status = getattr(p, "status", None)
-    paid = bool(getattr(p, "paid", False)) or status == "succeeded"
-
-    if not paid:
-        await update.message.reply_text(
-            f"Статус платежа: {status or 'ожидается'}. Попробуйте через минуту.",
-            reply_markup=main_keyboard()
-        )
-        return
-
     # найдём тариф по платежу
-    with get_db_connection() as conn:
-        pay = conn.execute(
-            "SELECT tariff, status FROM payments WHERE payment_id = ?",
-            (payment_id,)
-        ).fetchone()
+    pay = await repo.get_payment(payment_id)
 
-    # если уже активирован — просто покажем текущие данные
+    # если уже активирован — просто покажем текущие данные, без запроса в ЮKassa
     if pay and (pay["status"] == "succeeded"):
-        u = get_user(user_id)
+        u = await repo.get_user(user_id)
         info_lines = ["✔ Оплата уже активирована."]
     else:
+        wait = payment_check_cooldown(user_id)
+        if wait > 0:
+            await update.message.reply_text(
+                f"⏳ Проверяли только что. Повторите через {int(wait) + 1} сек.",
+                reply_markup=main_keyboard()
+            )
+            return
+
+        # проверяем статус в YooKassa
+        try:
+            p = await yookassa_gateway.get_payment_cached(payment_id)
+        except PaymentGatewayError as e:
+            logger.warning(f"ЮKassa не ответила при проверке {payment_id}: {e}")
+            await update.message.reply_text(
+                "⌛ Платёжная система сейчас недоступна. Попробуйте проверить через минуту.",
+                reply_markup=main_keyboard()
+            )
+            return
+
+        if not is_payment_paid(p):
+            await update.message.reply_text(
+                f"Статус платежа: {p.get('status') or 'ожидается'}. Попробуйте через минуту.",
+                reply_markup=main_keyboard()
+            )
+            return
+
         # активируем сейчас
         tariff_key = pay["tariff"] if pay else None
         if tariff_key:
-            activate_subscription(user_id, tariff_key, payment_id)
-        u = get_user(user_id)
+            await repo.activate_subscription(user_id, tariff_key, payment_id)
+        u = await repo.get_user(user_id)
         info_lines = ["🎉 Оплата прошла! Доступ активирован."]
 
     # красивый вывод начисленного
@@ -907,6 +3219,7 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_card_of_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик карты дня"""
+    reset_reading_choice(context.user_data)
     context.user_data['is_card_of_day'] = True
     context.user_data['question'] = 'Карта дня'
 
@@ -921,7 +3234,7 @@ async def handle_card_of_day(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def handle_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик подписки"""
-    user_data = get_user_data(update.effective_user.id)
+    user_data = await repo.get_user_data(update.effective_user.id)
     if not user_data:
         await update.message.reply_text("❌ Ошибка получения данных пользователя.")
         return
@@ -963,6 +3276,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Формулируйте вопросы четко и конкретно
 • Сосредоточьтесь на вопросе при выборе карт
 • Первые 10 гаданий бесплатно
+• /fast — быстрые толкования без ожидания (вкл/выкл)
 
 📞 **Поддержка:** @nik\\_Anna\\_Er
 
@@ -973,7 +3287,745 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
 # Новая функция в tarot_bot.py
-async def process_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, cards: list):
+# ====== ЗАЩИТА ОТ ПОВТОРНЫХ ОТПРАВОК ======
+# Двойное «Подтвердить» в выборе карт или повторная отправка данных из webapp запускали
+# process_cards дважды: два списания и два запроса к OpenAI. Реестр помнит гадание, которое
+# сейчас идёт у пользователя (и недавно завершённое). Апдейты пользователя обрабатываются
+# по очереди (UserOrderedUpdateProcessor), поэтому отправка карт во время идущего гадания
+# разбирается ещё до очереди: такой же расклад присоединяется к нему, другой — отклоняется.
+# Повтор сразу после ответа process_cards встречает уведомлением, а не вторым гаданием.
+INFLIGHT_RECENT_WINDOW = float(os.getenv("INFLIGHT_RECENT_WINDOW", "15"))  # сек после завершения
+INFLIGHT_ATTACH_TIMEOUT = float(os.getenv("INFLIGHT_ATTACH_TIMEOUT", "180"))
+
+
+def reading_fingerprint(cards: list, question: str | None = None, spread_key: str | None = None) -> tuple[str, str]:
+    """
+    Отпечаток отправки: (карты по порядку, расклад + нормализованный вопрос).
+    Вопрос пустой, если его нет в user_data — так приходит повтор после ответа (user_data очищено).
+    """
+    cards_fp = ",".join(normalize_card_key(c) or str(c).strip().casefold() for c in cards)
+    question = " ".join((question or "").casefold().split())
+    if question == "вопрос не указан":
+        question = ""
+    return cards_fp, f"{spread_key}|{question}" if question else ""
+
+
+def submitted_cards(update) -> list | None:
+    """Карты из данных webapp (как их разбирает handle_webapp) или None, если это не отправка карт."""
+    message = update.effective_message
+    web_app_data = getattr(message, "web_app_data", None) if message else None
+    if not web_app_data:
+        return None
+    try:
+        cards = json.loads(web_app_data.data).get("cards")
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(cards, list) or not cards:
+        return None
+    return [card_resolver.resolve(card) or card for card in cards]
+
+
+class ReadingInFlight:
+    """Идущие (и только что завершённые) гадания по user_id."""
+
+    def __init__(self):
+        self._running: dict[int, tuple[str, asyncio.Future]] = {}      # карты, завершение
+        self._recent: dict[int, tuple[tuple[str, str], float]] = {}    # отпечаток, время
+        self.stats = {"started": 0, "attached": 0, "recent": 0, "rejected": 0}
+
+    def is_running(self, user_id: int) -> bool:
+        return user_id in self._running
+
+    def begin(self, user_id: int, fingerprint: tuple[str, str]) -> str:
+        """
+        "new" — гадание зарегистрировано, его нужно выполнить и вызвать finish() или cancel();
+        "recent" — такое же только что завершилось: те же карты и тот же вопрос (или вопроса уже нет).
+        """
+        recent = self._recent.get(user_id)
+        if recent and time.monotonic() - recent[1] < INFLIGHT_RECENT_WINDOW:
+            (cards_fp, question_fp), (recent_cards, recent_question) = fingerprint, recent[0]
+            if cards_fp == recent_cards and question_fp in ("", recent_question):
+                self.stats["recent"] += 1
+                return "recent"
+
+        self._running[user_id] = (fingerprint[0], asyncio.get_running_loop().create_future())
+        self.stats["started"] += 1
+        return "new"
+
+    async def answer_concurrent(self, update, cards: list):
+        """
+        Отправка карт, пока у пользователя идёт гадание (до очереди апдейтов): такие же карты —
+        ждём первое (ответ придёт из него), другие — просим дождаться. Вопрос у обеих отправок
+        общий: user_data не меняется, пока идёт гадание, — сравниваем только карты.
+        """
+        running = self._running.get(update.effective_user.id)
+        if running is None:
+            return
+        if reading_fingerprint(cards)[0] == running[0]:
+            self.stats["attached"] += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(running[1]), timeout=INFLIGHT_ATTACH_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            return
+        self.stats["rejected"] += 1
+        await update.effective_message.reply_text(
+            "⏳ Я ещё расшифровываю ваш предыдущий расклад. Дождитесь ответа и отправьте новый.",
+            reply_markup=main_keyboard()
+        )
+
+    def cancel(self, user_id: int):
+        """Гадание не выдано (лимит, ошибка, возврат) — повтор того же расклада не считается дублем."""
+        running = self._running.pop(user_id, None)
+        if running and not running[1].done():
+            running[1].set_result(None)
+
+    def finish(self, user_id: int, fingerprint: tuple[str, str]):
+        running = self._running.pop(user_id, None)
+        if running and not running[1].done():
+            running[1].set_result(None)
+        now = time.monotonic()
+        self._recent[user_id] = (fingerprint, now)
+        if len(self._recent) > 10000:
+            for uid, (_fp, at) in list(self._recent.items()):
+                if now - at >= INFLIGHT_RECENT_WINDOW:
+                    del self._recent[uid]
+
+    def stats_text(self) -> str:
+        st = self.stats
+        return (
+            "🧷 Повторные отправки\n"
+            f"гаданий начато: {st['started']}, идёт сейчас: {len(self._running)}\n"
+            f"дублей присоединено: {st['attached']}, повторов после ответа: {st['recent']}, "
+            f"отклонено (идёт другое): {st['rejected']}\n"
+            f"лишних списаний и запросов к OpenAI не сделано: {st['attached'] + st['recent']}"
+        )
+
+
+reading_inflight = ReadingInFlight()
+
+
+# ====== ЛИМИТЫ ЧАСТОТЫ ГАДАНИЙ ======
+# Token bucket на пользователя (RATE_USER_BURST гаданий подряд, дальше — RATE_USER_PER_HOUR в час)
+# и общий на бота (защита лимитов OpenAI от одного скрипта или всплеска). Состояние в памяти;
+# при RATE_LIMIT_PERSIST=1 изменённые корзины раз в RATE_LIMIT_FLUSH_INTERVAL пишутся в rate_limits
+# и поднимаются при старте, так что перезапуск не обнуляет лимиты.
+RATE_USER_BURST = float(os.getenv("RATE_USER_BURST", "3"))
+RATE_USER_PER_HOUR = float(os.getenv("RATE_USER_PER_HOUR", "20"))
+RATE_GLOBAL_BURST = float(os.getenv("RATE_GLOBAL_BURST", "60"))
+RATE_GLOBAL_PER_MINUTE = float(os.getenv("RATE_GLOBAL_PER_MINUTE", "120"))
+RATE_LIMIT_PERSIST = os.getenv("RATE_LIMIT_PERSIST", "0") == "1"
+RATE_LIMIT_FLUSH_INTERVAL = float(os.getenv("RATE_LIMIT_FLUSH_INTERVAL", "10"))  # сек
+
+
+class TokenBuckets:
+    """Набор корзин с общими параметрами; время — time.time(), чтобы состояние переживало перезапуск."""
+
+    def __init__(self, name: str, capacity: float, refill_per_sec: float):
+        self.name = name
+        self.capacity = capacity
+        self.rate = refill_per_sec
+        self._state: dict[str, tuple[float, float]] = {}  # key -> (tokens, updated_at)
+        self.dirty: set[str] = set()
+
+    def level(self, key: str, now: float) -> float:
+        tokens, updated_at = self._state.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+
+    def wait_time(self, key: str, now: float) -> float:
+        """0 — жетон есть; иначе сколько секунд до появления жетона."""
+        level = self.level(key, now)
+        if level >= 1.0:
+            return 0.0
+        return (1.0 - level) / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self, key: str, now: float):
+        self._state[key] = (self.level(key, now) - 1.0, now)
+        self.dirty.add(key)
+
+    def restore(self, key: str, tokens: float, updated_at: float):
+        self._state[key] = (tokens, updated_at)
+
+    def take_dirty(self, now: float) -> tuple[list[tuple], list[str]]:
+        """(upserts, deletes) для сохранения; заполненные до краёв корзины забываются совсем."""
+        upserts, deletes = [], []
+        for key in self.dirty:
+            if key not in self._state:
+                continue
+            tokens, updated_at = self._state[key]
+            if self.level(key, now) >= self.capacity:
+                del self._state[key]
+                deletes.append(f"{self.name}:{key}")
+            else:
+                upserts.append((f"{self.name}:{key}", tokens, updated_at))
+        self.dirty.clear()
+        return upserts, deletes
+
+    def prune(self, now: float):
+        for key in [k for k in self._state if k not in self.dirty and self.level(k, now) >= self.capacity]:
+            del self._state[key]
+
+    def __len__(self):
+        return len(self._state)
+
+
+def load_rate_limits() -> list[tuple]:
+    with get_db_connection() as conn:
+        return [tuple(r) for r in conn.execute("SELECT key, tokens, updated_at FROM rate_limits")]
+
+
+def save_rate_limits(upserts: list[tuple], deletes: list[str]):
+    with get_db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO rate_limits(key, tokens, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+            upserts
+        )
+        conn.executemany("DELETE FROM rate_limits WHERE key = ?", [(k,) for k in deletes])
+
+
+class ReadingRateLimiter:
+    """Пользовательский + общий лимит на гадания, уходящие в OpenAI (кэш и быстрые толкования — без лимита)."""
+
+    def __init__(self):
+        self.user = TokenBuckets("user", RATE_USER_BURST, RATE_USER_PER_HOUR / 3600.0)
+        self.total = TokenBuckets("global", worker_share(RATE_GLOBAL_BURST), worker_share(RATE_GLOBAL_PER_MINUTE) / 60.0)
+        # у каждого воркера своя доля общего лимита — и своя строка в rate_limits
+        self._global_key = "all" if SHARD_INDEX < 0 else f"all@{SHARD_INDEX}"
+        self._task: asyncio.Task | None = None
+        self.stats = {"allowed": 0, "limited_user": 0, "limited_global": 0}
+
+    def check(self, user_id: int) -> tuple[str | None, float]:
+        """(None, 0) — можно, жетоны списаны; иначе ("user"|"global", сколько ждать)."""
+        if user_id == ADMIN_ID:
+            return None, 0.0
+        now = time.time()
+        key = str(user_id)
+        wait = self.user.wait_time(key, now)
+        if wait > 0:
+            self.stats["limited_user"] += 1
+            return "user", wait
+        wait = self.total.wait_time(self._global_key, now)
+        if wait > 0:
+            self.stats["limited_global"] += 1
+            return "global", wait
+        self.user.consume(key, now)
+        self.total.consume(self._global_key, now)
+        self.stats["allowed"] += 1
+        return None, 0.0
+
+    async def start(self):
+        if RATE_LIMIT_PERSIST:
+            for full_key, tokens, updated_at in await run_db(load_rate_limits):
+                name, _, key = full_key.partition(":")
+                buckets = self.user if name == "user" else self.total
+                buckets.restore(key, tokens, updated_at)
+        self._task = asyncio.create_task(self._run())
+
+    async def _flush(self):
+        now = time.time()
+        upserts, deletes = [], []
+        for buckets in (self.user, self.total):
+            u, d = buckets.take_dirty(now)
+            upserts += u
+            deletes += d
+            buckets.prune(now)
+        if RATE_LIMIT_PERSIST and (upserts or deletes):
+            try:
+                await run_db(save_rate_limits, upserts, deletes)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения лимитов: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(RATE_LIMIT_FLUSH_INTERVAL)
+            await self._flush()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+
+    def stats_text(self) -> str:
+        st = self.stats
+        return (
+            "🕯 Лимиты гаданий\n"
+            f"пропущено: {st['allowed']}, упёрлись в личный лимит: {st['limited_user']}, "
+            f"в общий: {st['limited_global']}\n"
+            f"корзин в памяти: {len(self.user)}, общий запас: {self.total.level(self._global_key, time.time()):.1f}"
+            f"/{self.total.capacity:.0f}, сохранение: {'вкл' if RATE_LIMIT_PERSIST else 'выкл'}"
+        )
+
+
+reading_rate_limiter = ReadingRateLimiter()
+
+
+def _format_wait(seconds: float) -> str:
+    seconds = int(seconds) + 1
+    if seconds < 60:
+        return f"{seconds} сек"
+    return f"{(seconds + 59) // 60} мин"
+
+
+def rate_limit_message(scope: str, wait: float) -> str:
+    if scope == "global":
+        return (f"🌙 Сейчас карты раскладывают очень многие. "
+                f"Попробуйте через {_format_wait(wait)} — попытка не списана.")
+    return (f"🕯 Картам нужна небольшая пауза между раскладами. "
+            f"Следующий можно сделать через {_format_wait(wait)} — попытка не списана.")
+
+
+# ====== ИСХОДЯЩИЕ СООБЩЕНИЯ ======
+# Все вызовы Bot API идут через OutboundPipeline (rate_limiter приложения), поэтому
+# reply_text из любого обработчика проходит одни и те же правила: в одном чате — строго
+# по очереди, разные чаты — параллельно; общий лимит Telegram (~30 сообщений/сек),
+# лимит на чат (личка — около 1 в секунду с небольшим запасом, группа — 20 в минуту);
+# на RetryAfter чат ставится на паузу, запрос встаёт в очередь чата первым и после паузы
+# заново проходит лимиты, а общий поток притормаживается.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))          # сообщений/сек на бота
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_CHAT_PER_SEC = float(os.getenv("OUTBOUND_CHAT_PER_SEC", "1"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_MAX_RETRY_AFTER = float(os.getenv("OUTBOUND_MAX_RETRY_AFTER", "60"))  # дольше — отдаём ошибку
+TELEGRAM_TEXT_LIMIT = 4096  # в единицах UTF-16, как считает Telegram
+
+# что расходует лимиты сообщений; правки и служебные вызовы только упорядочиваются
+_OUTBOUND_COUNTED = ("send", "copyMessage", "forwardMessage")
+
+
+class _ChatQueue:
+    """
+    Очередь запросов одного чата по номерам. Номер держится до конца запроса, в том числе
+    на время паузы RetryAfter: повтор встаёт в очередь снова, но первым, и никто не обгонит его,
+    при этом ни замок, ни общий лимит на время паузы не заняты.
+    """
+
+    __slots__ = ("turn", "issued", "paused_until", "_waiters", "_abandoned")
+
+    def __init__(self):
+        self.turn = 0            # чей номер сейчас
+        self.issued = 0          # сколько номеров выдано
+        self.paused_until = 0.0  # flood control чата (time.monotonic())
+        self._waiters: dict[int, asyncio.Future] = {}
+        self._abandoned: set[int] = set()
+
+    def take(self) -> int:
+        ticket = self.issued
+        self.issued += 1
+        return ticket
+
+    async def wait_turn(self, ticket: int):
+        if self.turn == ticket:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[ticket] = waiter
+        try:
+            await waiter
+        finally:
+            self._waiters.pop(ticket, None)
+
+    def release(self, ticket: int):
+        """Запрос завершён (или отменён, не дождавшись очереди) — очередь идёт дальше."""
+        if self.turn != ticket:
+            self._abandoned.add(ticket)
+            return
+        self.turn += 1
+        while self.turn in self._abandoned:
+            self._abandoned.discard(self.turn)
+            self.turn += 1
+        waiter = self._waiters.get(self.turn)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    @property
+    def idle(self) -> bool:
+        return self.turn >= self.issued
+
+
+class OutboundPipeline(BaseRateLimiter):
+    """Очерёдность по чатам, лимиты Telegram и повтор на RetryAfter для всех запросов бота."""
+
+    def __init__(self):
+        self.limiter = AsyncRateLimiter(worker_share(OUTBOUND_GLOBAL_RATE))
+        self.private = TokenBuckets("chat", OUTBOUND_CHAT_BURST, OUTBOUND_CHAT_PER_SEC)
+        self.groups = TokenBuckets("group", 1, OUTBOUND_GROUP_PER_MINUTE / 60)
+        self._chats: dict[int | str, _ChatQueue] = {}
+        self.queue_delay = LatencyHistogram()
+        self.stats = {"delivered": 0, "edited": 0, "retry_after": 0, "failed": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    async def _chat_token(self, chat_id):
+        buckets = self.groups if isinstance(chat_id, str) or int(chat_id) < 0 else self.private
+        key = str(chat_id)
+        if len(buckets) > 10000:
+            buckets.prune(time.time())
+        while True:
+            now = time.time()
+            wait = buckets.wait_time(key, now)
+            if wait <= 0:
+                buckets.consume(key, now)
+                buckets.dirty.discard(key)  # в БД не сохраняем
+                return
+            await asyncio.sleep(wait)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or endpoint.startswith("get"):
+            return await callback(*args, **kwargs)
+
+        queued_at = time.monotonic()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue()
+        ticket = chat.take()
+        counted = endpoint.startswith(_OUTBOUND_COUNTED)
+        try:
+            for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+                await chat.wait_turn(ticket)
+                pause = chat.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                # после паузы повтор заново проходит лимит чата и общий лимит
+                if counted:
+                    await self._chat_token(chat_id)
+                if counted or endpoint.startswith("edit"):
+                    await self.limiter.acquire()
+                if not attempt:
+                    self.queue_delay.observe(time.monotonic() - queued_at)
+                try:
+                    result = await callback(*args, **kwargs)
+                    break
+                except RetryAfter as e:
+                    self.stats["retry_after"] += 1
+                    wait = _retry_after_seconds(e)
+                    if attempt == OUTBOUND_MAX_RETRIES or wait > OUTBOUND_MAX_RETRY_AFTER:
+                        self.stats["failed"] += 1
+                        raise
+                    logger.warning(f"Flood control в чате {chat_id} ({endpoint}): пауза {wait:.0f} с")
+                    # пауза — на весь чат (его очередь стоит), остальным чатам — в общем лимите
+                    chat.paused_until = max(chat.paused_until, time.monotonic() + wait)
+                    self.limiter.pause(wait)
+                except Exception:
+                    self.stats["failed"] += 1
+                    raise
+        finally:
+            chat.release(ticket)
+            if chat.idle and self._chats.get(chat_id) is chat:
+                del self._chats[chat_id]
+
+        if counted:
+            self.stats["delivered"] += 1
+        elif endpoint.startswith("edit"):
+            self.stats["edited"] += 1
+        return result
+
+    def stats_text(self) -> str:
+        st = self.stats
+        now = time.monotonic()
+        paused = sum(1 for chat in self._chats.values() if chat.paused_until > now)
+        return (
+            "📤 Исходящие сообщения\n"
+            f"доставлено: {st['delivered']}, правок: {st['edited']}, RetryAfter: {st['retry_after']}, "
+            f"ошибок: {st['failed']}; чатов с очередью: {len(self._chats)}, на паузе: {paused}\n"
+            f"ожидание в очереди: {self.queue_delay.text()}"
+        )
+
+
+outbound = OutboundPipeline()
+
+
+def utf16_len(text: str) -> int:
+    """Длина так, как её считает Telegram: символы вне BMP (эмодзи) занимают две единицы."""
+    return len(text) if text.isascii() else len(text.encode("utf-16-le")) // 2
+
+
+def _utf16_prefix(text: str, limit: int) -> int:
+    """Сколько символов с начала text умещается в limit единиц UTF-16."""
+    if utf16_len(text) <= limit:
+        return len(text)
+    units = 0
+    for i, ch in enumerate(text):
+        units += 2 if ord(ch) > 0xFFFF else 1
+        if units > limit:
+            return i
+    return len(text)
+
+
+def split_message(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> list[str]:
+    """Делит текст на части не длиннее limit (UTF-16) по абзацам, строкам, предложениям, словам."""
+    parts = []
+    text = text.strip()
+    while utf16_len(text) > limit:
+        cut = _split_point(text, _utf16_prefix(text, limit))
+        head, text = text[:cut].rstrip(), text[cut:].lstrip()
+        if head:
+            parts.append(head)
+    if text:
+        parts.append(text)
+    return parts
+
+
+# Хелпер для отправки длинных сообщений
+async def reply_chunked(message, text: str, **kwargs):
+    """Отправляет длинный текст частями; клавиатура — только у последней."""
+    chunks = split_message(text)
+    reply_markup = kwargs.pop('reply_markup', None)
+    for i, chunk in enumerate(chunks):
+        if i == len(chunks) - 1:
+            kwargs['reply_markup'] = reply_markup
+        await message.reply_text(chunk, **kwargs)
+
+
+# ====== СОХРАНЕНИЕ СОСТОЯНИЯ ДИАЛОГОВ ======
+# context.user_data (шаг сценария, вопрос, позиции расклада) хранится в таблице user_sessions,
+# чтобы редеплой или сон сервиса не обрывал начатое гадание. При старте ничего не читается:
+# состояние пользователя подтягивается при его первом апдейте. Изменения копятся и пишутся
+# одной транзакцией раз в SESSION_FLUSH_INTERVAL; сессии без активности дольше
+# SESSION_IDLE_TTL удаляются и из памяти, и из БД.
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))      # сек
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(24 * 3600)))       # сек
+SESSION_PURGE_INTERVAL = float(os.getenv("SESSION_PURGE_INTERVAL", "900"))    # сек
+
+
+def load_user_session(user_id: int) -> dict:
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT data FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+    return json.loads(row["data"]) if row else {}
+
+
+def save_user_sessions(pending: dict[int, str | None], now: float):
+    """pending: user_id -> JSON состояния; None — удалить сессию."""
+    upserts = [(uid, data, now) for uid, data in pending.items() if data is not None]
+    deletes = [(uid,) for uid, data in pending.items() if data is None]
+    with get_db_transaction() as conn:
+        conn.executemany(
+            "INSERT INTO user_sessions(user_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            upserts
+        )
+        conn.executemany("DELETE FROM user_sessions WHERE user_id = ?", deletes)
+
+
+def purge_stale_sessions(cutoff: float) -> int:
+    with get_db_transaction() as conn:
+        return conn.execute("DELETE FROM user_sessions WHERE updated_at < ?", (cutoff,)).rowcount
+
+
+def _session_json(data: dict) -> str | None:
+    """Состояние в JSON; несериализуемые значения пропускаем, пустое — None."""
+    if not data:
+        return None
+    try:
+        return json.dumps(data, ensure_ascii=False)
+    except (TypeError, ValueError):
+        clean = {}
+        for key, value in data.items():
+            try:
+                json.dumps({key: value})
+            except (TypeError, ValueError):
+                continue
+            clean[key] = value
+        return json.dumps(clean, ensure_ascii=False) if clean else None
+
+
+class SQLiteSessionPersistence(BasePersistence):
+    """Persistence PTB только для user_data: ленивая загрузка и отложенная пакетная запись."""
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=SESSION_FLUSH_INTERVAL,
+        )
+        self._pending: dict[int, str | None] = {}
+        self._loaded: set[int] = set()
+        self._loading: dict[int, asyncio.Future] = {}
+        self.last_seen: dict[int, float] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"restored": 0, "loads": 0, "written": 0, "deleted": 0, "batches": 0, "purged": 0, "errors": 0}
+
+    # --- загрузка: при старте ничего, дальше по одному пользователю ---
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self.last_seen[user_id] = time.time()
+        if user_id in self._loaded:
+            return
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._hydrate(user_id, user_data))
+            self._loading[user_id] = task
+        await task
+
+    async def _hydrate(self, user_id: int, user_data: dict):
+        try:
+            self.stats["loads"] += 1
+            data = await run_db(load_user_session, user_id)
+            if data and not user_data:
+                user_data.update(data)
+                self.stats["restored"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Не удалось загрузить состояние пользователя {user_id}: {e}")
+        finally:
+            self._loaded.add(user_id)
+            self._loading.pop(user_id, None)
+
+    # --- запись: Application вызывает раз в update_interval для изменившихся пользователей ---
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending[user_id] = _session_json(data)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending[user_id] = None
+        self._loaded.discard(user_id)
+        self.last_seen.pop(user_id, None)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # вызовы одного прохода update_persistence идут через gather — задача соберёт их все
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            try:
+                await run_db(save_user_sessions, pending, time.time())
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Не удалось сохранить состояния {len(pending)} пользователей: {e}")
+                # более свежие изменения, пришедшие за время записи, не затираем
+                for uid, data in pending.items():
+                    self._pending.setdefault(uid, data)
+                return
+            self.stats["batches"] += 1
+            self.stats["written"] += sum(1 for d in pending.values() if d is not None)
+            self.stats["deleted"] += sum(1 for d in pending.values() if d is None)
+
+    def idle_users(self, cutoff: float) -> list[int]:
+        return [uid for uid, seen in self.last_seen.items() if seen < cutoff]
+
+    # --- остальное бот не хранит ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    def stats_text(self) -> str:
+        st = self.stats
+        return (
+            "💾 Состояния диалогов\n"
+            f"в памяти: {len(self.last_seen)}, ждут записи: {len(self._pending)}; "
+            f"загрузок: {st['loads']}, восстановлено: {st['restored']}\n"
+            f"записано: {st['written']}, удалено: {st['deleted']} за {st['batches']} пачек; "
+            f"очищено простаивающих: {st['purged']}, ошибок: {st['errors']}"
+        )
+
+
+session_store = SQLiteSessionPersistence()
+
+
+async def purge_idle_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Задача job_queue: забываем сессии без активности дольше SESSION_IDLE_TTL."""
+    store = context.application.persistence
+    if not isinstance(store, SQLiteSessionPersistence):
+        return
+    cutoff = time.time() - SESSION_IDLE_TTL
+    idle = store.idle_users(cutoff)
+    for user_id in idle:
+        context.application.drop_user_data(user_id)
+    try:
+        purged = await run_db(purge_stale_sessions, cutoff)
+    except Exception as e:
+        logger.error(f"Ошибка очистки сессий: {e}")
+        return
+    store.stats["purged"] += len(idle) + purged
+    if idle or purged:
+        logger.info(f"Очищено простаивающих сессий: в памяти {len(idle)}, в БД {purged}")
+
+
+# Итоги _process_cards
+READING_DELIVERED = "delivered"
+READING_FAILED = "failed"    # отказ, ошибка или возврат попытки
+READING_LIMITED = "limited"  # отказ по лимиту частоты: вопрос и расклад сохраняются для повтора
+
+
+async def process_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, cards: list) -> bool:
+    """
+    Гадание по выбранным картам; повторная отправка того же расклада не запускает его второй раз.
+    True — состояние диалога нужно сохранить (вызывающий не очищает user_data).
+    """
+    user = update.effective_user
+    fingerprint = reading_fingerprint(
+        cards, context.user_data.get('question'), active_spread_key(context.user_data)
+    )
+    # одновременные отправки разбирает UserOrderedUpdateProcessor (answer_concurrent) до очереди
+    if reading_inflight.begin(user.id, fingerprint) == "recent":
+        await update.message.reply_text(
+            "✅ Этот расклад я уже расшифровал — ответ выше. "
+            "Чтобы погадать ещё раз, выберите карты заново.",
+            reply_markup=main_keyboard()
+        )
+        return False
+
+    outcome = READING_FAILED
+    try:
+        outcome = await _process_cards(update, context, cards)
+    finally:
+        # «повтором» считаем только отправку после выданного толкования: после ошибки,
+        # возврата попытки или отказа тот же расклад можно отправить снова
+        if outcome == READING_DELIVERED:
+            reading_inflight.finish(user.id, fingerprint)
+        else:
+            reading_inflight.cancel(user.id)
+    return outcome == READING_LIMITED
+
+
+async def _process_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, cards: list) -> str:
+    """Итог гадания: READING_DELIVERED — толкование выдано и попытка списана."""
     user = update.effective_user
 
     # 1) Валидация карт
@@ -981,7 +4033,7 @@ async def process_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, card
     if not is_valid:
         await update.message.reply_text(f"❌ {error_message}", reply_markup=main_keyboard())
         context.user_data.clear()
-        return
+        return READING_FAILED
 
     # 2) Списываем попытку и получаем "чек"
     bucket = await deduct_user_request(user.id)
@@ -990,45 +4042,92 @@ async def process_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, card
             "❌ У вас закончились бесплатные гадания!\n\nВыберите вариант пополнения или оформите безлимит ⬇️",
             reply_markup=subscription_keyboard()
         )
-        return
+        return READING_FAILED
 
     # 3) Сообщение о процессе
     processing_message = await update.message.reply_text("🔮 Расшифровываю карты...")
 
-    try:
-        # 4) Собираем вопрос и позиции расклада (если выбран готовый расклад)
-        question = context.user_data.get('question') or "Вопрос не указан"
-        spread_positions = context.user_data.get('spread_positions')
+    # 4) Собираем вопрос и позиции расклада (если выбран готовый расклад)
+    keep_session = False  # после отказа по лимиту вопрос и расклад остаются для повтора
+    question = context.user_data.get('question') or "Вопрос не указан"
+    spread_positions = context.user_data.get('spread_positions')
 
+    try:
+        # в промпт — русские названия, а не ключи колоды
+        card_names = [card_resolver.display_name(card) for card in cards]
         if spread_positions:
             position_descriptions = [
-                f"{i}. {pos}: {card}" for i, (pos, card) in enumerate(zip(spread_positions, cards), 1)
+                f"{i}. {pos}: {card}" for i, (pos, card) in enumerate(zip(spread_positions, card_names), 1)
             ]
             prompt = (
                 f"Вопрос: {question}\n"
-                f"Карты: {', '.join(cards)}.\n"
+                f"Карты: {', '.join(card_names)}.\n"
                 f"Позиции: {'; '.join(position_descriptions)}.\n"
                 f"Дай детальную интерпретацию расклада."
             )
         else:
             position_descriptions = [
-                f"1. Первая карта: {cards[0]}",
-                f"2. Вторая карта: {cards[1]}",
-                f"3. Третья карта: {cards[2]}",
+                f"1. Первая карта: {card_names[0]}",
+                f"2. Вторая карта: {card_names[1]}",
+                f"3. Третья карта: {card_names[2]}",
             ]
             prompt = (
                 f"Вопрос: {question}\n"
-                f"Карты: {', '.join(cards)}.\n"
+                f"Карты: {', '.join(card_names)}.\n"
                 f"Позиции: {'; '.join(position_descriptions)}.\n"
                 f"Дай детальную интерпретацию расклада."
             )
 
 
-        interpretation = await get_tarot_reading(prompt)
+        # Быстрый режим — толкование из локального корпуса, без API
+        interpretation = None
+        if await wants_local_reading(user.id, bucket):
+            interpretation = assemble_local_reading(question, cards, spread_positions)
+
+        # Готовый расклад с уже набранным пулом вариантов — отвечаем из кэша
+        spread_key = active_spread_key(context.user_data)
+        cache_key = reading_cache_key(spread_key, cards)
+        if interpretation is None and cache_key:
+            interpretation = await run_db(get_cached_reading, cache_key)
+
+        # Лимит частоты — только на то, что действительно уйдёт в OpenAI
+        if interpretation is None:
+            scope, wait = reading_rate_limiter.check(user.id)
+            if scope:
+                keep_session = True
+                try:
+                    await refund_user_request(user.id, bucket)
+                except Exception as refund_err:
+                    logger.error(f"Ошибка рефанда: {refund_err}")
+                try:
+                    await processing_message.delete()
+                except Exception:
+                    pass
+                await update.message.reply_text(rate_limit_message(scope, wait), reply_markup=main_keyboard())
+                return READING_LIMITED
+
+        if interpretation is None and OPENAI_STREAMING:
+            # Текст появляется прямо в сообщении о процессе; клавиатуру меню
+            # нельзя прикрепить правкой, поэтому блок консультации — отдельным сообщением
+            interpretation = await stream_reading_to_message(
+                processing_message, prompt, READING_PRIORITY.get(bucket, PRIORITY_FREE)
+            )
+            if cache_key:
+                await run_db(store_cached_reading, cache_key, interpretation)
+            log_request(user.id, user.username, question, cards, spread_key)
+            await update.message.reply_text(CONSULTATION_BLOCK, reply_markup=main_keyboard())
+            return READING_DELIVERED
+
+        if interpretation is None:
+            interpretation = await get_tarot_reading(
+                prompt, READING_PRIORITY.get(bucket, PRIORITY_FREE), queue_position_notifier(processing_message)
+            )
+            if cache_key:
+                await run_db(store_cached_reading, cache_key, interpretation)
         final_text = f"{interpretation}\n\n{CONSULTATION_BLOCK}"
 
         # Логируем запрос
-        log_request(user.id, user.username, question, cards)
+        log_request(user.id, user.username, question, cards, spread_key)
 
         # Удаляем сообщение о процессе (если уже не существует — молчим)
         try:
@@ -1036,8 +4135,9 @@ async def process_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, card
         except Exception:
             pass
 
-        # Отправляем результат
-        await update.message.reply_text(final_text, reply_markup=main_keyboard())
+        # Отправляем результат (длинный — частями по абзацам)
+        await reply_chunked(update.message, final_text, reply_markup=main_keyboard())
+        return READING_DELIVERED
 
     except Exception as e:
         logger.error(f"Ошибка получения интерпретации: {e}")
@@ -1053,13 +4153,32 @@ async def process_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, card
             await processing_message.delete()
         except Exception:
             pass
+
+        # OpenAI недоступен или перегружен — отдаём толкование из локального корпуса (попытка уже возвращена)
+        fallback = assemble_local_reading(question, cards, spread_positions) if LOCAL_READING_FALLBACK else None
+        if fallback:
+            reason = (
+                "Сейчас очень много желающих получить подробное толкование"
+                if isinstance(e, AdmissionRejected) else
+                "Сервис подробных толкований сейчас недоступен"
+            )
+            await update.message.reply_text(
+                f"⚡ {reason}, поэтому вот быстрое толкование "
+                "по значениям карт. Попытка не списана.\n\n"
+                f"{fallback}\n\n{CONSULTATION_BLOCK}",
+                reply_markup=main_keyboard()
+            )
+            return READING_FAILED
+
         await update.message.reply_text(
             "❌ Произошла ошибка при расшифровке карт. Ваш запрос был возвращён.\n\n"
             f"Попробуйте позже или обратитесь в поддержку с кодом: {error_code}",
             reply_markup=main_keyboard()
         )
+        return READING_FAILED
     finally:
-        context.user_data.clear()
+        if not keep_session:
+            context.user_data.clear()
 
     
 async def process_card_of_day(update: Update, context: ContextTypes.DEFAULT_TYPE, card: str):
@@ -1084,7 +4203,7 @@ async def process_card_of_day(update: Update, context: ContextTypes.DEFAULT_TYPE
             pass
 
         await update.message.reply_text(text, reply_markup=main_keyboard())
-        log_request(user.id, user.username, "Карта дня", [card])
+        log_request(user.id, user.username, "Карта дня", [card], "card_of_day")
 
     except Exception as e:
         logger.error(f"Ошибка карты дня: {e}")
@@ -1117,17 +4236,20 @@ async def handle_webapp(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.clear()
         return
 
+    keep_session = False  # отказ по лимиту: вопрос и расклад остаются для повторной отправки
     try:
         cards = data.get('cards', [])
+        if isinstance(cards, list):
+            cards = [card_resolver.resolve(card) or card for card in cards]
         if not cards:
             await update.message.reply_text("❌ Ошибка получения данных карт. Попробуйте ещё раз.", reply_markup=main_keyboard())
             return
 
         user = update.effective_user
-        user_db_data = get_user_data(user.id)
+        user_db_data = await repo.get_user_data(user.id)
         if not user_db_data:
-            register_user(user.id, user.username, user.first_name, user.last_name)
-            user_db_data = get_user_data(user.id)
+            await repo.register(user.id, user.username, user.first_name, user.last_name)
+            user_db_data = await repo.get_user_data(user.id)
 
         # реальный бан — только если флаг в БД
         if user_db_data.get('is_banned'):
@@ -1137,13 +4259,14 @@ async def handle_webapp(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if context.user_data.get('is_card_of_day'):
             await process_card_of_day(update, context, cards[0])
         else:
-            await process_cards(update, context, cards)
+            keep_session = await process_cards(update, context, cards)
 
     except Exception as e:
         logger.error(f"Ошибка обработки WebApp: {e}")
         await update.message.reply_text("❌ Произошла ошибка при обработке данных.", reply_markup=main_keyboard())
     finally:
-        context.user_data.clear()
+        if not keep_session:
+            context.user_data.clear()
 
 
 
@@ -1239,8 +4362,10 @@ async def handle_ready_spread(update: Update, context: ContextTypes.DEFAULT_TYPE
     spread = READY_SPREADS[spread_key]
 
     # Сохраняем название расклада как вопрос + позиции отдельно
+    reset_reading_choice(context.user_data)
     context.user_data['question'] = spread['title']
     context.user_data['spread_positions'] = spread['positions']
+    context.user_data['spread_key'] = spread_key
     context.user_data['state'] = 'awaiting_cards'
 
     logger.info(f"СОХРАНИЛИ в context.user_data: {dict(context.user_data)}")
@@ -1349,6 +4474,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "📝 Напишите ваш вопрос:",
             parse_mode='Markdown'
         )
+        reset_reading_choice(context.user_data)
         context.user_data['state'] = 'awaiting_question'
         return
     
@@ -1365,6 +4491,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.clear()
             return
 
+        # Приводим к ключам колоды: тогда работают кэш, дедупликация и локальные толкования
+        keys = [card_resolver.resolve(card) for card in cards]
+        unknown = [card for card, key in zip(cards, keys) if not key]
+        if unknown:
+            await update.message.reply_text(
+                f"❌ Не узнаю карту: {', '.join(unknown)}. Проверьте написание и введите три карты ещё раз.\n"
+                "Пример: Двойка кубков, Четверка мечей, Императрица"
+            )
+            return
+        cards = keys
+
         # Эта часть кода почти такая же, как при выборе карт через WebApp
         await process_cards(update, context, cards)
         return
@@ -1380,6 +4517,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ {error_message}")
             return
         
+        reset_reading_choice(context.user_data)
         context.user_data['question'] = text
         context.user_data['state'] = 'awaiting_cards'
         
@@ -1440,6 +4578,55 @@ def _ensure_user_exists(user_id: int):
     if not get_user(user_id):
         register_user(user_id)
 
+
+def add_paid_requests(user_id: int, amount: int):
+    _ensure_user_exists(user_id)
+    with user_mutation(user_id) as conn:
+        conn.execute(
+            "UPDATE users SET paid_requests = COALESCE(paid_requests,0) + ? WHERE user_id = ?",
+            (amount, user_id)
+        )
+
+
+def add_bonus_requests(user_id: int, amount: int):
+    _ensure_user_exists(user_id)
+    with user_mutation(user_id) as conn:
+        conn.execute(
+            "UPDATE users SET bonus_requests = COALESCE(bonus_requests,0) + ? WHERE user_id = ?",
+            (amount, user_id)
+        )
+
+
+def reset_free_requests(user_id: int):
+    _ensure_user_exists(user_id)
+    with user_mutation(user_id) as conn:
+        conn.execute("UPDATE users SET request_count = 0 WHERE user_id = ?", (user_id,))
+
+
+def extend_subscription(user_id: int, days: int) -> datetime:
+    """Включает/продлевает подписку от текущего конца (если активна) и возвращает новый конец."""
+    _ensure_user_exists(user_id)
+    # читаем текущий конец подписки
+    user = get_user(user_id)
+    now = datetime.now()
+    base = now
+    try:
+        if user and user['subscription_end']:
+            current_end = datetime.strptime(user['subscription_end'], '%Y-%m-%d %H:%M:%S')
+            # если подписка ещё активна — продлеваем от текущего конца
+            if current_end > now:
+                base = current_end
+    except Exception:
+        pass
+
+    new_end = base + timedelta(days=days)
+    with user_mutation(user_id) as conn:
+        conn.execute(
+            "UPDATE users SET is_subscribed = 1, subscription_end = ? WHERE user_id = ?",
+            (new_end.strftime('%Y-%m-%d %H:%M:%S'), user_id)
+        )
+    return new_end
+
 async def _admin_guard(update: Update) -> bool:
     """Проверяем, что команду вызвал админ"""
     uid = update.effective_user.id if update.effective_user else 0
@@ -1466,12 +4653,7 @@ async def add_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Формат: /add_paid <user_id> <сколько>  (например: /add_paid 123456789 10)")
         return
 
-    _ensure_user_exists(target_id)
-    with get_db_connection() as conn:
-        conn.execute(
-            "UPDATE users SET paid_requests = COALESCE(paid_requests,0) + ? WHERE user_id = ?",
-            (amount, target_id)
-        )
+    await repo.add_paid(target_id, amount)
     await update.message.reply_text(f"✅ Начислено {amount} платных гаданий пользователю {target_id}.")
 
 async def add_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1489,12 +4671,7 @@ async def add_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Формат: /add_bonus <user_id> <сколько>  (например: /add_bonus 123456789 5)")
         return
 
-    _ensure_user_exists(target_id)
-    with get_db_connection() as conn:
-        conn.execute(
-            "UPDATE users SET bonus_requests = COALESCE(bonus_requests,0) + ? WHERE user_id = ?",
-            (amount, target_id)
-        )
+    await repo.add_bonus(target_id, amount)
     await update.message.reply_text(f"✅ Начислено {amount} бонусных гаданий пользователю {target_id}.")
 
 async def reset_free(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1510,9 +4687,7 @@ async def reset_free(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Формат: /reset_free <user_id>  (например: /reset_free 123456789)")
         return
 
-    _ensure_user_exists(target_id)
-    with get_db_connection() as conn:
-        conn.execute("UPDATE users SET request_count = 0 WHERE user_id = ?", (target_id,))
+    await repo.reset_free(target_id)
     await update.message.reply_text(f"✅ Бесплатные гадания сброшены пользователю {target_id} (снова доступно {MAX_FREE_REQUESTS}).")
 
 async def add_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1530,26 +4705,7 @@ async def add_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Формат: /add_sub <user_id> <дней>  (например: /add_sub 123456789 7)")
         return
 
-    _ensure_user_exists(target_id)
-    # читаем текущий конец подписки
-    user = get_user(target_id)
-    now = datetime.now()
-    base = now
-    try:
-        if user and user['subscription_end']:
-            current_end = datetime.strptime(user['subscription_end'], '%Y-%m-%d %H:%M:%S')
-            # если подписка ещё активна — продлеваем от текущего конца
-            if current_end > now:
-                base = current_end
-    except Exception:
-        pass
-
-    new_end = base + timedelta(days=days)
-    with get_db_connection() as conn:
-        conn.execute(
-            "UPDATE users SET is_subscribed = 1, subscription_end = ? WHERE user_id = ?",
-            (new_end.strftime('%Y-%m-%d %H:%M:%S'), target_id)
-        )
+    new_end = await repo.extend_subscription(target_id, days)
     await update.message.reply_text(
         f"✅ Подписка пользователю {target_id} продлена/выдана до {new_end.strftime('%d.%m.%Y %H:%M')}."
     )
@@ -1558,7 +4714,7 @@ async def add_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_sub_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    u = get_user(user.id)
+    u = await repo.get_user(user.id)
     already = (u['got_secretlovemagic'] if u else 0)
     if already:
         await update.message.reply_text("✅ Бонус уже начислялся ранее.")
@@ -1589,12 +4745,20 @@ async def is_user_subscribed_to_channel(bot, user_id: int) -> bool | None:
         logger.error(f"get_chat_member failed for {chat_ref}, user {user_id}: {e}")
         return None
 
+def grant_channel_bonus(user_id: int):
+    with user_mutation(user_id) as conn:
+        conn.execute(
+            "UPDATE users SET bonus_requests = COALESCE(bonus_requests,0) + ?, got_secretlovemagic = 1 WHERE user_id = ?",
+            (SUB_BONUS_AMOUNT, user_id)
+        )
+
+
 async def check_sub_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Проверка и единоразовое начисление бонуса"""
     query = update.callback_query
     user_id = update.effective_user.id
 
-    u = get_user(user_id)
+    u = await repo.get_user(user_id)
     if u and (u['got_secretlovemagic'] or 0) == 1:
         await query.answer("Бонус уже был начислён ранее.", show_alert=True)
         return
@@ -1608,13 +4772,186 @@ async def check_sub_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # подписан → начисляем один раз
-    with get_db_connection() as conn:
+    await repo.grant_channel_bonus(user_id)
+
+    await query.edit_message_text(f"✅ Подписка подтверждена! Начислено +{SUB_BONUS_AMOUNT} бонусных гаданий. Спасибо!")
+
+
+# ====== ШЛЮЗ ЮKASSA (ASYNC) ======
+# Синхронный SDK блокировал цикл событий и не имел явного таймаута. Здесь — прямые REST-вызовы
+# через общий httpx.AsyncClient (keep-alive), у каждой операции свой дедлайн, а автомат-предохранитель
+# после серии сбоев сразу отвечает «недоступно», не дожидаясь таймаутов.
+YOOKASSA_CREATE_DEADLINE = float(os.getenv("YOOKASSA_CREATE_DEADLINE", "10"))  # сек на создание платежа
+YOOKASSA_FIND_DEADLINE = float(os.getenv("YOOKASSA_FIND_DEADLINE", "5"))       # сек на чтение статуса
+YOOKASSA_POOL_SIZE = int(os.getenv("YOOKASSA_POOL_SIZE", "10"))
+YOOKASSA_BREAKER_FAILURES = int(os.getenv("YOOKASSA_BREAKER_FAILURES", "5"))     # сбоев подряд до размыкания
+YOOKASSA_BREAKER_RESET = float(os.getenv("YOOKASSA_BREAKER_RESET", "30"))        # сек до пробного запроса
+# Статусы платежей: одновременные проверки одного платежа делят один запрос, незавершённые статусы
+# живут в кэше PAYMENT_STATUS_TTL, финальные (succeeded/canceled) — пока не вытеснятся по размеру.
+PAYMENT_STATUS_TTL = float(os.getenv("PAYMENT_STATUS_TTL", "5"))                 # сек
+PAYMENT_STATUS_CACHE_SIZE = int(os.getenv("PAYMENT_STATUS_CACHE_SIZE", "10000"))
+PAYMENT_CHECK_COOLDOWN = float(os.getenv("PAYMENT_CHECK_COOLDOWN", "10"))         # сек между «Проверить оплату»
+PAYMENT_FINAL_STATUSES = ("succeeded", "canceled")
+
+
+class PaymentGatewayError(Exception):
+    """Ошибка ЮKassa (ответ 4xx/5xx, таймаут, сеть)."""
+
+
+class PaymentGatewayUnavailable(PaymentGatewayError):
+    """Предохранитель разомкнут — ЮKassa считается недоступной, запрос не отправлялся."""
+
+
+class YooKassaGateway:
+    """Асинхронный клиент ЮKassa API v3: create_payment / get_payment (ответы — dict из JSON)."""
+
+    def __init__(self):
+        self._client: httpx.AsyncClient | None = None
+        self.breaker = CircuitBreaker("ЮKassa", YOOKASSA_BREAKER_FAILURES, YOOKASSA_BREAKER_RESET)
+        self.latency: dict[str, LatencyHistogram] = {}
+        self.errors: Counter = Counter()
+        self._status_cache: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.status_stats: Counter = Counter()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=Configuration.api_url.rstrip("/") + "/",
+                auth=(str(Configuration.account_id or ""), Configuration.secret_key or ""),
+                timeout=httpx.Timeout(max(YOOKASSA_CREATE_DEADLINE, YOOKASSA_FIND_DEADLINE), connect=5.0),
+                limits=httpx.Limits(max_connections=YOOKASSA_POOL_SIZE, max_keepalive_connections=YOOKASSA_POOL_SIZE),
+            )
+        return self._client
+
+    async def _call(self, op: str, method: str, path: str, deadline: float, **kwargs) -> dict:
+        if not self.breaker.allow():
+            self.errors[f"{op}:breaker_open"] += 1
+            raise PaymentGatewayUnavailable(f"ЮKassa недоступна ({op})")
+
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self._request(method, path, deadline, **kwargs), timeout=deadline)
+        except (asyncio.TimeoutError, httpx.HTTPError) as e:
+            self.breaker.record_failure()
+            self.errors[f"{op}:{type(e).__name__}"] += 1
+            raise PaymentGatewayError(f"ЮKassa {op}: {type(e).__name__}") from e
+        finally:
+            self.latency.setdefault(op, LatencyHistogram()).observe(time.perf_counter() - started)
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            self.errors[f"{op}:{response.status_code}"] += 1
+            raise PaymentGatewayError(f"ЮKassa {op}: HTTP {response.status_code}")
+        # 4xx — ошибка запроса, а не признак недоступности сервиса
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            self.errors[f"{op}:{response.status_code}"] += 1
+            raise PaymentGatewayError(f"ЮKassa {op}: HTTP {response.status_code} {response.text[:200]}")
+        return response.json()
+
+    async def _request(self, method: str, path: str, deadline: float, **kwargs) -> httpx.Response:
+        """202 = «ещё обрабатывается»: повторяем через retry_after, пока не истёк дедлайн (его держит _call)."""
+        while True:
+            response = await self._get_client().request(method, path, **kwargs)
+            if response.status_code != 202:
+                return response
+            try:
+                retry_ms = float(response.json().get("retry_after", 1000))
+            except ValueError:
+                retry_ms = 1000.0
+            await asyncio.sleep(min(retry_ms / 1000.0, deadline))
+
+    async def create_payment(self, payload: dict, idempotency_key: str) -> dict:
+        return await self._call(
+            "create", "POST", "payments", YOOKASSA_CREATE_DEADLINE,
+            json=payload, headers={"Idempotence-Key": idempotency_key},
+        )
+
+    async def get_payment(self, payment_id: str) -> dict:
+        """Всегда свежий статус из API (уведомления, сверка); ответ заодно кладётся в кэш."""
+        payment = await self._call("find", "GET", f"payments/{payment_id}", YOOKASSA_FIND_DEADLINE)
+        self._remember(payment_id, payment)
+        return payment
+
+    def _remember(self, payment_id: str, payment: dict):
+        final = payment.get("status") in PAYMENT_FINAL_STATUSES
+        expires = float("inf") if final else time.monotonic() + PAYMENT_STATUS_TTL
+        self._status_cache[payment_id] = (payment, expires)
+        self._status_cache.move_to_end(payment_id)
+        while len(self._status_cache) > PAYMENT_STATUS_CACHE_SIZE:
+            self._status_cache.popitem(last=False)
+
+    def _forget_in_flight(self, payment_id: str, task: asyncio.Future):
+        self._in_flight.pop(payment_id, None)
+        if not task.cancelled():
+            task.exception()  # ошибку получат ожидающие; здесь — чтобы не было «never retrieved»
+
+    async def get_payment_cached(self, payment_id: str) -> dict:
+        """Для пользовательских проверок: кэш → общий запрос в полёте → API."""
+        cached = self._status_cache.get(payment_id)
+        if cached and cached[1] > time.monotonic():
+            self._status_cache.move_to_end(payment_id)
+            self.status_stats["hits"] += 1
+            return cached[0]
+
+        task = self._in_flight.get(payment_id)
+        if task is None:
+            self.status_stats["upstream"] += 1
+            task = asyncio.ensure_future(self.get_payment(payment_id))
+            self._in_flight[payment_id] = task
+            task.add_done_callback(lambda t: self._forget_in_flight(payment_id, t))
+        else:
+            self.status_stats["coalesced"] += 1
+        # shield: отменённый ожидающий не должен отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats_text(self) -> str:
+        st = self.status_stats
+        lines = [
+            "🏦 ЮKassa", self.breaker.stats_text(),
+            f"статусы: из кэша {st['hits']}, общих запросов {st['coalesced']}, в API {st['upstream']}, "
+            f"в кэше {len(self._status_cache)}",
+        ]
+        for op, hist in sorted(self.latency.items()):
+            lines.append(f"{op}: {hist.text()}")
+        if self.errors:
+            lines.append("ошибки: " + ", ".join(f"{k}={v}" for k, v in self.errors.most_common(6)))
+        return "\n".join(lines)
+
+
+yookassa_gateway = YooKassaGateway()
+
+
+def is_payment_paid(p: dict | None) -> bool:
+    return bool(p) and (bool(p.get("paid")) or p.get("status") == "succeeded")
+
+
+def save_created_payment(order_id: str, payment_id: str, user_id: int, tariff_key: str, amount: float):
+    """Сохраняет связку order_id → payment_id, запись платежа и last_payment_id пользователя."""
+    with user_mutation(user_id) as conn:
+        # связка order_id -> payment_id (таблица-словарь)
         conn.execute(
-            "UPDATE users SET bonus_requests = COALESCE(bonus_requests,0) + ?, got_secretlovemagic = 1 WHERE user_id = ?",
-            (SUB_BONUS_AMOUNT, user_id)
+            "INSERT OR REPLACE INTO payment_links(order_id, payment_id) VALUES(?, ?)",
+            (order_id, payment_id)
         )
 
-    await query.edit_message_text(f"✅ Подписка подтверждена! Начислено +{SUB_BONUS_AMOUNT} бонусных гаданий. Спасибо!")
+        # основная таблица payments
+        conn.execute(
+            "INSERT OR IGNORE INTO payments(payment_id, user_id, tariff, amount, status) VALUES (?, ?, ?, ?, 'pending')",
+            (payment_id, user_id, tariff_key, amount)
+        )
+
+        # сохраняем last_payment_id пользователю
+        conn.execute(
+            "UPDATE users SET last_payment_id = ? WHERE user_id = ?",
+            (payment_id, user_id)
+        )
 
 
 async def create_payment(user_id: int, tariff_key: str, tariff: dict) -> str | None:
@@ -1624,7 +4961,7 @@ async def create_payment(user_id: int, tariff_key: str, tariff: dict) -> str | N
         # 1) генерим order_id и используем его же для идемпотентности
         order_id = str(uuid4())
 
-        payment = Payment.create(
+        payment = await yookassa_gateway.create_payment(
             {
                 "amount": {"value": f"{price:.2f}", "currency": "RUB"},
                 "capture": True,
@@ -1642,47 +4979,10 @@ async def create_payment(user_id: int, tariff_key: str, tariff: dict) -> str | N
             idempotency_key=order_id  # важно для повторных кликов
         )
 
-        pay_url = payment.confirmation.confirmation_url
-
-        # 2) запись в БД (одним соединением, с таймаутом)
-        with sqlite3.connect('botdata.db', timeout=15) as conn:
-            conn.row_factory = sqlite3.Row
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA busy_timeout=15000;")
-
-            # связка order_id -> payment_id (таблица-словарь)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS payment_links (
-                    order_id   TEXT PRIMARY KEY,
-                    payment_id TEXT NOT NULL
-                )
-            """)
-            conn.execute(
-                "INSERT OR REPLACE INTO payment_links(order_id, payment_id) VALUES(?, ?)",
-                (order_id, payment.id)
-            )
-
-            # основная таблица payments (старая схема)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS payments (
-                    payment_id TEXT PRIMARY KEY,
-                    user_id    INTEGER,
-                    tariff     TEXT,
-                    amount     REAL,
-                    status     TEXT DEFAULT 'pending',
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.execute(
-                "INSERT OR IGNORE INTO payments(payment_id, user_id, tariff, amount, status) VALUES (?, ?, ?, ?, 'pending')",
-                (payment.id, user_id, tariff_key, price)
-            )
+        pay_url = payment["confirmation"]["confirmation_url"]
 
-            # сохраняем last_payment_id пользователю
-            conn.execute(
-                "UPDATE users SET last_payment_id = ? WHERE user_id = ?",
-                (payment.id, user_id)
-            )
+        # 2) запись в БД (одной транзакцией на соединении из пула)
+        await repo.save_created_payment(order_id, payment["id"], user_id, tariff_key, price)
 
         return pay_url
 
@@ -1690,33 +4990,63 @@ async def create_payment(user_id: int, tariff_key: str, tariff: dict) -> str | N
         logger.exception(f"create_payment error: {e}")
         return None
 
-def activate_subscription(user_id: int, tariff_key: str, payment_id: str) -> None:
+def get_last_payment_id(user_id: int) -> str | None:
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT last_payment_id FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+    return row["last_payment_id"] if row else None
+
+
+def get_payment(payment_id: str):
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT payment_id, user_id, tariff, amount, status FROM payments WHERE payment_id = ?",
+            (payment_id,)
+        ).fetchone()
+
+
+def find_payment_by_order(order_id: str):
+    """Платёж по order_id из return_url (/start pay_<order_id>)."""
+    with get_db_connection() as conn:
+        return conn.execute("""
+            SELECT p.payment_id, p.user_id, p.tariff, p.status
+            FROM payment_links l JOIN payments p ON p.payment_id = l.payment_id
+            WHERE l.order_id = ?
+        """, (order_id,)).fetchone()
+
+
+def activate_subscription(user_id: int, tariff_key: str, payment_id: str) -> bool:
     """
     Отмечает оплату успешной и начисляет доступ ровно один раз:
     - для 'requests' увеличивает users.paid_requests
     - для 'days' продлевает подписку
+    Возвращает True, если начисление произошло сейчас (False — уже было раньше).
     """
     now = datetime.now()
     tariff = TARIFFS.get(tariff_key)
     if not tariff:
         logger.error(f"Неизвестный тариф {tariff_key} при активации {payment_id}")
-        return
+        return False
 
-    with get_db_connection() as conn:
+    with user_mutation(user_id) as conn:
         # 0) проверим, не был ли платеж уже активирован
         row = conn.execute(
-            "SELECT status FROM payments WHERE payment_id = ?",
+            "SELECT status, amount FROM payments WHERE payment_id = ?",
             (payment_id,)
         ).fetchone()
 
         already_succeeded = bool(row and (row["status"] == "succeeded"))
 
         if not already_succeeded:
-            # помечаем платеж успешным
+            # помечаем платеж успешным (строки может ещё не быть, если уведомление опередило запись)
             conn.execute(
-                "UPDATE payments SET status = 'succeeded' WHERE payment_id = ?",
-                (payment_id,)
+                "INSERT INTO payments(payment_id, user_id, tariff, amount, status) VALUES (?, ?, ?, ?, 'succeeded') "
+                "ON CONFLICT(payment_id) DO UPDATE SET status = 'succeeded'",
+                (payment_id, user_id, tariff_key, tariff.get("price"))
             )
+            record_payment_stats(conn, user_id, tariff_key, row["amount"] if row else tariff.get("price"))
 
             # начисляем
             if "requests" in tariff:
@@ -1729,7 +5059,9 @@ def activate_subscription(user_id: int, tariff_key: str, payment_id: str) -> Non
 
             elif "days" in tariff:
                 days = int(tariff["days"])
-                u = get_user(user_id)
+                u = conn.execute(
+                    "SELECT subscription_end FROM users WHERE user_id = ?", (user_id,)
+                ).fetchone()
                 base = now
                 try:
                     if u and u["subscription_end"]:
@@ -1752,17 +5084,664 @@ def activate_subscription(user_id: int, tariff_key: str, payment_id: str) -> Non
             (payment_id, user_id)
         )
 
+    return not already_succeeded
+
+
+# ====== УВЕДОМЛЕНИЯ ЮKASSA ======
+# ЮKassa сама сообщает о payment.succeeded / payment.canceled POST-запросом на YOOKASSA_WEBHOOK_PATH
+# (адрес указывается в личном кабинете: <PUBLIC_URL>/yookassa/notify). Уведомлению не верим на слово:
+# проверяем IP отправителя по официальному списку и перечитываем статус платежа через API.
+YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/notify")
+YOOKASSA_VERIFY_IP = os.getenv("YOOKASSA_VERIFY_IP", "1") == "1"
+YOOKASSA_VERIFY_API = os.getenv("YOOKASSA_VERIFY_API", "1") == "1"
+YOOKASSA_NOTIFY_IPS = [
+    ipaddress.ip_network(net.strip(), strict=False)
+    for net in os.getenv(
+        "YOOKASSA_NOTIFY_IPS",
+        "185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11,77.75.156.35,77.75.154.128/25,2a02:5180::/32"
+    ).split(",") if net.strip()
+]
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # secret_token вебхука Telegram (необязательно)
+
+PAYMENT_NOTIFY_STATS = {
+    "received": 0, "processed": 0, "duplicates": 0,
+    "rejected_ip": 0, "rejected_status": 0, "unknown": 0, "errors": 0,
+}
 
 
-def main():
-    """Главная функция запуска бота"""
-    if not check_openai_setup():
-        print("❌ OpenAI API не настроен! Установите OPENAI_API_KEY")
+def is_yookassa_address(ip: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(addr in net for net in YOOKASSA_NOTIFY_IPS)
+
+
+def is_payment_event_processed(event_key: str) -> bool:
+    with get_db_connection() as conn:
+        return conn.execute("SELECT 1 FROM payment_events WHERE event_key = ?", (event_key,)).fetchone() is not None
+
+
+def mark_payment_event_processed(event_key: str, payment_id: str, event: str):
+    with get_db_transaction() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO payment_events(event_key, payment_id, event) VALUES (?, ?, ?)",
+            (event_key, payment_id, event)
+        )
+
+
+def mark_payment_canceled(payment_id: str) -> bool:
+    """Отмена не перетирает успешный платёж. True — статус изменился сейчас."""
+    with get_db_transaction() as conn:
+        cur = conn.execute(
+            "UPDATE payments SET status = 'canceled' WHERE payment_id = ? AND status NOT IN ('succeeded', 'canceled')",
+            (payment_id,)
+        )
+        return cur.rowcount > 0
+
+
+def payment_success_lines(u: dict | None, tariff_key: str) -> list[str]:
+    tariff = TARIFFS.get(tariff_key, {})
+    added = tariff.get("requests") or tariff.get("days")
+    kind = "гаданий" if "requests" in tariff else "дней безлимита"
+    lines = [
+        "🎉 Оплата прошла! Доступ активирован.",
+        f"➕ Начислено: {added} {kind}."
+    ]
+    if u:
+        lines.append(
+            f"📊 Теперь доступно: бесплатных {max(0, MAX_FREE_REQUESTS - (u['request_count'] or 0))}, "
+            f"платных {u['paid_requests'] or 0}, бонусных {u['bonus_requests'] or 0}."
+        )
+    return lines
+
+
+async def apply_payment_status(bot, payment_id: str, user_id: int, tariff_key: str, status: str) -> bool:
+    """
+    Применяет подтверждённый в ЮKassa финальный статус (succeeded/canceled) и пишет пользователю.
+    Общая часть для уведомлений и фоновой сверки. True — статус изменился сейчас.
+    """
+    if status == "succeeded":
+        changed = await repo.activate_subscription(user_id, tariff_key, payment_id)
+        if changed:
+            u = await repo.get_user(user_id)
+            text = "\n".join(payment_success_lines(u, tariff_key))
+    elif status == "canceled":
+        changed = await run_db(mark_payment_canceled, payment_id)
+        text = "❌ Платёж отменён. Если это ошибка — попробуйте оплатить ещё раз."
+    else:
+        return False
+
+    if changed:
+        try:
+            await bot.send_message(user_id, text, reply_markup=main_keyboard())
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить {user_id} о платеже {payment_id}: {e}")
+    return changed
+
+
+async def process_yookassa_notification(bot, body: dict) -> int:
+    """Обрабатывает тело уведомления, возвращает HTTP-код ответа (не 200 — ЮKassa повторит доставку)."""
+    event = body.get("event")
+    obj = body.get("object") or {}
+    payment_id = obj.get("id")
+    if event not in ("payment.succeeded", "payment.canceled") or not payment_id:
+        PAYMENT_NOTIFY_STATS["unknown"] += 1
+        return 200
+
+    event_key = f"{event}:{payment_id}"
+    if await run_db(is_payment_event_processed, event_key):
+        PAYMENT_NOTIFY_STATS["duplicates"] += 1
+        return 200
+
+    status, metadata = obj.get("status"), obj.get("metadata") or {}
+    if YOOKASSA_VERIFY_API:
+        p = await yookassa_gateway.get_payment(payment_id)
+        status, metadata = p.get("status"), p.get("metadata") or {}
+    expected = "succeeded" if event == "payment.succeeded" else "canceled"
+    if status != expected:
+        PAYMENT_NOTIFY_STATS["rejected_status"] += 1
+        logger.warning(f"Уведомление {event} для {payment_id}, но статус в ЮKassa: {status}")
+        return 200
+
+    pay = await repo.get_payment(payment_id)
+    user_id = pay["user_id"] if pay else metadata.get("user_id")
+    tariff_key = pay["tariff"] if pay else metadata.get("tariff")
+    if not user_id or tariff_key not in TARIFFS:
+        PAYMENT_NOTIFY_STATS["unknown"] += 1
+        logger.error(f"Уведомление {event} для неизвестного платежа {payment_id}")
+        return 200
+    await apply_payment_status(bot, payment_id, int(user_id), tariff_key, status)
+    await run_db(mark_payment_event_processed, event_key, payment_id, event)
+    PAYMENT_NOTIFY_STATS["processed"] += 1
+    return 200
+
+
+# ====== ФОНОВАЯ СВЕРКА ПЛАТЕЖЕЙ ======
+# Платежи, по которым не пришло уведомление и пользователь не вернулся, периодически перепроверяются
+# пачками: интервал между проверками одного платежа растёт экспоненциально (до потолка), а платежи
+# старше PAYMENT_PENDING_MAX_AGE помечаются expired одним UPDATE и больше не опрашиваются.
+PAYMENT_RECONCILE_INTERVAL = float(os.getenv("PAYMENT_RECONCILE_INTERVAL", "60"))      # сек между проходами
+PAYMENT_RECONCILE_BATCH = int(os.getenv("PAYMENT_RECONCILE_BATCH", "50"))
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "5"))
+PAYMENT_RECHECK_BASE = int(os.getenv("PAYMENT_RECHECK_BASE", "30"))                    # сек, первая пауза
+PAYMENT_RECHECK_CAP = int(os.getenv("PAYMENT_RECHECK_CAP", "1800"))                    # сек, потолок паузы
+PAYMENT_PENDING_MAX_AGE = int(os.getenv("PAYMENT_PENDING_MAX_AGE", str(24 * 3600)))    # сек
+
+PAYMENT_RECONCILE_STATS = {
+    "runs": 0, "checked": 0, "activated": 0, "canceled": 0,
+    "still_pending": 0, "errors": 0, "expired": 0, "last_run_ms": 0.0,
+}
+
+
+def expire_stale_payments() -> int:
+    with get_db_transaction() as conn:
+        cur = conn.execute(
+            "UPDATE payments SET status = 'expired', next_check_at = NULL "
+            "WHERE status = 'pending' AND created_at < datetime('now', ?)",
+            (f"-{PAYMENT_PENDING_MAX_AGE} seconds",)
+        )
+        return cur.rowcount
+
+
+def get_due_pending_payments(limit: int) -> list[dict]:
+    """Самые старые из ожидающих, у которых подошло время проверки (скан по idx_payments_status_created)."""
+    with get_db_connection() as conn:
+        rows = conn.execute("""
+            SELECT payment_id, user_id, tariff, COALESCE(attempts, 0) AS attempts
+            FROM payments
+            WHERE status = 'pending'
+              AND created_at >= datetime('now', ?)
+              AND (next_check_at IS NULL OR next_check_at <= datetime('now'))
+            ORDER BY created_at
+            LIMIT ?
+        """, (f"-{PAYMENT_PENDING_MAX_AGE} seconds", limit)).fetchall()
+        return [dict(r) for r in rows]
+
+
+def schedule_payment_recheck(payment_id: str, attempts: int):
+    delay = min(PAYMENT_RECHECK_BASE * (2 ** attempts), PAYMENT_RECHECK_CAP)
+    with get_db_transaction() as conn:
+        conn.execute(
+            "UPDATE payments SET attempts = ?, next_check_at = datetime('now', ?) "
+            "WHERE payment_id = ? AND status = 'pending'",
+            (attempts + 1, f"+{delay} seconds", payment_id)
+        )
+
+
+async def _reconcile_payment(bot, row: dict):
+    st = PAYMENT_RECONCILE_STATS
+    try:
+        p = await yookassa_gateway.get_payment(row["payment_id"])
+    except PaymentGatewayError:
+        st["errors"] += 1
+        await run_db(schedule_payment_recheck, row["payment_id"], row["attempts"])
         return
+    st["checked"] += 1
+    status = "succeeded" if is_payment_paid(p) else p.get("status")
+    if status in ("succeeded", "canceled"):
+        if await apply_payment_status(bot, row["payment_id"], row["user_id"], row["tariff"], status):
+            st["activated" if status == "succeeded" else "canceled"] += 1
+    else:
+        st["still_pending"] += 1
+        await run_db(schedule_payment_recheck, row["payment_id"], row["attempts"])
+
+
+async def reconcile_pending_payments(context: ContextTypes.DEFAULT_TYPE):
+    """Задача job_queue: один проход сверки."""
+    st = PAYMENT_RECONCILE_STATS
+    started = time.perf_counter()
+    st["runs"] += 1
+    try:
+        st["expired"] += await run_db(expire_stale_payments)
+        rows = await run_db(get_due_pending_payments, PAYMENT_RECONCILE_BATCH)
+        semaphore = asyncio.Semaphore(PAYMENT_RECONCILE_CONCURRENCY)
+
+        async def check(row):
+            async with semaphore:
+                # ЮKassa недоступна — не тратим попытки, дождёмся следующего прохода
+                if yookassa_gateway.breaker.state == "open":
+                    return
+                await _reconcile_payment(context.bot, row)
+
+        await asyncio.gather(*(check(row) for row in rows))
+    except Exception as e:
+        st["errors"] += 1
+        logger.exception(f"Ошибка сверки платежей: {e}")
+    st["last_run_ms"] = (time.perf_counter() - started) * 1000
+
+
+def payment_reconcile_stats_text() -> str:
+    st = PAYMENT_RECONCILE_STATS
+    return (
+        "🔄 Сверка платежей\n"
+        f"проходов: {st['runs']} (последний {st['last_run_ms']:.0f} мс), проверено: {st['checked']}\n"
+        f"активировано: {st['activated']}, отменено: {st['canceled']}, ещё ждут: {st['still_pending']}, "
+        f"просрочено: {st['expired']}, ошибок: {st['errors']}"
+    )
+
+
+def payment_notify_stats_text() -> str:
+    st = PAYMENT_NOTIFY_STATS
+    return (
+        "💳 Уведомления ЮKassa\n"
+        f"получено: {st['received']}, обработано: {st['processed']}, повторов: {st['duplicates']}\n"
+        f"отклонено по IP: {st['rejected_ip']}, по статусу: {st['rejected_status']}, "
+        f"неизвестных: {st['unknown']}, ошибок: {st['errors']}"
+    )
+
+
+# ====== HTTP-СЕРВЕР ВЕБХУКОВ ======
+# Вместо app.run_webhook: свой tornado-сервер, чтобы рядом с маршрутом Telegram жил маршрут ЮKassa.
+
+def _is_trusted_proxy(ip: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(addr in net for net in TRUSTED_PROXY_IPS)
+
+
+def _client_ip(request) -> str:
+    """Адрес клиента: X-Forwarded-For разбираем справа налево, пока хопы — наши прокси."""
+    ip = request.remote_ip
+    if not _is_trusted_proxy(ip):
+        return ip
+    hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    while hops and _is_trusted_proxy(ip):
+        ip = hops.pop()
+    return ip
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app, router=None):
+        self.bot_app = bot_app
+        self.router = router
+
+    def get(self):
+        self.write("ok")  # keepalive-пинг
+
+    async def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self.set_status(403)
+            return
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        if self.router:
+            # очередь воркера переполнена — 503, Telegram повторит доставку позже
+            if not self.router.route_update(data):
+                self.set_status(503)
+            return
+        await self.bot_app.update_queue.put(Update.de_json(data, self.bot_app.bot))
+
+
+class YooKassaNotificationHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app, router=None):
+        self.bot_app = bot_app
+        self.router = router
+
+    async def post(self):
+        PAYMENT_NOTIFY_STATS["received"] += 1
+        ip = _client_ip(self.request)
+        if YOOKASSA_VERIFY_IP and not is_yookassa_address(ip):
+            PAYMENT_NOTIFY_STATS["rejected_ip"] += 1
+            logger.warning(f"Уведомление ЮKassa с чужого адреса {ip}")
+            self.set_status(403)
+            return
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        if self.router:
+            # обработает воркер; если он не справится — платёж подберёт фоновая сверка
+            self.set_status(200 if self.router.route_notification(body) else 503)
+            return
+        try:
+            self.set_status(await process_yookassa_notification(self.bot_app.bot, body))
+        except Exception as e:
+            PAYMENT_NOTIFY_STATS["errors"] += 1
+            logger.exception(f"Ошибка обработки уведомления ЮKassa: {e}")
+            self.set_status(500)
+
+
+def build_web_app(app, router=None) -> tornado.web.Application:
+    handler_args = {"bot_app": app, "router": router}
+    return tornado.web.Application([
+        (f"/{re.escape(TOKEN)}", TelegramWebhookHandler, handler_args),
+        (re.escape(YOOKASSA_WEBHOOK_PATH), YooKassaNotificationHandler, handler_args),
+    ])
+
+
+async def run_webhook_server(app, port: int):
+    """Тот же жизненный цикл, что у app.run_webhook (post_init/post_shutdown), но на своём сервере."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    server = HTTPServer(build_web_app(app))
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.bot.set_webhook(
+        url=f"{PUBLIC_URL}/{TOKEN}",
+        drop_pending_updates=True,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    await app.start()
+    server.listen(port, "0.0.0.0")
+    logger.info(f"Вебхуки слушают порт {port}: /<token>, {YOOKASSA_WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+# ====== ШАРДИРОВАНИЕ ВЕБХУКОВ ПО ПРОЦЕССАМ ======
+# WEBHOOK_WORKERS > 0: этот процесс только принимает HTTP (Telegram и ЮKassa) и раскладывает
+# апдейты по очередям воркеров: user_id % WEBHOOK_WORKERS. Воркер — отдельный процесс со
+# своим event loop и Application; апдейты одного пользователя всегда попадают в один воркер
+# и там обрабатываются строго по очереди, разные пользователи — параллельно на разных ядрах.
+# Общее состояние — SQLite (WAL, BEGIN IMMEDIATE работает между процессами); кэш
+# пользователей сбрасывается сообщениями между воркерами; общие лимиты делятся поровну
+# (worker_share); фоновые задачи в одном экземпляре (сверка, рассылки, keepalive) — в воркере 0.
+# Выигрыш есть только на многоядерной машине и при обработчиках, нагружающих CPU: воркеров
+# ставят не больше, чем ядер минус одно под фронт. На одном ядре режим медленнее обычного
+# (очереди между процессами, переключения) — см. bench/bench_sharding.py.
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))          # апдейтов в очереди воркера
+SHARD_STOP_TIMEOUT = float(os.getenv("SHARD_STOP_TIMEOUT", "30"))      # сек на остановку воркера
+SHARD_SUPERVISE_INTERVAL = float(os.getenv("SHARD_SUPERVISE_INTERVAL", "5"))
+
+SHARD_STATS = {"updates": 0, "notifications": 0, "invalidations": 0}
+
+
+def update_routing_key(data: dict) -> int | None:
+    """user_id отправителя из сырого апдейта (message.from, callback_query.from, poll_answer.user…)."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
 
-    init_db()
 
-    app = ApplicationBuilder().token(TOKEN).build()
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты одного пользователя — по очереди (FIFO), разных — параллельно.
+    Исключение — отправка карт во время идущего гадания: в очереди она дождалась бы его конца,
+    поэтому дубль или отказ разбирается сразу (reading_inflight.answer_concurrent).
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._users: dict[int, list] = {}  # user_id -> [Lock, ждущих + обрабатываемых]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        if reading_inflight.is_running(user.id):
+            cards = submitted_cards(update)
+            if cards is not None:
+                coroutine.close()  # обработчики для этой отправки не запускаем
+                await reading_inflight.answer_concurrent(update, cards)
+                return
+        entry = self._users.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._users.pop(user.id, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class ShardRouter:
+    """Фронт: очереди и процессы воркеров, маршрутизация, перезапуск упавших."""
+
+    def __init__(self, workers: int):
+        self._mp = multiprocessing.get_context("spawn")
+        self.queues = [self._mp.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(workers)]
+        self.processes: list = [None] * workers
+        self.stats = {"routed": [0] * workers, "rejected": 0, "notifications": 0, "restarts": 0}
+
+    def _spawn(self, index: int):
+        # SHARD_INDEX читается воркером при импорте модуля, поэтому передаём через окружение
+        os.environ["SHARD_INDEX"] = str(index)
+        os.environ["WEBHOOK_WORKERS"] = str(len(self.queues))
+        try:
+            process = self._mp.Process(
+                target=_run_shard_worker, args=(index, self.queues), name=f"shard-{index}", daemon=True
+            )
+            process.start()
+        finally:
+            os.environ.pop("SHARD_INDEX", None)
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+        logger.info(f"Запущено воркеров: {len(self.queues)}")
+
+    def shard_for(self, key: int | None) -> int:
+        return key % len(self.queues) if key is not None else 0
+
+    def _put(self, index: int, message: tuple) -> bool:
+        try:
+            self.queues[index].put_nowait(message)
+        except queue.Full:
+            self.stats["rejected"] += 1
+            logger.warning(f"Очередь воркера {index} переполнена")
+            return False
+        self.stats["routed"][index] += 1
+        return True
+
+    def route_update(self, data: dict) -> bool:
+        return self._put(self.shard_for(update_routing_key(data)), ("update", data))
+
+    def route_notification(self, body: dict) -> bool:
+        # тот же воркер, что и у плательщика: его кэш и дедупликация оплат
+        metadata = (body.get("object") or {}).get("metadata") or {}
+        try:
+            key = int(metadata.get("user_id"))
+        except (TypeError, ValueError):
+            key = None
+        self.stats["notifications"] += 1
+        return self._put(self.shard_for(key), ("yookassa", body))
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(SHARD_SUPERVISE_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    self.stats["restarts"] += 1
+                    logger.error(f"Воркер {index} завершился (код {process.exitcode}), перезапускаем")
+                    self._spawn(index)
+
+    def stop(self):
+        """Блокирующая остановка: сначала просим воркеров доработать, затем добиваем зависших."""
+        for inbox in self.queues:
+            try:
+                inbox.put(("stop", None), timeout=1)
+            except queue.Full:
+                pass
+        deadline = time.monotonic() + SHARD_STOP_TIMEOUT
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Воркер {index} не остановился за {SHARD_STOP_TIMEOUT:.0f} с, завершаем")
+                process.terminate()
+                process.join(5)
+        logger.info(f"Маршрутизация: {self.stats}")
+
+
+def _shard_get(inbox) -> tuple:
+    try:
+        return inbox.get(timeout=1.0)
+    except queue.Empty:
+        return "idle", None
+
+
+async def _process_routed_notification(bot, body: dict):
+    try:
+        await process_yookassa_notification(bot, body)
+    except Exception as e:
+        PAYMENT_NOTIFY_STATS["errors"] += 1
+        logger.exception(f"Ошибка обработки уведомления ЮKassa: {e}")
+
+
+async def shard_worker_loop(app, index: int, queues: list):
+    """Читает свою очередь до сообщения stop (или пока жив фронт) и кормит Application."""
+    global _shard_peers
+    inbox = queues[index]
+    _shard_peers = [q for i, q in enumerate(queues) if i != index]
+    loop = asyncio.get_running_loop()
+    parent = os.getppid()
+    tasks = set()
+    while True:
+        kind, payload = await loop.run_in_executor(None, _shard_get, inbox)
+        if kind == "update":
+            SHARD_STATS["updates"] += 1
+            await app.update_queue.put(Update.de_json(payload, app.bot))
+        elif kind == "yookassa":
+            SHARD_STATS["notifications"] += 1
+            task = asyncio.create_task(_process_routed_notification(app.bot, payload))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif kind == "invalidate":
+            SHARD_STATS["invalidations"] += 1
+            for user_id in payload:
+                user_cache.invalidate(user_id)
+        elif kind == "stop":
+            break
+        elif os.getppid() != parent:
+            logger.warning(f"Воркер {index}: фронт пропал, останавливаемся")
+            break
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _shard_worker(index: int, queues: list):
+    app = build_application()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    logger.info(f"Воркер {index}/{WEBHOOK_WORKERS} готов")
+    try:
+        await shard_worker_loop(app, index, queues)
+    finally:
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+def _run_shard_worker(index: int, queues: list):
+    """Точка входа процесса-воркера. Ctrl+C и SIGTERM обрабатывает фронт и присылает stop."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_shard_worker(index, queues))
+
+
+def shard_stats_text() -> str:
+    st = SHARD_STATS
+    return (
+        f"🧩 Воркер {SHARD_INDEX + 1}/{WEBHOOK_WORKERS}\n"
+        f"апдейтов: {st['updates']}, уведомлений ЮKassa: {st['notifications']}, "
+        f"сбросов кэша от соседей: {st['invalidations']}"
+    )
+
+
+async def run_sharded_webhook_server(port: int, workers: int):
+    """Фронт: HTTP → очереди воркеров. Application здесь нет, только set_webhook."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    router = ShardRouter(workers)
+    router.start()
+    server = HTTPServer(build_web_app(None, router))
+    async with Bot(TOKEN) as bot:
+        await bot.set_webhook(
+            url=f"{PUBLIC_URL}/{TOKEN}",
+            drop_pending_updates=True,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    server.listen(port, "0.0.0.0")
+    logger.info(f"Вебхуки слушают порт {port}, воркеров {workers}: /<token>, {YOOKASSA_WEBHOOK_PATH}")
+    supervisor = asyncio.create_task(router.supervise())
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        supervisor.cancel()
+        await loop.run_in_executor(None, router.stop)
+
+
+async def _post_init(app):
+    """Запуск фоновых задач после инициализации приложения."""
+    request_log_writer.start()
+    await reading_rate_limiter.start()
+    if SHARD_INDEX <= 0:  # незавершённые рассылки продолжает один процесс
+        await broadcast_engine.resume_all(app)
+
+
+async def _post_shutdown(app):
+    """Освобождаем общие ресурсы при остановке."""
+    await broadcast_engine.stop()
+    await request_log_writer.stop()
+    await reading_rate_limiter.stop()
+    await close_openai_client()
+    await yookassa_gateway.close()
+    _db_executor.shutdown(wait=True)
+    _db_pool.close_all()
+
+
+def build_application():
+    """Application со всеми обработчиками и фоновыми задачами (в обычном процессе и в воркере)."""
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        # разные пользователи — параллельно, апдейты одного пользователя — строго по очереди
+        .concurrent_updates(UserOrderedUpdateProcessor(BOT_CONCURRENT_UPDATES))
+        .rate_limiter(outbound)
+        .persistence(session_store)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     # Регистрация обработчиков
     app.add_handler(CommandHandler("start", start))
@@ -1770,6 +5749,7 @@ def main():
     app.add_handler(CallbackQueryHandler(handle_callback_query))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(CommandHandler("check_payment", check_payment))
+    app.add_handler(CommandHandler("fast", toggle_fast_reading))
 
     # Админ-команды (оставляем, как у тебя)
     app.add_handler(CommandHandler("add_paid", add_paid))
@@ -1777,14 +5757,25 @@ def main():
     app.add_handler(CommandHandler("reset_free", reset_free))
     app.add_handler(CommandHandler("add_sub", add_sub))
     app.add_handler(CommandHandler("broadcast", broadcast))
-
-    logger.info("🤖 Таро бот запущен!")
-    print("🤖 Таро бот запущен!")
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel))
+    app.add_handler(CommandHandler("cache_stats", cache_stats))
+    app.add_handler(CommandHandler("metrics", metrics))
+    app.add_handler(CommandHandler("stats", stats))
+
+    # задачи в одном экземпляре на весь бот — только в обычном процессе или в воркере 0
+    singleton = SHARD_INDEX <= 0
+    if app.job_queue:
+        if singleton:
+            app.job_queue.run_repeating(reconcile_pending_payments, interval=PAYMENT_RECONCILE_INTERVAL, first=30)
+        app.job_queue.run_repeating(purge_idle_sessions, interval=SESSION_PURGE_INTERVAL, first=SESSION_PURGE_INTERVAL)
+    else:
+        logger.warning("job_queue недоступна (нужен python-telegram-bot[job-queue]) — "
+                       "сверка платежей и очистка сессий выключены")
 
     # --- KEEPALIVE для Render Free (не даём сервису уснуть) ---
     # Включается переменной окружения KEEPALIVE=1
     # По умолчанию пингуем путь вебхука: https://<PUBLIC_URL>/<TOKEN>
-    if os.getenv("KEEPALIVE", "1") == "1" and PUBLIC_URL:
+    if os.getenv("KEEPALIVE", "1") == "1" and PUBLIC_URL and singleton and app.job_queue:
         async def _keepalive(_):
             try:
                 url = os.getenv("KEEPALIVE_URL") or f"{PUBLIC_URL}/{TOKEN}"
@@ -1797,22 +5788,33 @@ def main():
         # каждые 9 минут, первый пинг через 60 секунд
         app.job_queue.run_repeating(_keepalive, interval=540, first=60)
 
+    return app
+
+
+def main():
+    """Главная функция запуска бота"""
+    if not check_openai_setup():
+        print("❌ OpenAI API не настроен! Установите OPENAI_API_KEY")
+        return
+
+    # миграции, импорт и пересчёт аналитики — один раз, до запуска воркеров
+    init_db()
+
+    logger.info("🤖 Таро бот запущен!")
+    print("🤖 Таро бот запущен!")
 
     # === ВЫБОР РЕЖИМА ЗАПУСКА ===
     USE_WEBHOOK = os.getenv("USE_WEBHOOK", "0") == "1"
     if USE_WEBHOOK:
         # Для Render (или другого хостинга с публичным URL)
         PORT = int(os.environ.get("PORT", "8080"))
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=TOKEN,
-            webhook_url=f"{PUBLIC_URL}/{TOKEN}",
-            drop_pending_updates=True
-        )
+        if WEBHOOK_WORKERS > 0:
+            asyncio.run(run_sharded_webhook_server(PORT, WEBHOOK_WORKERS))
+        else:
+            asyncio.run(run_webhook_server(build_application(), PORT))
     else:
         # Для запуска на компьютере
-        app.run_polling(drop_pending_updates=True)
+        build_application().run_polling(drop_pending_updates=True)
 
     
     
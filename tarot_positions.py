@@ -0,0 +1,339 @@
+# tarot_positions.py
+# Офлайн-корпус значений карт по позициям раскладов.
+# Тексты для пар (карта, позиция) собираются из значений карт и шаблонов позиций:
+# старшие арканы описаны целиком, младшие — комбинацией достоинства и масти.
+
+MAJOR_ARCANA = {
+    # ключ: (название, суть, что мешает, совет)
+    "the_fool": (
+        "Шут",
+        "Это энергия нового начала, спонтанности и доверия к жизни.",
+        "Мешать может легкомыслие и нежелание думать о последствиях.",
+        "Позвольте себе сделать первый шаг, не дожидаясь полных гарантий.",
+    ),
+    "the_magician": (
+        "Маг",
+        "У вас есть всё необходимое, чтобы превратить замысел в результат.",
+        "Мешать может распыление сил или попытка управлять людьми вместо ситуации.",
+        "Соберите ресурсы в одной точке и действуйте сознательно.",
+    ),
+    "the_high_priestess": (
+        "Жрица",
+        "Многое происходит под поверхностью, и интуиция знает больше, чем слова.",
+        "Мешают недосказанность, скрытность и неумение доверять своим ощущениям.",
+        "Не торопите события: понаблюдайте и прислушайтесь к внутреннему голосу.",
+    ),
+    "the_empress": (
+        "Императрица",
+        "Это время роста, заботы и плодородия — то, во что вложено тепло, приносит плоды.",
+        "Мешать может чрезмерная опека или застой в комфорте.",
+        "Питайте то, что вам дорого, и не забывайте заботиться о себе.",
+    ),
+    "the_emperor": (
+        "Император",
+        "Ситуация требует структуры, ответственности и ясных границ.",
+        "Мешают жёсткость, контроль и нежелание учитывать чувства других.",
+        "Наведите порядок, примите решение и возьмите ответственность на себя.",
+    ),
+    "the_hierophant": (
+        "Иерофант",
+        "Важны традиции, опыт и поддержка наставника или близкого круга.",
+        "Мешать могут чужие правила и страх выйти за рамки привычного.",
+        "Обратитесь за советом к тому, кому доверяете, и опирайтесь на проверенное.",
+    ),
+    "the_lovers": (
+        "Влюбленные",
+        "В центре — выбор сердца, искренность и союз, основанный на ценностях.",
+        "Мешают сомнения, раздвоенность и выбор из страха, а не из любви.",
+        "Выбирайте то, что созвучно вашим ценностям, и говорите честно.",
+    ),
+    "the_chariot": (
+        "Колесница",
+        "Это движение вперёд, воля и победа, которая начинается с внутреннего решения.",
+        "Мешают разнонаправленные желания и попытка ехать сразу в две стороны.",
+        "Определите курс и держите его, не отвлекаясь на второстепенное.",
+    ),
+    "strength": (
+        "Сила",
+        "Ваша сила — в мягкости, терпении и умении справляться с эмоциями.",
+        "Мешать может давление, раздражение или неверие в себя.",
+        "Действуйте спокойно и бережно: мягкое упорство сделает больше напора.",
+    ),
+    "the_hermit": (
+        "Отшельник",
+        "Это время уединения, размышлений и поиска собственного ответа.",
+        "Мешают замкнутость и отстранённость от тех, кто готов помочь.",
+        "Возьмите паузу, чтобы услышать себя, а затем поделитесь найденным светом.",
+    ),
+    "wheel_of_fortune": (
+        "Колесо Фортуны",
+        "Начинается новый цикл: обстоятельства меняются, и судьба даёт шанс.",
+        "Мешает сопротивление переменам и ожидание, что всё решится само.",
+        "Будьте внимательны к возможностям и не упускайте удачный момент.",
+    ),
+    "justice": (
+        "Справедливость",
+        "Важны честность, равновесие и последствия принятых решений.",
+        "Мешают предвзятость, поиск виноватых и самообман.",
+        "Взвесьте факты трезво и поступите так, как сочтёте справедливым.",
+    ),
+    "the_hanged_man": (
+        "Повешенный",
+        "Ситуация словно подвешена: это пауза, которая меняет взгляд на вещи.",
+        "Мешают жертвенность без смысла и ожидание без действия.",
+        "Посмотрите на происходящее под другим углом и отпустите старое восприятие.",
+    ),
+    "death": (
+        "Смерть",
+        "Что-то завершается, освобождая место для нового этапа.",
+        "Мешает цепляние за то, что уже отжило своё.",
+        "Отпустите прошлое с благодарностью — так начинается обновление.",
+    ),
+    "temperance": (
+        "Умеренность",
+        "Это баланс, исцеление и постепенное соединение противоположностей.",
+        "Мешают крайности, спешка и попытка получить всё сразу.",
+        "Ищите золотую середину и доверьтесь естественному темпу.",
+    ),
+    "the_devil": (
+        "Дьявол",
+        "Проявляются привязанности, соблазны и сценарии, которые держат крепче, чем кажется.",
+        "Мешают зависимость, страх и то, что вы сами себе запрещаете видеть.",
+        "Честно назовите то, что вас сковывает, — осознанность уже даёт свободу.",
+    ),
+    "the_tower": (
+        "Башня",
+        "Рушится то, что держалось на иллюзиях, и открывается правда.",
+        "Мешает попытка удержать то, что уже не выдерживает нагрузки.",
+        "Не цепляйтесь за обломки: стройте заново на честном основании.",
+    ),
+    "the_star": (
+        "Звезда",
+        "После трудностей приходят надежда, вдохновение и исцеление.",
+        "Мешают разочарование и неверие в то, что хорошее возможно.",
+        "Сохраняйте веру в лучшее и двигайтесь к мечте маленькими шагами.",
+    ),
+    "the_moon": (
+        "Луна",
+        "Многое пока неясно: в игру вступают страхи, фантазии и подсознание.",
+        "Мешают иллюзии, тревога и недосказанность.",
+        "Не принимайте поспешных решений, пока туман не рассеется.",
+    ),
+    "the_sun": (
+        "Солнце",
+        "Это радость, ясность и успех — всё становится понятным и тёплым.",
+        "Мешать может самоуверенность и нежелание замечать мелочи.",
+        "Действуйте открыто и позвольте себе радоваться результату.",
+    ),
+    "judgement": (
+        "Суд",
+        "Наступает момент пробуждения, подведения итогов и второго шанса.",
+        "Мешают самокритика и страх услышать внутренний зов.",
+        "Примите урок прошлого и откликнитесь на новое призвание.",
+    ),
+    "the_world": (
+        "Мир",
+        "Цикл завершается успешно: приходят целостность и чувство выполненного пути.",
+        "Мешает страх сделать последний шаг и закрыть этап.",
+        "Завершите начатое и отметьте свой путь — впереди новый уровень.",
+    ),
+}
+
+# Достоинства младших арканов: (название, суть, что мешает, совет); {sphere} — сфера масти
+MINOR_RANKS = {
+    "ace": (
+        "Туз",
+        "Это зерно нового начала в сфере {sphere}: появляется шанс, который стоит заметить.",
+        "Мешать может неуверенность, из-за которой новая возможность остаётся нереализованной.",
+        "Примите новую возможность и дайте ей первый импульс.",
+    ),
+    "two": (
+        "Двойка",
+        "В сфере {sphere} важны выбор, партнёрство и поиск равновесия.",
+        "Мешает нерешительность и попытка удержать два пути одновременно.",
+        "Взвесьте варианты и выберите тот, что ближе вашим целям.",
+    ),
+    "three": (
+        "Тройка",
+        "В сфере {sphere} начинается рост: первые результаты и расширение.",
+        "Мешают поспешность и недостаток взаимодействия с другими.",
+        "Объединяйтесь с теми, кто разделяет ваши цели, и развивайте успех.",
+    ),
+    "four": (
+        "Четверка",
+        "В сфере {sphere} наступает стабилизация и потребность в опоре.",
+        "Мешают застой, перестраховка и страх перемен.",
+        "Закрепите достигнутое, но не закрывайтесь от нового.",
+    ),
+    "five": (
+        "Пятерка",
+        "В сфере {sphere} возникает испытание: конфликт, потеря или нехватка.",
+        "Мешает фиксация на проигрыше и чувство одиночества в трудности.",
+        "Примите трудность как урок и не стесняйтесь просить поддержки.",
+    ),
+    "six": (
+        "Шестерка",
+        "В сфере {sphere} приходят гармония, восстановление и обмен.",
+        "Мешают неравные отношения и ожидание благодарности.",
+        "Делитесь и принимайте помощь — так восстанавливается баланс.",
+    ),
+    "seven": (
+        "Семерка",
+        "В сфере {sphere} вы проходите проверку: стратегия, терпение и выбор.",
+        "Мешают сомнения, хитрости и разбросанность.",
+        "Определите главное и защищайте свою позицию честно.",
+    ),
+    "eight": (
+        "Восьмерка",
+        "В сфере {sphere} идёт движение: события ускоряются, требуется мастерство.",
+        "Мешают ограничивающие убеждения и суета.",
+        "Сосредоточьтесь на деле и двигайтесь последовательно.",
+    ),
+    "nine": (
+        "Девятка",
+        "В сфере {sphere} вы близки к итогу: накоплен опыт и внутренняя стойкость.",
+        "Мешают усталость, тревога и ожидание подвоха.",
+        "Берегите силы: осталось совсем немного до результата.",
+    ),
+    "ten": (
+        "Десятка",
+        "В сфере {sphere} цикл завершается: итог, полнота или предел нагрузки.",
+        "Мешает груз, который вы несёте в одиночку дольше, чем нужно.",
+        "Подведите итог и освободите место для следующего этапа.",
+    ),
+    "page": (
+        "Паж",
+        "В сфере {sphere} появляются новости, любопытство и желание учиться.",
+        "Мешают наивность и неумение доводить начатое до конца.",
+        "Учитесь, пробуйте и будьте открыты новостям.",
+    ),
+    "knight": (
+        "Рыцарь",
+        "В сфере {sphere} начинается активное движение к цели.",
+        "Мешают горячность или, наоборот, излишняя медлительность.",
+        "Действуйте смело, но соизмеряйте темп с обстоятельствами.",
+    ),
+    "queen": (
+        "Королева",
+        "В сфере {sphere} важны зрелость, эмпатия и мудрое управление ресурсами.",
+        "Мешает, когда забота превращается в контроль или ревность.",
+        "Опирайтесь на внутреннюю мудрость и поддерживайте себя так же, как других.",
+    ),
+    "king": (
+        "Король",
+        "В сфере {sphere} нужны лидерство, опыт и ответственность за решения.",
+        "Мешают властность и нежелание слышать других.",
+        "Возьмите ситуацию под уверенное управление.",
+    ),
+}
+
+# Масти: (родительный падеж для названия, сфера, характерная черта)
+MINOR_SUITS = {
+    "wands": ("жезлов", "дел, идей и вдохновения", "Здесь много огня: решают инициатива и смелость."),
+    "cups": ("кубков", "чувств и отношений", "Главное здесь — эмоции и искренность."),
+    "swords": ("мечей", "мыслей, решений и слов", "Ключ к ситуации — ясность мысли и честный разговор."),
+    "pentacles": ("пентаклей", "денег, работы и здоровья", "Важна практичность: результат строится постепенно."),
+}
+
+
+def build_card_meanings() -> dict:
+    """Ключ карты (как в index.html) → {'name', 'core', 'shadow', 'advice'}."""
+    meanings = {}
+    for key, (name, core, shadow, advice) in MAJOR_ARCANA.items():
+        meanings[key] = {"name": name, "core": core, "shadow": shadow, "advice": advice}
+    for suit, (suit_gen, sphere, note) in MINOR_SUITS.items():
+        for rank, (rank_name, core, shadow, advice) in MINOR_RANKS.items():
+            meanings[f"{rank}_of_{suit}"] = {
+                "name": f"{rank_name} {suit_gen}",
+                "core": f"{core.format(sphere=sphere)} {note}",
+                "shadow": shadow,
+                "advice": advice,
+            }
+    return meanings
+
+
+CARD_MEANINGS = build_card_meanings()
+
+# Шаблоны по типу позиции
+POSITION_TEMPLATES = {
+    "situation": "Эта позиция описывает суть происходящего. {core}",
+    "feelings": "Эта позиция раскрывает внутренний настрой и чувства. {core}",
+    "obstacle": "Эта позиция показывает, что тормозит процесс. {shadow}",
+    "resource": "Эта позиция говорит об опоре и сильных сторонах. {core}",
+    "lesson": "Эта позиция показывает, что важно понять. {core} {advice}",
+    "direction": "Эта позиция указывает направление. {core}",
+    "release": "Эта позиция показывает, с чем пора проститься. {shadow}",
+    "advice": "Эта позиция даёт совет. {advice}",
+    "outcome": "Эта позиция показывает, к чему всё движется. {core}",
+}
+
+# Позиции готовых раскладов и расклада по умолчанию → тип позиции
+POSITION_KINDS = {
+    # расклад по умолчанию (вопрос пользователя)
+    "Первая карта": "situation",
+    "Вторая карта": "lesson",
+    "Третья карта": "outcome",
+    # любовь
+    "Его/её мысли о вас": "feelings",
+    "Скрытые чувства": "feelings",
+    "Что мешает сближению": "obstacle",
+    "Текущее состояние": "situation",
+    "Возможные препятствия": "obstacle",
+    "Итог отношений": "outcome",
+    "Истинная причина": "situation",
+    "Его/её состояние": "feelings",
+    "Стоит ли ждать возвращения": "outcome",
+    "Ваш вклад в отношения": "resource",
+    "Вклад партнера": "resource",
+    "Общий потенциал": "outcome",
+    "Плюсы продолжения": "resource",
+    "Минусы продолжения": "obstacle",
+    "Совет карт": "advice",
+    "Что мешает любви": "obstacle",
+    "Что нужно изменить": "lesson",
+    "Как действовать": "advice",
+    "Причина боли": "obstacle",
+    "Урок расставания": "lesson",
+    "Путь к исцелению": "advice",
+    # карьера
+    "Текущая ситуация": "situation",
+    "Скрытые возможности": "resource",
+    "Рекомендации": "advice",
+    "Источники дохода": "resource",
+    "Препятствия": "obstacle",
+    "Путь к изобилию": "advice",
+    "Ваши сильные стороны": "resource",
+    "Подходящая сфера": "direction",
+    "Первые шаги": "advice",
+    "Текущие навыки": "resource",
+    "Что развивать": "lesson",
+    "Возможности роста": "outcome",
+    "Атмосфера в коллективе": "situation",
+    "Ваша роль": "resource",
+    "Как улучшить отношения": "advice",
+    # личностный рост
+    "Истинные желания": "feelings",
+    "Путь к цели": "advice",
+    "Что уходит": "release",
+    "Что приходит": "outcome",
+    "Как принять изменения": "advice",
+    "Скрытый талант": "resource",
+    "Как развить": "advice",
+    "Где применить": "direction",
+    "Кармическая задача": "lesson",
+    "Урок для души": "lesson",
+    "Путь освобождения": "advice",
+    "Текущий уровень": "situation",
+    "Следующий шаг": "advice",
+    "Духовная цель": "outcome",
+}
+
+
+def build_position_corpus(positions) -> dict:
+    """(ключ карты, позиция) → готовый абзац для каждой карты и каждой переданной позиции."""
+    corpus = {}
+    for position in positions:
+        template = POSITION_TEMPLATES[POSITION_KINDS.get(position, "situation")]
+        for key, meaning in CARD_MEANINGS.items():
+            corpus[(key, position)] = template.format(**meaning)
+    return corpus
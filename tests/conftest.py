@@ -0,0 +1,43 @@
+"""
+Общая настройка тестов: окружение задаётся до импорта tarot_bot,
+т.к. модуль читает конфигурацию из переменных окружения при импорте.
+"""
+import os
+import socket
+import sys
+import tempfile
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+_TMP_DIR = tempfile.mkdtemp(prefix="tarot_bot_tests_")
+FAKE_YOOKASSA_PORT = _free_port()
+
+os.environ.update(
+    TELEGRAM_TOKEN="1:test",
+    OPENAI_API_KEY="sk-test",
+    DB_PATH=os.path.join(_TMP_DIR, "botdata.db"),
+    ADMIN_ID="0",
+    # Фейковая ЮKassa (tests/fake_yookassa.py) слушает на localhost
+    YOOKASSA_ACCOUNT_ID="1",
+    YOOKASSA_SECRET_KEY="test",
+    YOOKASSA_API_URL=f"http://127.0.0.1:{FAKE_YOOKASSA_PORT}/v3",
+    YOOKASSA_NOTIFY_IPS="127.0.0.1/32",
+    TRUSTED_PROXY_IPS="",
+)
+# Дочерние процессы (spawn) наследуют окружение и sys.path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import tarot_bot  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    tarot_bot.init_db()
+    yield tarot_bot.DB_PATH
@@ -0,0 +1,79 @@
+"""
+Фейковая ЮKassa для тестов: API v3 (GET /v3/payments/{id}) со статусами, которые задаёт тест,
+и отправитель HTTP-уведомлений на вебхук бота — в том виде, в каком их шлёт ЮKassa.
+"""
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+
+class FakeYooKassa:
+    """API платежей: payments[payment_id] = (status, metadata); calls — запрошенные id по порядку."""
+
+    def __init__(self):
+        self.payments: dict[str, tuple[str, dict]] = {}
+        self.calls: list[str] = []
+        self._server: HTTPServer | None = None
+
+    def add_payment(self, payment_id: str, status: str, user_id: int, tariff: str, amount: float = 100.0):
+        self.payments[payment_id] = (status, {"user_id": str(user_id), "tariff": tariff, "amount": amount})
+
+    def payment_json(self, payment_id: str) -> dict:
+        status, metadata = self.payments[payment_id]
+        return {
+            "id": payment_id,
+            "status": status,
+            "paid": status == "succeeded",
+            "amount": {"value": f"{metadata['amount']:.2f}", "currency": "RUB"},
+            "metadata": {"user_id": metadata["user_id"], "tariff": metadata["tariff"]},
+            "created_at": "2026-01-01T00:00:00.000Z",
+            "test": True,
+            "refundable": False,
+            "recipient": {"account_id": "1", "gateway_id": "1"},
+        }
+
+    def start(self, port: int):
+        fake = self
+
+        class PaymentHandler(tornado.web.RequestHandler):
+            def get(self, payment_id):
+                fake.calls.append(payment_id)
+                if payment_id not in fake.payments:
+                    self.set_status(404)
+                    self.write({"type": "error", "code": "not_found"})
+                    return
+                self.write(fake.payment_json(payment_id))
+
+        self._server = HTTPServer(tornado.web.Application([(r"/v3/payments/([^/]+)", PaymentHandler)]))
+        self._server.listen(port, "127.0.0.1")
+
+    def stop(self):
+        if self._server:
+            self._server.stop()
+            self._server = None
+
+
+class NotificationSender:
+    """Шлёт уведомления ЮKassa на вебхук бота."""
+
+    def __init__(self, base_url: str, path: str):
+        self.client = httpx.AsyncClient(base_url=base_url)
+        self.path = path
+
+    @staticmethod
+    def notification(event: str, payment_id: str, status: str | None = None) -> dict:
+        return {
+            "type": "notification",
+            "event": event,
+            "object": {"id": payment_id, "status": status or event.split(".", 1)[1]},
+        }
+
+    async def send(self, event: str, payment_id: str, status: str | None = None, headers: dict | None = None) -> int:
+        response = await self.client.post(self.path, json=self.notification(event, payment_id, status), headers=headers)
+        return response.status_code
+
+    async def send_raw(self, content: bytes) -> int:
+        return (await self.client.post(self.path, content=content)).status_code
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,71 @@
+"""
+Остановка рассылки через флаг в БД: её видит задача в любом процессе,
+а не только в том, где администратор набрал /broadcast_cancel.
+"""
+import asyncio
+
+import tarot_bot
+
+RECIPIENTS = list(range(920001, 920011))
+
+
+class FakeBot:
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+        if self.on_send:
+            self.on_send(chat_id)
+
+    async def edit_message_text(self, text, **kwargs):
+        pass
+
+
+def _new_job(monkeypatch) -> int:
+    for uid in RECIPIENTS:
+        tarot_bot.register_user(uid, f"user{uid}")
+    monkeypatch.setitem(
+        tarot_bot.BROADCAST_SEGMENTS, "test",
+        ("тест", f"SELECT user_id FROM users WHERE user_id BETWEEN {RECIPIENTS[0]} AND {RECIPIENTS[-1]}"),
+    )
+    monkeypatch.setattr(tarot_bot, "BROADCAST_RATE", 0)
+    monkeypatch.setattr(tarot_bot, "BROADCAST_CONCURRENCY", 1)
+    monkeypatch.setattr(tarot_bot, "BROADCAST_FLUSH_SIZE", 2)
+    job_id, total = tarot_bot.create_broadcast_job("привет", "test", 0)
+    assert total == len(RECIPIENTS)
+    return job_id
+
+
+def test_cancel_from_another_process_stops_after_batch(monkeypatch):
+    job_id = _new_job(monkeypatch)
+    engine = tarot_bot.BroadcastEngine()
+    # отмену ставит другой воркер: в этом процессе о ней знает только БД
+    bot = FakeBot(on_send=lambda uid: uid == RECIPIENTS[2] and tarot_bot.request_broadcast_cancel(job_id))
+
+    asyncio.run(engine._run(bot, job_id))
+
+    job = tarot_bot.get_broadcast_job(job_id)
+    assert job["status"] == "cancelled"
+    assert len(bot.sent) == 4  # дослали текущую пачку из BROADCAST_FLUSH_SIZE
+    assert job["sent"] == 4
+    assert len(tarot_bot.get_pending_broadcast_recipients(job_id)) == len(RECIPIENTS) - 4
+    assert tarot_bot.get_unfinished_broadcast_ids().count(job_id) == 0
+
+
+def test_cancel_without_local_task_is_seen_on_resume(monkeypatch):
+    job_id = _new_job(monkeypatch)
+
+    async def main():
+        engine = tarot_bot.BroadcastEngine()
+        assert await engine.cancel(job_id) is True
+        bot = FakeBot()
+        await engine._run(bot, job_id)
+        return bot
+
+    bot = asyncio.run(main())
+
+    assert bot.sent == []
+    assert tarot_bot.get_broadcast_job(job_id)["status"] == "cancelled"
+    assert asyncio.run(tarot_bot.BroadcastEngine().cancel(job_id)) is False
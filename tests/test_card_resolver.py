@@ -0,0 +1,45 @@
+"""Распознавание названий карт: падежи, синонимы, опечатки и ключи WebApp."""
+import pytest
+
+import tarot_bot
+
+
+@pytest.mark.parametrize("name, key", [
+    ("Повешенный", "the_hanged_man"),
+    ("Повешенного", "the_hanged_man"),
+    ("повешенному", "the_hanged_man"),
+    ("Шута", "the_fool"),
+    ("Мага", "the_magician"),
+    ("Верховную Жрицу", "the_high_priestess"),
+    ("Императрицы", "the_empress"),
+    ("Колеса Фортуны", "wheel_of_fortune"),
+    ("Влюблённых", "the_lovers"),
+    ("Страшного суда", "judgement"),
+    ("башню", "the_tower"),
+    ("Звезду", "the_star"),
+    ("Солнца", "the_sun"),
+    ("Смерти", "death"),
+    ("безумца", "the_fool"),
+    ("Туз кубков", "ace_of_cups"),
+    ("двойку мечей", "two_of_swords"),
+    ("Queen of Pentacles", "queen_of_pentacles"),
+    ("the_hanged_man", "the_hanged_man"),
+])
+def test_resolves_names_and_cases(name, key):
+    assert tarot_bot.card_resolver.resolve(name) == key
+
+
+def test_resolves_typos_in_oblique_cases():
+    assert tarot_bot.card_resolver.resolve("Повешеного") == "the_hanged_man"
+
+
+def test_unknown_name_is_not_guessed():
+    assert tarot_bot.card_resolver.resolve("Пылесос") is None
+
+
+def test_oblique_forms_do_not_collide_between_cards():
+    owners = {}
+    for key, (ru, synonyms) in tarot_bot.MAJOR_CARD_NAMES.items():
+        for alias in (ru, *synonyms):
+            for form in tarot_bot._ru_case_forms(alias):
+                assert owners.setdefault(form, key) == key, form
@@ -0,0 +1,89 @@
+"""
+Стресс-тест атомарного списания попыток: параллельные списания из нескольких
+процессов и потоков не выдают больше гаданий, чем есть на балансе, и не уводят его в минус.
+"""
+import asyncio
+import multiprocessing as mp
+from collections import Counter
+
+import tarot_bot
+
+PROCESSES = 4
+CALLS_PER_PROCESS = 40  # 4 × 40 = 160 одновременных списаний
+BONUS, PAID = 5, 3
+
+
+def _make_user(user_id: int, request_count=0, bonus=BONUS, paid=PAID):
+    tarot_bot.register_user(user_id, f"user{user_id}")
+    with tarot_bot.get_db_transaction() as conn:
+        conn.execute(
+            "UPDATE users SET request_count = ?, bonus_requests = ?, paid_requests = ?, "
+            "is_subscribed = 0, subscription_end = NULL WHERE user_id = ?",
+            (request_count, bonus, paid, user_id)
+        )
+    tarot_bot.user_cache.invalidate(user_id)
+
+
+def _balance(user_id: int) -> tuple[int, int, int]:
+    with tarot_bot.get_db_connection() as conn:
+        u = conn.execute(
+            "SELECT request_count, bonus_requests, paid_requests FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+    return u["request_count"], u["bonus_requests"], u["paid_requests"]
+
+
+def _deduct_concurrently(user_id: int, n: int) -> list:
+    async def run():
+        return await asyncio.gather(*[tarot_bot.deduct_user_request(user_id) for _ in range(n)])
+    return asyncio.run(run())
+
+
+def test_concurrent_deduction_across_processes():
+    user_id = 700001
+    _make_user(user_id)
+
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(PROCESSES) as pool:
+        results = pool.starmap(_deduct_concurrently, [(user_id, CALLS_PER_PROCESS)] * PROCESSES)
+
+    got = Counter(bucket for chunk in results for bucket in chunk)
+    assert got == Counter({
+        "free": tarot_bot.MAX_FREE_REQUESTS, "bonus": BONUS, "paid": PAID,
+        None: PROCESSES * CALLS_PER_PROCESS - tarot_bot.MAX_FREE_REQUESTS - BONUS - PAID,
+    })
+    assert _balance(user_id) == (tarot_bot.MAX_FREE_REQUESTS, 0, 0)
+
+
+def test_concurrent_deduction_in_one_process():
+    user_id = 700002
+    _make_user(user_id, request_count=tarot_bot.MAX_FREE_REQUESTS - 2)
+
+    got = Counter(_deduct_concurrently(user_id, 50))
+    assert got == Counter({"free": 2, "bonus": BONUS, "paid": PAID, None: 50 - 2 - BONUS - PAID})
+    assert _balance(user_id) == (tarot_bot.MAX_FREE_REQUESTS, 0, 0)
+
+
+def test_refund_is_exact_inverse_of_deduction():
+    user_id = 700003
+    _make_user(user_id, request_count=tarot_bot.MAX_FREE_REQUESTS - 1)
+    before = _balance(user_id)
+
+    async def run():
+        buckets = await asyncio.gather(*[tarot_bot.deduct_user_request(user_id) for _ in range(20)])
+        assert _balance(user_id) == (tarot_bot.MAX_FREE_REQUESTS, 0, 0)
+        await asyncio.gather(*[tarot_bot.refund_user_request(user_id, b) for b in buckets])
+        return buckets
+
+    buckets = asyncio.run(run())
+    assert Counter(buckets) == Counter({"free": 1, "bonus": BONUS, "paid": PAID, None: 20 - 1 - BONUS - PAID})
+    assert _balance(user_id) == before
+
+
+def test_subscription_is_not_deducted():
+    user_id = 700004
+    _make_user(user_id, request_count=tarot_bot.MAX_FREE_REQUESTS, bonus=0, paid=0)
+    tarot_bot.extend_subscription(user_id, 1)
+
+    assert set(_deduct_concurrently(user_id, 20)) == {"sub"}
+    assert _balance(user_id) == (tarot_bot.MAX_FREE_REQUESTS, 0, 0)
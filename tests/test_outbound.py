@@ -0,0 +1,157 @@
+"""
+Исходящие сообщения: порядок в чате при RetryAfter (пауза без занятой очереди и с повтором
+через лимиты), отмена ждущего запроса и деление потокового ответа по длине в UTF-16;
+при ошибке показа поток OpenAI закрывается сразу, а слот очереди освобождается.
+"""
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+import tarot_bot
+
+
+def _send(pipeline, chat_id, callback):
+    return pipeline.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, None)
+
+
+def test_retry_after_keeps_chat_order_and_pauses_chat():
+    pipeline = tarot_bot.OutboundPipeline()
+    delivered, floods = [], {"c0": 1}
+
+    def message(text):
+        async def callback():
+            if floods.get(text):
+                floods[text] -= 1
+                raise RetryAfter(1)
+            delivered.append((text, time.monotonic()))
+            return text
+        return callback
+
+    async def main():
+        started = time.monotonic()
+        results = await asyncio.gather(*[_send(pipeline, 7, message(f"c{i}")) for i in range(3)])
+        return started, results
+
+    started, results = asyncio.run(main())
+    assert results == ["c0", "c1", "c2"]
+    assert [text for text, _ in delivered] == ["c0", "c1", "c2"]
+    assert delivered[0][1] - started >= 1.0
+    assert pipeline.stats["retry_after"] == 1
+    assert pipeline._chats == {}
+
+
+def test_cancelled_request_does_not_stall_chat():
+    pipeline = tarot_bot.OutboundPipeline()
+    delivered = []
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def first():
+            await gate.wait()
+            delivered.append("first")
+
+        async def record(name):
+            delivered.append(name)
+
+        tasks = [
+            asyncio.ensure_future(_send(pipeline, 9, first)),
+            asyncio.ensure_future(_send(pipeline, 9, lambda: record("second"))),
+            asyncio.ensure_future(_send(pipeline, 9, lambda: record("third"))),
+        ]
+        await asyncio.sleep(0.05)
+        tasks[1].cancel()
+        gate.set()
+        await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout=5)
+
+    asyncio.run(main())
+    assert delivered == ["first", "third"]
+    assert pipeline._chats == {}
+
+
+class FakeChat:
+    def __init__(self, sent):
+        self.sent = sent
+
+    async def send_message(self, text, **kwargs):
+        message = FakeStreamMessage(self.sent)
+        message.text = text
+        self.sent.append(message)
+        return message
+
+
+class FakeStreamMessage:
+    def __init__(self, sent):
+        self.text = ""
+        self.chat = FakeChat(sent)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+
+def test_streaming_reply_splits_by_utf16_length(monkeypatch):
+    monkeypatch.setattr(tarot_bot, "STREAM_EDIT_INTERVAL", 0)
+    sent = []
+    first = FakeStreamMessage(sent)
+    sent.append(first)
+    text = "Карта дня 🔮🌙✨ " * 600  # эмодзи — по две единицы UTF-16
+
+    async def main():
+        reply = tarot_bot.StreamingReply(first)
+        for i in range(0, len(text), 50):
+            await reply.feed(text[i:i + 50])
+        await reply.finish()
+
+    asyncio.run(main())
+    assert len(sent) > 1
+    assert all(tarot_bot.utf16_len(m.text) <= tarot_bot.STREAM_MESSAGE_LIMIT for m in sent)
+    assert "".join(m.text for m in sent).replace(" ", "") == text.replace(" ", "")
+
+
+class FakeOpenAIStream:
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.closed = False
+
+    async def __aiter__(self):
+        for delta in self.deltas:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+    async def close(self):
+        await asyncio.sleep(0)  # как у httpx: закрытие ответа — настоящий await
+        self.closed = True
+
+
+class BrokenStreamMessage(FakeStreamMessage):
+    async def edit_text(self, text, **kwargs):
+        raise RuntimeError("Telegram недоступен")
+
+    async def delete(self):
+        pass
+
+
+def test_stream_is_closed_when_showing_fails(monkeypatch):
+    stream = FakeOpenAIStream(["Шут ", "сулит ", "начало"])
+
+    async def create(**kwargs):
+        return stream
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(tarot_bot, "get_openai_client", lambda: client)
+    monkeypatch.setattr(tarot_bot, "openai_breaker", tarot_bot.CircuitBreaker("test", failure_threshold=100, reset_timeout=30))
+
+    async def main():
+        # без хуков asyncio брошенный генератор никто не доберёт: закрыть поток может только aclosing
+        sys.set_asyncgen_hooks(firstiter=None, finalizer=None)
+        try:
+            await tarot_bot.stream_reading_to_message(BrokenStreamMessage([]), "prompt")
+        except RuntimeError:
+            return stream.closed, tarot_bot.llm_admission.active
+        raise AssertionError("ошибка показа должна пробрасываться")
+
+    closed, active = asyncio.run(main())
+    assert closed
+    assert active == 0
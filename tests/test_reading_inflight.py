@@ -0,0 +1,166 @@
+"""
+Защита от повторной отправки расклада: «повтором» считается только отправка тех же карт
+с тем же вопросом после выданного толкования; после ошибки тот же расклад обрабатывается
+заново; одновременные отправки разбираются до очереди апдейтов пользователя.
+"""
+import asyncio
+import json
+
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+import tarot_bot
+
+CARDS = ["Шут", "Маг", "Жрица"]
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+
+
+class FakeUpdate:
+    def __init__(self, user_id):
+        self.effective_user = FakeUser(user_id)
+        self.message = FakeMessage()
+
+
+class FakeContext:
+    def __init__(self, question=None):
+        self.user_data = {"question": question} if question else {}
+
+
+def _run(monkeypatch, user_id, outcomes, questions=None):
+    """Отправляет расклад столько раз, сколько исходов в outcomes; возвращает (вызовы, ответы)."""
+    questions = questions or [None] * len(outcomes)
+    calls = []
+
+    async def fake_process_cards(update, context, cards):
+        calls.append(list(cards))
+        outcome = outcomes[len(calls) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return tarot_bot.READING_DELIVERED if outcome else tarot_bot.READING_FAILED
+
+    monkeypatch.setattr(tarot_bot, "_process_cards", fake_process_cards)
+    monkeypatch.setattr(tarot_bot.reading_rate_limiter, "check", lambda uid: (None, 0.0))
+
+    async def send_all():
+        replies = []
+        for question in questions:
+            update = FakeUpdate(user_id)
+            try:
+                await tarot_bot.process_cards(update, FakeContext(question), CARDS)
+            except RuntimeError:
+                pass
+            replies.append(update.message.replies)
+        return replies
+
+    return calls, asyncio.run(send_all())
+
+
+def test_resend_after_delivered_reading_gets_notice(monkeypatch):
+    calls, replies = _run(monkeypatch, 800001, [True, True])
+    assert len(calls) == 1
+    assert replies[1] and "уже расшифровал" in replies[1][0]
+
+
+def test_resend_after_failure_is_processed_again(monkeypatch):
+    calls, replies = _run(monkeypatch, 800002, [False, True])
+    assert len(calls) == 2
+    assert replies[1] == []
+
+
+def test_resend_after_exception_is_processed_again(monkeypatch):
+    calls, _ = _run(monkeypatch, 800003, [RuntimeError("boom"), True])
+    assert len(calls) == 2
+
+
+def test_same_cards_for_a_different_question_are_not_a_repeat(monkeypatch):
+    calls, replies = _run(
+        monkeypatch, 800004, [True, True, True],
+        questions=["Что ждёт меня в любви?", "Что ждёт меня в работе?", "Что ждёт меня в работе?"],
+    )
+    assert len(calls) == 2
+    assert replies[1] == []
+    assert "уже расшифровал" in replies[2][0]
+
+
+class StubRequest(BaseRequest):
+    """Bot API без сети: запоминает тексты sendMessage."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        params = request_data.parameters if request_data else {}
+        if url.endswith("getMe"):
+            result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+        else:
+            self.sent.append(params.get("text"))
+            result = {"message_id": len(self.sent), "date": 0, "chat": {"id": params.get("chat_id"), "type": "private"}}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def _webapp_update(bot, user_id: int, update_id: int, cards: list) -> Update:
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        "web_app_data": {"data": json.dumps({"cards": cards}), "button_text": "Выбрать"},
+    }}, bot)
+
+
+def test_concurrent_submissions_attach_or_are_rejected(monkeypatch):
+    user_id = 800005
+    calls = []
+    request = StubRequest()
+
+    async def main():
+        bot = ExtBot("1:test", request=request, get_updates_request=StubRequest())
+        await bot.initialize()
+        release = asyncio.Event()
+
+        async def slow_process_cards(update, context, cards):
+            calls.append(list(cards))
+            await release.wait()
+            return tarot_bot.READING_DELIVERED
+
+        monkeypatch.setattr(tarot_bot, "_process_cards", slow_process_cards)
+        processor = tarot_bot.UserOrderedUpdateProcessor(8)
+        context = FakeContext("Что ждёт меня в любви?")
+
+        def submit(update_id, cards):
+            update = _webapp_update(bot, user_id, update_id, cards)
+            # как Application: обработчик webapp → process_cards с картами из данных
+            handler = tarot_bot.process_cards(update, context, tarot_bot.submitted_cards(update))
+            return asyncio.ensure_future(processor.process_update(update, handler))
+
+        first = submit(1, CARDS)
+        await asyncio.sleep(0.05)
+        duplicate = submit(2, CARDS)
+        other = submit(3, ["Солнце", "Луна", "Звезда"])
+        await asyncio.wait_for(other, timeout=5)  # отказ приходит, не дожидаясь первого гадания
+        assert not duplicate.done()
+        release.set()
+        await asyncio.wait_for(asyncio.gather(first, duplicate), timeout=5)
+
+    asyncio.run(main())
+    assert len(calls) == 1
+    assert len(request.sent) == 1 and "предыдущий расклад" in request.sent[0]
@@ -0,0 +1,129 @@
+"""
+Лимит частоты гаданий берёт жетон только перед запросом к OpenAI: быстрые толкования
+и ответы из кэша его не тратят, а отказ по лимиту возвращает попытку и сохраняет вопрос.
+"""
+import asyncio
+import json
+
+import tarot_bot
+
+CARDS = ["Шут", "Маг", "Жрица"]
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def delete(self):
+        pass
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+        self.first_name = "Тест"
+        self.last_name = None
+
+
+class FakeUpdate:
+    def __init__(self, user_id):
+        self.effective_user = FakeUser(user_id)
+        self.message = FakeMessage()
+
+
+class FakeWebAppData:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeWebAppUpdate(FakeUpdate):
+    def __init__(self, user_id, cards):
+        super().__init__(user_id)
+        self.message.web_app_data = FakeWebAppData(json.dumps({"cards": cards}, ensure_ascii=False))
+        self.effective_message = self.message
+
+
+class FakeContext:
+    def __init__(self, question):
+        self.user_data = {"question": question}
+
+
+def _setup(monkeypatch, user_id, local: bool, limit):
+    tarot_bot.register_user(user_id, f"user{user_id}")
+    checks = []
+
+    def check(uid):
+        checks.append(uid)
+        return limit
+
+    async def wants_local(uid, bucket):
+        return local
+
+    async def no_openai(*args, **kwargs):
+        raise AssertionError("запроса к OpenAI быть не должно")
+
+    monkeypatch.setattr(tarot_bot.reading_rate_limiter, "check", check)
+    monkeypatch.setattr(tarot_bot, "wants_local_reading", wants_local)
+    monkeypatch.setattr(tarot_bot, "get_tarot_reading", no_openai)
+    monkeypatch.setattr(tarot_bot, "stream_reading_to_message", no_openai)
+    monkeypatch.setattr(tarot_bot, "log_request", lambda *args, **kwargs: None)
+    return checks
+
+
+def _request_count(user_id):
+    return tarot_bot.get_user(user_id)["request_count"] or 0
+
+
+def test_local_reading_does_not_take_rate_limit_token(monkeypatch):
+    user_id = 810001
+    checks = _setup(monkeypatch, user_id, local=True, limit=("user", 600.0))
+    update, context = FakeUpdate(user_id), FakeContext("Что меня ждёт?")
+
+    outcome = asyncio.run(tarot_bot._process_cards(update, context, CARDS))
+
+    assert outcome == tarot_bot.READING_DELIVERED
+    assert checks == []
+    assert _request_count(user_id) == 1
+
+
+def test_rate_limited_reading_is_refunded_and_keeps_question(monkeypatch):
+    user_id = 810002
+    checks = _setup(monkeypatch, user_id, local=False, limit=("user", 600.0))
+    update, context = FakeUpdate(user_id), FakeContext("Что меня ждёт?")
+
+    outcome = asyncio.run(tarot_bot._process_cards(update, context, CARDS))
+
+    assert outcome == tarot_bot.READING_LIMITED
+    assert checks == [user_id]
+    assert _request_count(user_id) == 0
+    assert update.message.replies[-1] == tarot_bot.rate_limit_message("user", 600.0)
+    assert context.user_data["question"] == "Что меня ждёт?"
+
+
+def test_webapp_handler_keeps_question_after_rate_limit(monkeypatch):
+    user_id = 810003
+    _setup(monkeypatch, user_id, local=False, limit=("user", 600.0))
+    update, context = FakeWebAppUpdate(user_id, CARDS), FakeContext("Что меня ждёт?")
+    context.user_data["spread_positions"] = ["Прошлое", "Настоящее", "Будущее"]
+
+    asyncio.run(tarot_bot.handle_webapp(update, context))
+
+    assert update.message.replies[-1] == tarot_bot.rate_limit_message("user", 600.0)
+    assert context.user_data["question"] == "Что меня ждёт?"
+    assert context.user_data["spread_positions"] == ["Прошлое", "Настоящее", "Будущее"]
+
+
+def test_webapp_handler_clears_session_after_reading(monkeypatch):
+    user_id = 810004
+    _setup(monkeypatch, user_id, local=True, limit=None)
+    update, context = FakeWebAppUpdate(user_id, CARDS), FakeContext("Что меня ждёт?")
+
+    asyncio.run(tarot_bot.handle_webapp(update, context))
+
+    assert context.user_data == {}
+    assert _request_count(user_id) == 1
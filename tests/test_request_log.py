@@ -0,0 +1,44 @@
+"""Журнал гаданий: записи, уже взятые фоновой задачей в пачку, дописываются при остановке."""
+import asyncio
+
+import tarot_bot
+
+
+def _logged(user_id: int) -> list:
+    with tarot_bot.get_db_connection() as conn:
+        return conn.execute("SELECT question, cards FROM request_log WHERE user_id = ?", (user_id,)).fetchall()
+
+
+def test_stop_flushes_batch_waiting_for_timer(monkeypatch):
+    monkeypatch.setattr(tarot_bot, "REQUEST_LOG_FLUSH_INTERVAL", 30.0)
+    writer = tarot_bot.RequestLogWriter()
+    monkeypatch.setattr(tarot_bot, "request_log_writer", writer)
+    user_id = 820001
+
+    async def main():
+        writer.start()
+        tarot_bot.log_request(user_id, "user", "Что меня ждёт?", ["Шут", "Маг", "Жрица"], "love")
+        await asyncio.sleep(0.05)  # фоновая задача взяла запись и ждёт таймера пачки
+        assert writer._queue.empty()
+        await writer.stop()
+
+    asyncio.run(main())
+    assert [tuple(r) for r in _logged(user_id)] == [("Что меня ждёт?", "Шут, Маг, Жрица")]
+    assert writer.stats["enqueued"] == 1 and writer.stats["written"] == 1
+
+
+def test_stop_flushes_everything_still_queued(monkeypatch):
+    monkeypatch.setattr(tarot_bot, "REQUEST_LOG_BATCH_SIZE", 3)
+    writer = tarot_bot.RequestLogWriter()
+    monkeypatch.setattr(tarot_bot, "request_log_writer", writer)
+    user_id = 820002
+
+    async def main():
+        writer.start()
+        for i in range(10):
+            tarot_bot.log_request(user_id, "user", f"вопрос {i}", ["Шут"])
+        await writer.stop()
+
+    asyncio.run(main())
+    assert len(_logged(user_id)) == 10
+    assert writer.stats["written"] == 10
@@ -0,0 +1,104 @@
+"""
+Переход от готового расклада к своему вопросу: ключ расклада не переносится, и гадание
+по своему вопросу не берётся из общего кэша расклада и не учитывается в его статистике.
+"""
+import asyncio
+
+import tarot_bot
+
+SPREAD_KEY = "spread_love_thoughts"
+QUESTION = "Что ждёт меня в работе в этом месяце?"
+CARDS = ["the_fool", "the_magician", "the_high_priestess"]
+
+
+class FakeMessage:
+    def __init__(self, text=""):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def delete(self):
+        pass
+
+
+class FakeCallbackQuery:
+    def __init__(self):
+        self.message = FakeMessage()
+
+    async def edit_message_text(self, text, **kwargs):
+        pass
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f"user{user_id}"
+
+
+class FakeUpdate:
+    def __init__(self, user_id, text=""):
+        self.effective_user = FakeUser(user_id)
+        self.message = FakeMessage(text)
+        self.callback_query = FakeCallbackQuery()
+
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+
+
+def test_custom_question_after_ready_spread_drops_spread(monkeypatch):
+    user_id = 830001
+    tarot_bot.register_user(user_id, "user")
+    context = FakeContext()
+    cache_lookups, logged = [], []
+
+    async def no_local(uid, bucket):
+        return False
+
+    async def reading(prompt, *args, **kwargs):
+        return "Толкование"
+
+    def cache_key(spread_key, cards):
+        cache_lookups.append(spread_key)
+        return None
+
+    monkeypatch.setattr(tarot_bot, "wants_local_reading", no_local)
+    monkeypatch.setattr(tarot_bot, "OPENAI_STREAMING", False)
+    monkeypatch.setattr(tarot_bot, "get_tarot_reading", reading)
+    monkeypatch.setattr(tarot_bot, "reading_cache_key", cache_key)
+    monkeypatch.setattr(tarot_bot.reading_rate_limiter, "check", lambda uid: (None, 0.0))
+    monkeypatch.setattr(tarot_bot, "log_request", lambda uid, name, q, cards, spread=None: logged.append((q, spread)))
+
+    async def main():
+        await tarot_bot.handle_ready_spread(FakeUpdate(user_id), context, SPREAD_KEY)
+        assert tarot_bot.active_spread_key(context.user_data) == SPREAD_KEY
+
+        await tarot_bot.handle_text(FakeUpdate(user_id, "🃏 Задать вопрос"), context)
+        await tarot_bot.handle_text(FakeUpdate(user_id, QUESTION), context)
+        assert "spread_key" not in context.user_data
+        assert "spread_positions" not in context.user_data
+
+        assert await tarot_bot._process_cards(FakeUpdate(user_id), context, CARDS) == tarot_bot.READING_DELIVERED
+
+    asyncio.run(main())
+    assert cache_lookups == [None]
+    assert logged == [(QUESTION, None)]
+
+
+def test_stale_spread_key_is_ignored_for_other_question():
+    user_data = {"spread_key": SPREAD_KEY, "question": QUESTION}
+    assert tarot_bot.active_spread_key(user_data) is None
+    user_data["question"] = tarot_bot.READY_SPREADS[SPREAD_KEY]["title"]
+    assert tarot_bot.active_spread_key(user_data) == SPREAD_KEY
+
+
+def test_card_of_day_drops_ready_spread():
+    context = FakeContext()
+    context.user_data.update(spread_key=SPREAD_KEY, spread_positions=["a", "b", "c"])
+    asyncio.run(tarot_bot.handle_card_of_day(FakeUpdate(830002), context))
+    assert "spread_key" not in context.user_data
+    assert context.user_data["is_card_of_day"] is True
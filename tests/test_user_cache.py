@@ -0,0 +1,59 @@
+"""
+Замки записи users разбиты на полосы: мутации разных пользователей не ждут друг друга,
+а кэш после параллельных мутаций совпадает с базой.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tarot_bot
+
+USERS = list(range(930001, 930009))
+UPDATES_PER_USER = 25
+
+
+def test_other_user_is_not_blocked_by_held_stripe():
+    user_a, user_b = USERS[0], USERS[1]
+    assert user_a % tarot_bot.USER_WRITE_LOCK_STRIPES != user_b % tarot_bot.USER_WRITE_LOCK_STRIPES
+    held, release = threading.Event(), threading.Event()
+
+    def hold_a():
+        with tarot_bot.user_write_locked([user_a]):
+            held.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_a)
+    holder.start()
+    try:
+        assert held.wait(5)
+        acquired = {}
+
+        def try_lock(uid):
+            stripe = tarot_bot._user_write_locks[uid % tarot_bot.USER_WRITE_LOCK_STRIPES]
+            acquired[uid] = stripe.acquire(timeout=0.2)
+            if acquired[uid]:
+                stripe.release()
+
+        try_lock(user_b)
+        try_lock(user_a)
+        assert acquired == {user_b: True, user_a: False}
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_cache_matches_db_after_parallel_mutations():
+    for uid in USERS:
+        tarot_bot.register_user(uid, f"user{uid}")
+        tarot_bot.get_user(uid)  # строка в кэше до начала мутаций
+
+    def bump(uid):
+        with tarot_bot.user_mutation(uid) as conn:
+            conn.execute("UPDATE users SET bonus_requests = COALESCE(bonus_requests, 0) + 1 WHERE user_id = ?", (uid,))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(bump, [uid for uid in USERS for _ in range(UPDATES_PER_USER)]))
+
+    with tarot_bot.get_db_connection() as conn:
+        for uid in USERS:
+            row = conn.execute("SELECT bonus_requests FROM users WHERE user_id = ?", (uid,)).fetchone()
+            assert tarot_bot.user_cache.get(uid)["bonus_requests"] == row["bonus_requests"]
@@ -0,0 +1,166 @@
+"""
+Уведомления ЮKassa: проверка адреса отправителя, перепроверка статуса через API
+и идемпотентная активация — повторные и одновременные уведомления начисляют оплату один раз.
+"""
+import asyncio
+import ipaddress
+import socket
+
+from tornado.httpserver import HTTPServer
+
+import tarot_bot
+from conftest import FAKE_YOOKASSA_PORT
+from fake_yookassa import FakeYooKassa, NotificationSender
+
+TARIFF = "pay10"
+CREDITED = tarot_bot.TARIFFS[TARIFF]["requests"]
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.update_queue = asyncio.Queue()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run(scenario):
+    """Поднимает фейковую ЮKassa и вебхук бота, выполняет scenario(api, sender, bot)."""
+    async def main():
+        api = FakeYooKassa()
+        api.start(FAKE_YOOKASSA_PORT)
+        app = FakeApplication()
+        port = _free_port()
+        server = HTTPServer(tarot_bot.build_web_app(app))
+        server.listen(port, "127.0.0.1")
+        sender = NotificationSender(f"http://127.0.0.1:{port}", tarot_bot.YOOKASSA_WEBHOOK_PATH)
+        try:
+            await scenario(api, sender, app.bot)
+        finally:
+            await sender.close()
+            await tarot_bot.yookassa_gateway.close()
+            server.stop()
+            api.stop()
+    asyncio.run(main())
+
+
+def _new_payment(api: FakeYooKassa, user_id: int, payment_id: str, api_status: str):
+    tarot_bot.register_user(user_id, f"user{user_id}")
+    tarot_bot.save_created_payment(f"order-{payment_id}", payment_id, user_id, TARIFF, 100.0)
+    api.add_payment(payment_id, api_status, user_id, TARIFF)
+
+
+def _paid(user_id: int) -> int:
+    return tarot_bot.get_user(user_id)["paid_requests"] or 0
+
+
+def _status(payment_id: str) -> str:
+    return tarot_bot.get_payment(payment_id)["status"]
+
+
+def test_duplicate_notifications_credit_once():
+    user_id, payment_id = 900001, "pay-dup"
+
+    async def scenario(api, sender, bot):
+        _new_payment(api, user_id, payment_id, "succeeded")
+        before = _paid(user_id)
+
+        codes = await asyncio.gather(*[sender.send("payment.succeeded", payment_id) for _ in range(5)])
+        assert codes == [200] * 5
+        assert await sender.send("payment.succeeded", payment_id) == 200  # повтор доставки позже
+
+        assert _paid(user_id) == before + CREDITED
+        assert _status(payment_id) == "succeeded"
+        assert len([text for chat, text in bot.sent if chat == user_id]) == 1
+
+    _run(scenario)
+
+
+def test_forged_success_is_checked_against_api():
+    user_id, payment_id = 900002, "pay-forged"
+
+    async def scenario(api, sender, bot):
+        _new_payment(api, user_id, payment_id, "pending")
+        before = _paid(user_id)
+
+        assert await sender.send("payment.succeeded", payment_id) == 200
+        assert api.calls == [payment_id]
+        assert _paid(user_id) == before
+        assert _status(payment_id) != "succeeded"
+        assert bot.sent == []
+
+        # когда платёж действительно прошёл, следующее уведомление его активирует
+        api.add_payment(payment_id, "succeeded", user_id, TARIFF)
+        assert await sender.send("payment.succeeded", payment_id) == 200
+        assert _paid(user_id) == before + CREDITED
+
+    _run(scenario)
+
+
+def test_cancel_does_not_credit_and_success_after_cancel_is_ignored():
+    user_id, payment_id = 900003, "pay-cancel"
+
+    async def scenario(api, sender, bot):
+        _new_payment(api, user_id, payment_id, "canceled")
+        before = _paid(user_id)
+
+        assert await sender.send("payment.canceled", payment_id) == 200
+        assert _status(payment_id) == "canceled"
+        assert await sender.send("payment.succeeded", payment_id) == 200  # API всё ещё говорит canceled
+        assert _paid(user_id) == before
+        assert len(bot.sent) == 1
+
+    _run(scenario)
+
+
+def test_foreign_address_and_bad_body_are_rejected(monkeypatch):
+    user_id, payment_id = 900004, "pay-foreign"
+
+    async def scenario(api, sender, bot):
+        _new_payment(api, user_id, payment_id, "succeeded")
+        before = _paid(user_id)
+
+        assert await sender.send_raw(b"{") == 400
+
+        monkeypatch.setattr(tarot_bot, "YOOKASSA_NOTIFY_IPS", [])
+        assert await sender.send("payment.succeeded", payment_id) == 403
+        assert api.calls == []
+        assert _paid(user_id) == before
+        assert _status(payment_id) != "succeeded"
+
+    _run(scenario)
+
+
+def test_forwarded_for_is_trusted_only_from_proxy(monkeypatch):
+    user_id, payment_id = 900005, "pay-spoofed"
+    yookassa_ip = {"X-Forwarded-For": "185.71.76.1"}
+
+    async def scenario(api, sender, bot):
+        _new_payment(api, user_id, payment_id, "succeeded")
+        before = _paid(user_id)
+        monkeypatch.setattr(tarot_bot, "YOOKASSA_NOTIFY_IPS", [ipaddress.ip_network("185.71.76.0/27")])
+
+        # прямой запрос с подставленным заголовком: адрес соединения не из списка ЮKassa
+        assert await sender.send("payment.succeeded", payment_id, headers=yookassa_ip) == 403
+        # клиент дописал IP ЮKassa перед адресом, который добавил наш прокси
+        monkeypatch.setattr(tarot_bot, "TRUSTED_PROXY_IPS", [ipaddress.ip_network("127.0.0.1/32")])
+        spoofed = {"X-Forwarded-For": "185.71.76.1, 203.0.113.7"}
+        assert await sender.send("payment.succeeded", payment_id, headers=spoofed) == 403
+        assert _paid(user_id) == before
+
+        assert await sender.send("payment.succeeded", payment_id, headers=yookassa_ip) == 200
+        assert _paid(user_id) == before + CREDITED
+
+    _run(scenario)